@@ -0,0 +1,190 @@
+"""
+Persistent scan results cache, the entries are keyed by the file fingerprint (device, inode, size, mtime)
+and optionally by the content hash, so unchanged files are not inspected again
+"""
+import contextlib
+import datetime
+import hashlib
+import json
+import os
+import sqlite3
+import time
+import typing as t
+
+SCAN = "scan"
+ELA = "ela"
+# perceptual hash of the image, see phash.py
+PHASH = "phash"
+
+DEFAULT_MAX_ENTRIES = 1_000_000
+# bumped when the entries table changes, the cache of an older schema is dropped
+SCHEMA_VERSION = 2
+HASH_CHUNK_SIZE = 2**20
+# seconds to wait for the other scans sharing the cache file to release the write lock
+LOCK_TIMEOUT = 60.0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    kind TEXT NOT NULL,
+    device INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    content_hash TEXT,
+    version TEXT NOT NULL,
+    result TEXT NOT NULL,
+    accessed REAL NOT NULL,
+    PRIMARY KEY (kind, device, inode, version)
+);
+CREATE INDEX IF NOT EXISTS entries_content_hash ON entries (kind, content_hash, version);
+CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed);
+"""
+
+
+def _encode(value: t.Any) -> t.Any:
+    if isinstance(value, datetime.datetime):
+        return {"$datetime": value.isoformat()}
+    if isinstance(value, os.PathLike):
+        return os.fspath(value)
+    raise TypeError(f"can't serialize {type(value).__name__}")
+
+
+def _decode(value: dict[str, t.Any]) -> t.Any:
+    if "$datetime" in value:
+        return datetime.datetime.fromisoformat(value["$datetime"])
+    return value
+
+
+def hash_file(path: str) -> str:
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, "rb") as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ScanCache:
+    """
+    SQLite backed cache of the per-file results of a given `kind` (scan, ela or phash).
+    The entries are keyed by `version` (inspectors or model version) as well, so the runs of different versions
+    can share the cache file, the entries of the versions no longer used are left to the eviction.
+    The least recently used entries are evicted once the cache holds more than `max_entries`
+    """
+
+    def __init__(self, path: str, max_entries: int = DEFAULT_MAX_ENTRIES, hash_contents: bool = False) -> None:
+        self.max_entries = max_entries
+        self.hash_contents = hash_contents
+        self.connection = sqlite3.connect(path, timeout=LOCK_TIMEOUT)
+        # readers don't block the writer, so concurrent scans can share one cache file
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        (schema_version,) = self.connection.execute("PRAGMA user_version").fetchone()
+        if schema_version != SCHEMA_VERSION:
+            # the perceptual index kept in the cache file is dropped along
+            self.connection.executescript("DROP TABLE IF EXISTS entries; DROP TABLE IF EXISTS phash_nodes;")
+            self.connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION:d}")
+        self.connection.executescript(_SCHEMA)
+        # upper bound of the number of entries, counted for real only when it exceeds `max_entries`
+        (self.entries,) = self.connection.execute("SELECT COUNT(*) FROM entries").fetchone()
+        self.hits = 0
+        self.misses = 0
+        # hashes computed by the missed lookups, reused when the new result is stored
+        self._hashes: dict[str, str] = {}
+
+    def __enter__(self) -> "ScanCache":
+        return self
+
+    def __exit__(self, *args: t.Any) -> None:
+        self.close()
+
+    def get(self, kind: str, path: str, version: str) -> t.Optional[t.Any]:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+
+        row = self.connection.execute(
+            "SELECT size, mtime_ns, result FROM entries WHERE kind = ? AND device = ? AND inode = ? AND version = ?",
+            (kind, stat.st_dev, stat.st_ino, version),
+        ).fetchone()
+        if row and row[:2] == (stat.st_size, stat.st_mtime_ns):
+            self._touch(kind, stat, version)
+            self.hits += 1
+            return json.loads(row[2], object_hook=_decode)
+
+        if self.hash_contents:
+            # the file might have been copied or touched without changing its contents
+            self._hashes[path] = hash_file(path)
+            row = self.connection.execute(
+                "SELECT result FROM entries WHERE kind = ? AND content_hash = ? AND version = ?",
+                (kind, self._hashes[path], version),
+            ).fetchone()
+            if row:
+                self.hits += 1
+                result = json.loads(row[0], object_hook=_decode)
+                self.put(kind, path, version, result)
+                return result
+
+        self.misses += 1
+        return None
+
+    def put(self, kind: str, path: str, version: str, result: t.Any) -> None:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return
+        content_hash = (self._hashes.pop(path, None) or hash_file(path)) if self.hash_contents else None
+        self.connection.execute(
+            "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                kind,
+                stat.st_dev,
+                stat.st_ino,
+                stat.st_size,
+                stat.st_mtime_ns,
+                content_hash,
+                version,
+                json.dumps(result, default=_encode),
+                time.time(),
+            ),
+        )
+        self.entries += 1
+
+    def _touch(self, kind: str, stat: os.stat_result, version: str) -> None:
+        self.connection.execute(
+            "UPDATE entries SET accessed = ? WHERE kind = ? AND device = ? AND inode = ? AND version = ?",
+            (time.time(), kind, stat.st_dev, stat.st_ino, version),
+        )
+
+    def commit(self) -> None:
+        self.evict()
+        self.connection.commit()
+
+    def evict(self) -> None:
+        """
+        The entries are only counted once the puts might have pushed them over `max_entries`, then a tenth of it
+        is freed, so a full cache isn't counted again on every commit
+        """
+        if self.entries <= self.max_entries:
+            return
+        (count,) = self.connection.execute("SELECT COUNT(*) FROM entries").fetchone()
+        if count > self.max_entries:
+            self.connection.execute(
+                "DELETE FROM entries WHERE rowid IN (SELECT rowid FROM entries ORDER BY accessed LIMIT ?)",
+                (count - self.max_entries + self.max_entries // 10,),
+            )
+            count = self.max_entries - self.max_entries // 10
+        self.entries = count
+
+    def close(self) -> None:
+        self.commit()
+        self.connection.close()
+
+
+def open_cache(
+    path: t.Optional[str],
+    max_entries: int = DEFAULT_MAX_ENTRIES,
+    hash_contents: bool = False,
+) -> t.ContextManager[t.Optional[ScanCache]]:
+    if path is None:
+        return contextlib.nullcontext()
+    return ScanCache(path, max_entries=max_entries, hash_contents=hash_contents)
@@ -0,0 +1,67 @@
+"""
+Thin client of the `serve` daemon, only the standard library is imported so that the analysis of a single file
+doesn't pay the torch import and the model load
+"""
+import http.client
+import json
+import socket
+import typing as t
+import urllib.parse
+
+CLIENT_CHUNK_SIZE = 256
+DEFAULT_TIMEOUT = 600.0
+
+
+class ServerError(Exception):
+    pass
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path: str, timeout: float = DEFAULT_TIMEOUT) -> None:
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self) -> None:
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def connect(address: str, timeout: float = DEFAULT_TIMEOUT) -> http.client.HTTPConnection:
+    """`address` is either `unix:/path/to.sock` or `http://127.0.0.1:8765`"""
+    if address.startswith("unix:"):
+        return UnixHTTPConnection(address[len("unix:") :], timeout)
+    url = urllib.parse.urlsplit(address if "://" in address else f"http://{address}")
+    return http.client.HTTPConnection(url.hostname or "127.0.0.1", url.port, timeout=timeout)
+
+
+def _request(address: str, method: str, path: str, body: t.Optional[dict[str, t.Any]] = None) -> dict[str, t.Any]:
+    connection = connect(address)
+    try:
+        connection.request(
+            method,
+            path,
+            body=None if body is None else json.dumps(body),
+            headers={"Content-Type": "application/json"},
+        )
+        response = connection.getresponse()
+        result: dict[str, t.Any] = json.loads(response.read())
+    except (OSError, ValueError) as e:
+        raise ServerError(f"can't reach the ELA server at {address}: {e}") from e
+    finally:
+        connection.close()
+    if response.status != 200:
+        raise ServerError(f"the ELA server failed: {result.get('error', response.reason)}")
+    return result
+
+
+def health(address: str) -> dict[str, t.Any]:
+    return _request(address, "GET", "/health")
+
+
+def analyze(address: str, paths: list[str]) -> t.Iterator[tuple[str, t.Optional[bool]]]:
+    """Yields (path, is_authentic) in the order of `paths`, the paths have to be readable by the server"""
+    for start in range(0, len(paths), CLIENT_CHUNK_SIZE):
+        result = _request(address, "POST", "/analyze", {"paths": paths[start : start + CLIENT_CHUNK_SIZE]})
+        for item in result["results"]:
+            yield item["path"], item["is_authentic"]
@@ -0,0 +1,315 @@
+"""
+Concurrent image downloader, the images are fetched on a thread pool sharing one pooled HTTP session
+and handed to the scanner as soon as they arrive
+"""
+import collections
+import hashlib
+import html.parser
+import itertools
+import os
+import threading
+import typing as t
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.parse import urldefrag, urljoin, urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from app import profiling
+from app.utils import (
+    DEFAULT_DOWNLOAD_LIMIT,
+    DEFAULT_DOWNLOAD_WORKERS,
+    DOWNLOAD_CHUNK_SIZE,
+    IMAGE_EXTENSIONS,
+    USER_AGENT,
+    print_error_and_exit,
+    print_warning,
+    print_warning_and_exit,
+)
+
+DEFAULT_PER_HOST_LIMIT = 4
+# (connect, read) timeouts in seconds
+DEFAULT_TIMEOUT = (5.0, 30.0)
+# images up to this size are kept in memory, the bigger ones are spilled to the download folder
+IN_MEMORY_LIMIT = 2**23
+DEFAULT_MAX_PAGES = 1000
+DEFAULT_MAX_FRONTIER = 10_000
+
+
+class Download(t.NamedTuple):
+    url: str
+    data: t.Optional[bytes] = None
+    path: t.Optional[str] = None
+
+
+def create_session(pool_size: int = DEFAULT_DOWNLOAD_WORKERS) -> requests.Session:
+    session = requests.Session()
+    session.headers["User-Agent"] = USER_AGENT
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def is_image_url(url: str) -> bool:
+    return urlsplit(url).path.lower().endswith(tuple(IMAGE_EXTENSIONS))
+
+
+def _parse_srcset(srcset: str) -> list[str]:
+    return [candidate.split()[0] for candidate in srcset.split(",") if candidate.strip()]
+
+
+class _LinkParser(html.parser.HTMLParser):
+    """
+    Collects the links and the image urls while the page is tokenized, without building the document tree.
+    The comments and the `<script>`/`<style>` bodies are skipped by the tokenizer
+    """
+
+    def __init__(self, base_url: str) -> None:
+        super().__init__(convert_charrefs=True)
+        self.base_url = base_url
+        self.links: list[str] = []
+        self.images: list[str] = []
+
+    def handle_starttag(self, tag: str, attrs: list[tuple[str, t.Optional[str]]]) -> None:
+        values = {name: value for name, value in attrs if value}
+        if tag == "a" and (href := values.get("href")):
+            self.links.append(urldefrag(urljoin(self.base_url, href.strip())).url)
+        elif tag in ("img", "source"):
+            candidates = _parse_srcset(values.get("srcset", ""))
+            if src := values.get("src"):
+                candidates.insert(0, src)
+            self.images.extend(urljoin(self.base_url, candidate.strip()) for candidate in candidates)
+
+
+def extract_links(page: str, base_url: str) -> tuple[list[str], list[str]]:
+    """
+    Returns the (page links, image urls) of the HTML page. `<img>`/`<source>` `src` and `srcset` are taken
+    into account
+    """
+    parser = _LinkParser(base_url)
+    parser.feed(page)
+    parser.close()
+    return parser.links, [image for image in parser.images if is_image_url(image)]
+
+
+def get_images_from_url(  # type: ignore[return]
+    url: str,
+    session: t.Optional[requests.Session] = None,
+    timeout: tuple[float, float] = DEFAULT_TIMEOUT,
+) -> list[str]:
+    response = (session or create_session()).get(url, timeout=timeout)
+    if response.status_code == 200:
+        _, images = extract_links(response.text, url)
+        return list(dict.fromkeys(images))
+    else:
+        print_error_and_exit(f"Failed to retrieve the webpage. Status code: {response.status_code}")
+
+
+class Crawler:
+    """
+    Breadth-first crawl starting from a page up to `max_depth` links away, yielding every image url once.
+    At most `max_pages` pages are fetched and at most `max_frontier` pages wait in the queue
+    """
+
+    def __init__(
+        self,
+        session: t.Optional[requests.Session] = None,
+        max_depth: int = 0,
+        same_domain: bool = True,
+        max_pages: int = DEFAULT_MAX_PAGES,
+        max_frontier: int = DEFAULT_MAX_FRONTIER,
+        workers: int = DEFAULT_DOWNLOAD_WORKERS,
+        timeout: tuple[float, float] = DEFAULT_TIMEOUT,
+    ) -> None:
+        self.session = session or create_session(workers)
+        self.max_depth = max_depth
+        self.same_domain = same_domain
+        self.max_pages = max_pages
+        self.max_frontier = max_frontier
+        self.workers = workers
+        self.timeout = timeout
+        self.pages_fetched = 0
+
+    def _fetch_page(self, url: str) -> t.Optional[str]:
+        try:
+            with self.session.get(url, stream=True, timeout=self.timeout) as response:
+                if response.status_code != 200:
+                    print_warning(f"Failed to retrieve the webpage {url}. Status code: {response.status_code}")
+                    return None
+                if "html" not in response.headers.get("Content-Type", "text/html"):
+                    return None
+                return response.text
+        except requests.RequestException as e:
+            print_warning(f"Failed to retrieve the webpage {url}: {e}")
+            return None
+
+    def _is_followed(self, link: str, domain: str) -> bool:
+        parts = urlsplit(link)
+        if parts.scheme not in ("http", "https"):
+            return False
+        return not self.same_domain or parts.netloc.lower() == domain
+
+    def crawl(self, url: str) -> t.Iterator[str]:
+        domain = urlsplit(url).netloc.lower()
+        start = urldefrag(url).url
+        seen_pages = {start}
+        seen_images: set[str] = set()
+        frontier = collections.deque([(start, 0)])
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while frontier and self.pages_fetched < self.max_pages:
+                batch_size = min(self.workers, self.max_pages - self.pages_fetched, len(frontier))
+                batch = [frontier.popleft() for _ in range(batch_size)]
+                pages = executor.map(self._fetch_page, [page_url for page_url, _ in batch])
+                for (page_url, depth), page in zip(batch, pages):
+                    self.pages_fetched += 1
+                    if page is None:
+                        continue
+                    links, images = extract_links(page, page_url)
+                    new_images = [image for image in dict.fromkeys(images) if image not in seen_images]
+                    seen_images.update(new_images)
+                    yield from new_images
+                    if depth < self.max_depth:
+                        self._enqueue(links, depth + 1, domain, seen_pages, frontier)
+
+    def _enqueue(
+        self,
+        links: list[str],
+        depth: int,
+        domain: str,
+        seen_pages: set[str],
+        frontier: collections.deque[tuple[str, int]],
+    ) -> None:
+        for link in links:
+            if len(frontier) >= self.max_frontier:
+                return
+            if link not in seen_pages and self._is_followed(link, domain):
+                seen_pages.add(link)
+                frontier.append((link, depth))
+
+
+def _hash_download(download: Download) -> str:
+    digest = hashlib.blake2b(digest_size=20)
+    if download.data is not None:
+        digest.update(download.data)
+    else:
+        with open(str(download.path), "rb") as file:
+            while chunk := file.read(DOWNLOAD_CHUNK_SIZE):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Downloader:
+    """
+    Downloads the images on `workers` threads with at most `per_host_limit` concurrent requests to a single host.
+    Images smaller than `in_memory_limit` never touch the disk, the bigger ones are written to `spill_folder`
+    """
+
+    def __init__(
+        self,
+        spill_folder: str,
+        session: t.Optional[requests.Session] = None,
+        workers: int = DEFAULT_DOWNLOAD_WORKERS,
+        per_host_limit: int = DEFAULT_PER_HOST_LIMIT,
+        timeout: tuple[float, float] = DEFAULT_TIMEOUT,
+        in_memory_limit: int = IN_MEMORY_LIMIT,
+    ) -> None:
+        self.session = session or create_session(workers)
+        self.workers = workers
+        self.timeout = timeout
+        self.in_memory_limit = in_memory_limit
+        self.spill_folder = spill_folder
+        self._host_limits: dict[str, threading.BoundedSemaphore] = collections.defaultdict(
+            lambda: threading.BoundedSemaphore(per_host_limit),
+        )
+        self._lock = threading.Lock()
+        self.duplicates = 0
+
+    def _host_limit(self, url: str) -> threading.BoundedSemaphore:
+        with self._lock:
+            return self._host_limits[urlsplit(url).netloc]
+
+    def fetch(self, url: str) -> t.Optional[Download]:
+        with profiling.stage("download"):
+            return self._fetch(url)
+
+    def _fetch(self, url: str) -> t.Optional[Download]:
+        try:
+            with self._host_limit(url), self.session.get(url, stream=True, timeout=self.timeout) as response:
+                if response.status_code != 200:
+                    print_warning(f"Failed to download image {url}. Status code: {response.status_code}")
+                    return None
+                return self._read(url, response)
+        except requests.RequestException as e:
+            print_warning(f"Failed to download image {url}: {e}")
+            return None
+
+    def _read(self, url: str, response: requests.Response) -> Download:
+        buffer = bytearray()
+        chunks = response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE)
+        for chunk in chunks:
+            buffer += chunk
+            if len(buffer) > self.in_memory_limit:
+                break
+        else:
+            profiling.add_bytes("download", len(buffer))
+            return Download(url=url, data=bytes(buffer))
+
+        os.makedirs(self.spill_folder, exist_ok=True)
+        name = os.path.basename(urlsplit(url).path)
+        path = f"{self.spill_folder}/{hashlib.sha1(url.encode()).hexdigest()[:12]}_{name}"
+        with open(path, "wb") as file:
+            file.write(buffer)
+            for chunk in chunks:
+                file.write(chunk)
+            profiling.add_bytes("download", file.tell())
+        return Download(url=url, path=path)
+
+    def fetch_all(self, urls: t.Iterable[str], limit: t.Optional[int] = None) -> t.Iterator[Download]:
+        """
+        Yields up to `limit` successful downloads in the order of `urls` while the following ones are still
+        in flight. `urls` is consumed lazily and images with already seen contents are skipped
+        """
+        seen_hashes = set()
+        yielded = 0
+        urls_iter = iter(urls)
+        pending: collections.deque[Future[t.Optional[Download]]] = collections.deque()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending.extend(executor.submit(self.fetch, url) for url in itertools.islice(urls_iter, self.workers * 2))
+            while pending and (limit is None or yielded < limit):
+                download = pending.popleft().result()
+                if (url := next(urls_iter, None)) is not None:
+                    pending.append(executor.submit(self.fetch, url))
+                if download is None:
+                    continue
+                if (content_hash := _hash_download(download)) in seen_hashes:
+                    self.duplicates += 1
+                    continue
+                seen_hashes.add(content_hash)
+                yielded += 1
+                yield download
+            for future in pending:
+                future.cancel()
+
+
+def download_images(
+    url: str,
+    spill_folder: str,
+    limit: int = DEFAULT_DOWNLOAD_LIMIT,
+    workers: int = DEFAULT_DOWNLOAD_WORKERS,
+    per_host_limit: int = DEFAULT_PER_HOST_LIMIT,
+    crawl_depth: int = 0,
+    same_domain: bool = True,
+    max_pages: int = DEFAULT_MAX_PAGES,
+) -> t.Iterator[Download]:
+    session = create_session(workers)
+    if crawl_depth == 0:
+        img_urls: t.Iterable[str] = get_images_from_url(url, session=session)
+        if not img_urls:
+            print_warning_and_exit(f"Can't find suitable images from url {url}")
+    else:
+        crawler = Crawler(session, crawl_depth, same_domain=same_domain, max_pages=max_pages, workers=workers)
+        img_urls = crawler.crawl(url)
+    downloader = Downloader(spill_folder, session=session, workers=workers, per_host_limit=per_host_limit)
+    yield from downloader.fetch_all(img_urls, limit=limit)
@@ -0,0 +1,299 @@
+"""
+Header-only EXIF reader, walks the JPEG APP1 (or PNG eXIf) TIFF structure without decoding any pixel data.
+The XMP packet (JPEG APP1 or PNG iTXt) is only searched for the CreatorTool
+"""
+import contextlib
+import mmap
+import re
+import struct
+import typing as t
+import zlib
+
+from app import profiling
+
+IFD0 = "IFD0"
+EXIF_IFD = "Exif"
+GPS_IFD = "GPS"
+
+EXIF_IFD_POINTER = 0x8769
+GPS_IFD_POINTER = 0x8825
+
+# tag name -> (ifd, tag id)
+EXIF_TAGS = {
+    "ProcessingSoftware": (IFD0, 0x000B),
+    "Software": (IFD0, 0x0131),
+    "DateTime": (IFD0, 0x0132),
+    "HostComputer": (IFD0, 0x013C),
+    "Copyright": (IFD0, 0x8298),
+    "DateTimeOriginal": (EXIF_IFD, 0x9003),
+}
+# GPSLatitudeRef, GPSLatitude, GPSLongitudeRef, GPSLongitude
+GPS_TAG_IDS = (1, 2, 3, 4)
+GPS_INFO = "GPSInfo"
+XMP_CREATOR_TOOL = "CreatorTool"
+
+INSPECTED_TAGS = (
+    "DateTimeOriginal",
+    "DateTime",
+    "ProcessingSoftware",
+    "Software",
+    "HostComputer",
+    "Copyright",
+    GPS_INFO,
+    XMP_CREATOR_TOOL,
+)
+
+JPEG_SOI = b"\xff\xd8"
+JPEG_SOS = 0xDA
+JPEG_EOI = 0xD9
+JPEG_APP1 = 0xE1
+JPEG_STANDALONE_MARKERS = {0x01, *range(0xD0, 0xD8)}
+EXIF_HEADER = b"Exif\x00\x00"
+XMP_HEADER = b"http://ns.adobe.com/xap/1.0/\x00"
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNG_XMP_KEYWORD = b"XML:com.adobe.xmp"
+# both the attribute and the element forms, older Adobe tools write the `xap` prefix
+CREATOR_TOOL_PATTERN = re.compile(rb"(?:xmp|xap):CreatorTool(?:=\"([^\"]*)\"|>([^<]*)<)")
+XML_ENTITIES = {"lt": "<", "gt": ">", "quot": '"', "apos": "'", "amp": "&"}
+XML_ENTITY_PATTERN = re.compile(r"&(lt|gt|quot|apos|amp);")
+
+# TIFF field type -> (struct format, size)
+FIELD_TYPES = {
+    1: ("B", 1),  # BYTE
+    2: ("s", 1),  # ASCII
+    3: ("H", 2),  # SHORT
+    4: ("L", 4),  # LONG
+    5: ("LL", 8),  # RATIONAL
+    7: ("B", 1),  # UNDEFINED
+    9: ("l", 4),  # SLONG
+    10: ("ll", 8),  # SRATIONAL
+    11: ("f", 4),  # FLOAT
+    12: ("d", 8),  # DOUBLE
+}
+
+Buffer = t.Union[bytes, bytearray, mmap.mmap]
+
+
+class ExifError(Exception):
+    pass
+
+
+class _TiffReader:
+    """Reads the TIFF structure located at `data[start:end]`, offsets are relative to `start`"""
+
+    def __init__(self, data: Buffer, start: int, end: int) -> None:
+        self.data = data
+        self.start = start
+        self.size = end - start
+        byte_order = bytes(data[start : start + 2])
+        if byte_order == b"II":
+            self.endian = "<"
+        elif byte_order == b"MM":
+            self.endian = ">"
+        else:
+            raise ExifError("invalid TIFF byte order")
+        if self.unpack("H", 2)[0] != 42:
+            raise ExifError("invalid TIFF magic number")
+
+    def unpack(self, fmt: str, offset: int) -> tuple[t.Any, ...]:
+        fmt = self.endian + fmt
+        if offset < 0 or offset + struct.calcsize(fmt) > self.size:
+            raise ExifError("offset out of the EXIF segment bounds")
+        return struct.unpack_from(fmt, self.data, self.start + offset)
+
+    def first_ifd_offset(self) -> int:
+        offset: int = self.unpack("L", 4)[0]
+        return offset
+
+    def read_ifd(self, offset: int, tag_ids: t.Collection[int]) -> dict[int, t.Any]:
+        """Decodes only the entries of `tag_ids` from the IFD at `offset`, broken entries are skipped"""
+        result = {}
+        (count,) = self.unpack("H", offset)
+        if offset + 2 + count * 12 > self.size:
+            raise ExifError("IFD exceeds the EXIF segment")
+        for i in range(count):
+            entry = offset + 2 + i * 12
+            tag, field_type, value_count = self.unpack("HHL", entry)
+            if tag not in tag_ids or not value_count:
+                continue
+            try:
+                result[tag] = self.read_value(entry + 8, field_type, value_count)
+            except ExifError:
+                continue
+        return result
+
+    def read_value(self, offset: int, field_type: int, count: int) -> t.Any:
+        if field_type not in FIELD_TYPES:
+            raise ExifError(f"unknown field type {field_type}")
+        fmt, size = FIELD_TYPES[field_type]
+        if size * count > 4:
+            offset = self.unpack("L", offset)[0]
+        if offset + size * count > self.size:
+            raise ExifError("value exceeds the EXIF segment")
+
+        if field_type == 2:
+            raw = bytes(self.data[self.start + offset : self.start + offset + count])
+            return raw.split(b"\x00", 1)[0].decode("latin-1", "replace")
+
+        values: list[t.Any] = []
+        for i in range(count):
+            item = self.unpack(fmt, offset + i * size)
+            if field_type in (5, 10):
+                numerator, denominator = item
+                values.append(numerator / denominator if denominator else float("nan"))
+            else:
+                values.append(item[0])
+        return values[0] if count == 1 else tuple(values)
+
+
+def find_tiff_block(data: Buffer) -> t.Optional[tuple[int, int]]:
+    """Returns the (start, end) of the TIFF structure inside a JPEG or PNG file"""
+    if bytes(data[:2]) == JPEG_SOI:
+        return _find_jpeg_tiff_block(data)
+    if bytes(data[:8]) == PNG_SIGNATURE:
+        return _find_png_tiff_block(data)
+    return None
+
+
+def _iter_jpeg_app1(data: Buffer) -> t.Iterator[tuple[int, int]]:
+    """Yields the (start, end) of the APP1 segment payloads preceding the image data"""
+    pos = 2
+    size = len(data)
+    while pos + 4 <= size:
+        if data[pos] != 0xFF:
+            raise ExifError("invalid JPEG marker")
+        marker = data[pos + 1]
+        if marker == 0xFF:  # fill byte
+            pos += 1
+            continue
+        if marker in JPEG_STANDALONE_MARKERS:
+            pos += 2
+            continue
+        if marker in (JPEG_SOS, JPEG_EOI):
+            return
+        (length,) = struct.unpack_from(">H", data, pos + 2)
+        if length < 2:
+            raise ExifError("invalid JPEG segment length")
+        if marker == JPEG_APP1:
+            yield pos + 4, min(pos + 2 + length, size)
+        pos += 2 + length
+
+
+def _iter_png_chunks(data: Buffer) -> t.Iterator[tuple[bytes, int, int]]:
+    """Yields the (type, start, end) of the chunks preceding the image data"""
+    pos = 8
+    size = len(data)
+    while pos + 8 <= size:
+        length, chunk_type = struct.unpack_from(">L4s", data, pos)
+        if chunk_type in (b"IDAT", b"IEND"):
+            return
+        yield chunk_type, pos + 8, min(pos + 8 + length, size)
+        pos += 12 + length
+
+
+def _find_jpeg_tiff_block(data: Buffer) -> t.Optional[tuple[int, int]]:
+    for start, end in _iter_jpeg_app1(data):
+        if bytes(data[start : start + len(EXIF_HEADER)]) == EXIF_HEADER:
+            return start + len(EXIF_HEADER), end
+    return None
+
+
+def _find_png_tiff_block(data: Buffer) -> t.Optional[tuple[int, int]]:
+    for chunk_type, start, end in _iter_png_chunks(data):
+        if chunk_type == b"eXIf":
+            return start, end
+    return None
+
+
+def find_xmp_packet(data: Buffer) -> t.Optional[bytes]:
+    if bytes(data[:2]) == JPEG_SOI:
+        for start, end in _iter_jpeg_app1(data):
+            if bytes(data[start : start + len(XMP_HEADER)]) == XMP_HEADER:
+                return bytes(data[start + len(XMP_HEADER) : end])
+    elif bytes(data[:8]) == PNG_SIGNATURE:
+        for chunk_type, start, end in _iter_png_chunks(data):
+            keyword_end = start + len(PNG_XMP_KEYWORD) + 1
+            if chunk_type == b"iTXt" and bytes(data[start:keyword_end]) == PNG_XMP_KEYWORD + b"\x00":
+                return _read_itxt_text(bytes(data[keyword_end:end]))
+    return None
+
+
+def _read_itxt_text(chunk: bytes) -> bytes:
+    """The iTXt chunk after the keyword: compression flag and method, language tag, translated keyword, text"""
+    compressed = chunk[:1] == b"\x01"
+    _, _, text = chunk[2:].split(b"\x00", 2)
+    if compressed:
+        try:
+            return zlib.decompress(text)
+        except zlib.error as e:
+            raise ExifError("invalid compressed XMP packet") from e
+    return text
+
+
+def parse_xmp_creator_tool(packet: bytes) -> t.Optional[str]:
+    if (match := CREATOR_TOOL_PATTERN.search(packet)) is None:
+        return None
+    value = (match.group(1) if match.group(1) is not None else match.group(2)).decode("utf-8", "replace")
+    return XML_ENTITY_PATTERN.sub(lambda entity: XML_ENTITIES[entity.group(1)], value).strip() or None
+
+
+def parse_exif(data: Buffer, tags: t.Iterable[str] = INSPECTED_TAGS) -> dict[str, t.Any]:
+    """
+    Decodes the requested `tags` (names as in `PIL.ExifTags.TAGS`) from the image file contents,
+    `GPSInfo` is returned as a dict of the latitude/longitude GPS tags keyed by tag id,
+    `CreatorTool` is taken from the XMP packet
+    """
+    tags = set(tags)
+    result: dict[str, t.Any] = {}
+    if (
+        XMP_CREATOR_TOOL in tags
+        and (packet := find_xmp_packet(data)) is not None
+        and (creator_tool := parse_xmp_creator_tool(packet))
+    ):
+        result[XMP_CREATOR_TOOL] = creator_tool
+
+    block = find_tiff_block(data)
+    if block is None:
+        return result
+    reader = _TiffReader(data, *block)
+
+    tag_ids: dict[str, dict[int, str]] = {IFD0: {}, EXIF_IFD: {}}
+    for name in tags & EXIF_TAGS.keys():
+        ifd, tag_id = EXIF_TAGS[name]
+        tag_ids[ifd][tag_id] = name
+    pointers = {EXIF_IFD_POINTER} if tag_ids[EXIF_IFD] else set()
+    if GPS_INFO in tags:
+        pointers.add(GPS_IFD_POINTER)
+
+    ifd0 = reader.read_ifd(reader.first_ifd_offset(), tag_ids[IFD0].keys() | pointers)
+    result.update({tag_ids[IFD0][tag_id]: value for tag_id, value in ifd0.items() if tag_id in tag_ids[IFD0]})
+
+    if isinstance(exif_offset := ifd0.get(EXIF_IFD_POINTER), int):
+        with contextlib.suppress(ExifError):
+            exif_ifd = reader.read_ifd(exif_offset, tag_ids[EXIF_IFD].keys())
+            result.update({tag_ids[EXIF_IFD][tag_id]: value for tag_id, value in exif_ifd.items()})
+
+    if isinstance(gps_offset := ifd0.get(GPS_IFD_POINTER), int):
+        with contextlib.suppress(ExifError):
+            gps = reader.read_ifd(gps_offset, GPS_TAG_IDS)
+            if gps:
+                result[GPS_INFO] = dict(sorted(gps.items()))
+
+    return result
+
+
+def read_exif(path: str, tags: t.Iterable[str] = INSPECTED_TAGS) -> dict[str, t.Any]:
+    """
+    Memory-maps the file and decodes the requested EXIF tags, only the pages holding the headers are read.
+    Malformed or truncated metadata results in an empty dict
+    """
+    with profiling.stage("open"), open(path, "rb") as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # empty file
+            return {}
+    with data, profiling.stage("exif"):
+        try:
+            return parse_exif(data, tags)
+        except (ExifError, struct.error, IndexError):
+            return {}
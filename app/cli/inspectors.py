@@ -1,14 +1,18 @@
 import datetime
+import math
 import platform
 import typing as t
 from pathlib import Path
 
 import typer
 
-EDITING_SOFTWARE_TAG_PARTS = [
-    "GIMP",
-    "Photoshop",
-]
+from app.cli.exif import XMP_CREATOR_TOOL
+from app.cli.signatures import EDITED_CONFIDENCE, load_matcher
+
+# bump when the output of any inspector changes, invalidates the cached scan results
+INSPECTORS_VERSION = "4"
+
+SOFTWARE_TAGS = ("Software", "ProcessingSoftware", "HostComputer", XMP_CREATOR_TOOL)
 
 PathAnnotation = t.Annotated[
     Path,
@@ -66,14 +70,20 @@ def inspect_datetime_fields(exif: dict[str, t.Any]) -> list[datetime.datetime]:
 
 
 @inspector_wrapper
-def inspect_editing_software(exif: dict[str, t.Any]) -> list[str]:
-    result = []
-    for part in EDITING_SOFTWARE_TAG_PARTS:
-        if part.lower() in exif["Software"].lower():
-            result.append(exif["Software"])
-            result.append(1)
-            return result
-    return []
+def inspect_editing_software(exif: dict[str, t.Any]) -> list[t.Any]:
+    """[tag value, is edited, category, confidence] of the most confident signature found in the software tags"""
+    matcher = load_matcher()
+    best = None
+    for tag in SOFTWARE_TAGS:
+        value = exif.get(tag)
+        if not isinstance(value, str) or (signature := matcher.match(value)) is None:
+            continue
+        if best is None or signature.confidence > best[1].confidence:
+            best = (value.strip(), signature)
+    if best is None:
+        return []
+    value, signature = best
+    return [value, int(signature.confidence >= EDITED_CONFIDENCE), signature.category, signature.confidence]
 
 
 @inspector_wrapper
@@ -91,12 +101,24 @@ def _format_coord(parts: tuple[t.Any]) -> str:
     return f"{casted_parts[0]:.2f}°{casted_parts[1]:.2f}'{casted_parts[2]:.2f}\""
 
 
+def _to_degrees(parts: tuple[t.Any], ref: t.Any) -> t.Optional[float]:
+    degrees, minutes, seconds = (float(i) for i in parts)
+    value = degrees + minutes / 60 + seconds / 3600
+    if not math.isfinite(value):
+        return None
+    return -value if str(ref).strip().upper() in ("S", "W") else value
+
+
 @inspector_wrapper
-def inspect_gps(exif: dict[str, t.Any]) -> list[str]:
-    result = []
+def inspect_gps(exif: dict[str, t.Any]) -> list[t.Any]:
+    """[formatted coordinates, latitude, longitude], the signed decimal degrees are None when not representable"""
+    result: list[t.Any] = []
     if gps := exif.get("GPSInfo"):
         gps_parts = [v for _, v in gps.items()][:4]
         result.append(f"{gps_parts[0]}: {_format_coord(gps_parts[1])}\n {gps_parts[2]}: {_format_coord(gps_parts[3])} ")
+        # GPSLatitudeRef, GPSLatitude, GPSLongitudeRef, GPSLongitude
+        result.append(_to_degrees(gps[2], gps.get(1)) if 2 in gps else None)
+        result.append(_to_degrees(gps[4], gps.get(3)) if 4 in gps else None)
         return result
     else:
         return result
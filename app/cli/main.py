@@ -1,44 +1,56 @@
+import contextlib
+import itertools
 import os
-import typing
 import typing as t
 import warnings
 from pathlib import Path
 
 import typer
-from PIL import ExifTags, Image
-
-from app.cli.inspectors import (
-    inspect_copyright,
-    inspect_datetime_fields,
-    inspect_editing_software,
-    inspect_gps,
-    inspect_osx_metadata,
+from rich.progress import track
+
+from app import profiling
+from app.cli.cache import DEFAULT_MAX_ENTRIES, open_cache
+from app.cli.outputs import MultiWriter, OutputFormat, open_writers
+from app.cli.phash import DEFAULT_CLUSTER_DISTANCE, DEFAULT_REUSE_DISTANCE, open_perceptual_index
+from app.cli.records import (
+    DEDUP_COLUMNS,
+    ELA_COLUMNS,
+    SCAN_COLUMNS,
+    SCAN_ELA_COLUMNS,
+    TILED_ELA_COLUMNS,
+    ElaRecord,
+    ScanRecord,
 )
-from app.cli.report import generate_report
+from app.cli.scanner import scan_downloads, scan_paths
+from app.cli.watcher import DEFAULT_DEBOUNCE, DEFAULT_POLL_INTERVAL, create_watcher, iter_settled
 from app.utils import (
-    DOWNLOAD_TMP_FOLDER,
+    DEFAULT_BATCH_SIZE,
+    DEFAULT_DOWNLOAD_LIMIT,
+    DEFAULT_DOWNLOAD_WORKERS,
+    DEFAULT_SERVER_PORT,
+    DEFAULT_TILE_FRACTION,
+    DEFAULT_TILE_SIZE,
+    DEFAULT_TILE_THRESHOLD,
+    InferenceBackend,
     clean_temp_folders_and_files,
-    download_images,
-    filter_images_or_directories_from_paths,
+    collect_image_paths,
     is_osxmetadata_package_present,
+    iter_image_paths,
     print_error_and_exit,
     print_header,
     print_list_item,
+    print_prediction,
     print_sub_header,
-    create_temp_folders,
+    workspace,
 )
-from app.ela_nn.ela import check_ela
-from app.ela_nn.model import IMDModel
+
+if t.TYPE_CHECKING:
+    from app.ela_nn.ela import ElaScorer
 
 warnings.filterwarnings("ignore")
 
 app = typer.Typer()
 
-EDITING_SOFTWARE_TAG_PARTS = [
-    "GIMP",
-    "Photoshop",
-]
-
 PathAnnotation = t.Annotated[
     Path,
     typer.Option(
@@ -51,62 +63,404 @@ PathAnnotation = t.Annotated[
     ),
 ]
 
+FileOrDirPathAnnotation = t.Annotated[
+    Path,
+    typer.Option(
+        exists=True,
+        file_okay=True,
+        dir_okay=True,
+        writable=False,
+        readable=True,
+        resolve_path=True,
+    ),
+]
+
+PathsAnnotation = t.Annotated[
+    list[Path],
+    typer.Option(
+        exists=True,
+        file_okay=True,
+        dir_okay=True,
+        writable=False,
+        readable=True,
+        resolve_path=True,
+    ),
+]
+
+CacheAnnotation = t.Annotated[
+    t.Optional[Path],
+    typer.Option(
+        dir_okay=False,
+        resolve_path=True,
+        help="SQLite file caching the results, unchanged files are not analysed again",
+    ),
+]
+CacheMaxEntriesAnnotation = t.Annotated[
+    int,
+    typer.Option(min=1, help="Least recently used cache entries are evicted above this limit"),
+]
+CacheHashAnnotation = t.Annotated[
+    bool,
+    typer.Option(help="Also match the cache entries by the content hash, e.g. for the copied files"),
+]
+ProfileAnnotation = t.Annotated[
+    bool,
+    typer.Option(help="Print the per-stage timings (count, p50/p95/max latency, bytes) at the end"),
+]
+ProfileJsonAnnotation = t.Annotated[
+    t.Optional[Path],
+    typer.Option(dir_okay=False, help="Write the per-stage timings to this JSON file instead of printing them"),
+]
+ProfileStageAnnotation = t.Annotated[
+    t.Optional[str],
+    typer.Option(help="Run cProfile within this stage only, e.g. exif, inspectors, ela.recompress, inference"),
+]
+OutputAnnotation = t.Annotated[
+    t.Optional[Path],
+    typer.Option(
+        dir_okay=False,
+        resolve_path=True,
+        help="Path of the written results without the extension, the format is appended, e.g. results/run1",
+    ),
+]
+FeaturesAnnotation = t.Annotated[
+    t.Optional[Path],
+    typer.Option(
+        file_okay=False,
+        resolve_path=True,
+        help="Folder of the memory-mapped ELA model inputs, reused for the unchanged images and by the rescore command",
+    ),
+]
+BackendAnnotation = t.Annotated[
+    InferenceBackend,
+    typer.Option(
+        case_sensitive=False,
+        help="ELA model inference mode: fp32 (as trained), fused (BatchNorm folded, channels-last), "
+        "int8 (fused, dynamically quantized linear layers, CPU only) or bf16 (fused, bfloat16)",
+    ),
+]
+ThreadsAnnotation = t.Annotated[
+    t.Optional[int],
+    typer.Option(min=1, help="Number of threads of the ELA model inference, defaults to the number of cores"),
+]
+OutputFormatAnnotation = t.Annotated[
+    list[OutputFormat],
+    typer.Option(
+        case_sensitive=False,
+        help=(
+            "Format of the written results, can be repeated. jsonl/csv/parquet hold the full untruncated values "
+            "and are written while scanning, the pdf report is held in memory (~0.5 KB per image) until the end"
+        ),
+    ),
+]
+
 
 @app.command(
-    help="Cleans all the files that were added during the scanning, e.g. downloaded images from the URL",
+    help="Cleans the temporary files left behind by the interrupted scans, e.g. downloaded images from the URL",
 )
 def clean() -> None:
     clean_temp_folders_and_files()
 
 
-def scan_image(path: typing.Union[PathAnnotation, str]) -> list[str]:
-    result = []
-    result.append(path)
-    img = Image.open(path)
-    if raw_exif := img._getexif():
-        exif = {ExifTags.TAGS[k]: v for k, v in raw_exif.items() if k in ExifTags.TAGS}
-        result.append(inspect_datetime_fields(exif))
-        result.append(inspect_editing_software(exif))
-        result.append(inspect_copyright(exif))
-        result.append(inspect_gps(exif))
+def _setup_backend(backend: InferenceBackend, threads: t.Optional[int]) -> None:
+    from app.ela_nn.backends import BackendError, check_backend, select_device, set_threads
+
+    try:
+        check_backend(select_device(backend), backend)
+    except BackendError as e:
+        print_error_and_exit(f"{e}!")
+    set_threads(threads)
+
+
+@app.command(
+    help="Run the ELA (Error Level Analysis) scan",
+)
+def ela(
+    path: PathsAnnotation,
+    reference: bool = typer.Option(False, help="Use the original on-disk per-pixel ELA implementation"),
+    batch_size: int = typer.Option(DEFAULT_BATCH_SIZE, min=1, help="Number of images fed to the model at once"),
+    workers: int = typer.Option(os.cpu_count() or 1, min=0, help="Number of processes preparing the ELA images"),
+    backend: BackendAnnotation = InferenceBackend.FP32,
+    threads: ThreadsAnnotation = None,
+    cache: CacheAnnotation = None,
+    cache_max_entries: CacheMaxEntriesAnnotation = DEFAULT_MAX_ENTRIES,
+    cache_hash: CacheHashAnnotation = False,
+    features: FeaturesAnnotation = None,
+    output: OutputAnnotation = None,
+    output_format: OutputFormatAnnotation = [],  # noqa: B006
+    profile: ProfileAnnotation = False,
+    profile_json: ProfileJsonAnnotation = None,
+    profile_stage: ProfileStageAnnotation = None,
+    server: t.Optional[str] = typer.Option(
+        None,
+        help="Send the images to the `serve` daemon instead, e.g. unix:/tmp/image_scan.sock or 127.0.0.1:8765",
+    ),
+    tiled: bool = typer.Option(
+        False,
+        help="Score every tile of the image on its own, for the large images. --workers threads prepare the tiles",
+    ),
+    tile_size: int = typer.Option(DEFAULT_TILE_SIZE, min=16, help="Tile side in pixels, a multiple of 16"),
+    tile_threshold: float = typer.Option(
+        DEFAULT_TILE_THRESHOLD,
+        min=0,
+        max=1,
+        help="Tamper probability of a tampered tile",
+    ),
+    tile_fraction: float = typer.Option(
+        DEFAULT_TILE_FRACTION,
+        min=0,
+        max=1,
+        help="The image is tampered when at least this fraction of its tiles (and at least one) is tampered",
+    ),
+    heatmaps: t.Optional[Path] = typer.Option(
+        None,
+        file_okay=False,
+        resolve_path=True,
+        help="Folder to save the per-tile tamper probability heatmaps of --tiled to",
+    ),
+) -> None:
+    if OutputFormat.PDF in output_format:
+        print_error_and_exit("the pdf report is only available for the scan command!")
+
+    paths = collect_image_paths([str(p) for p in path])
+    if not paths:
+        print_error_and_exit("no images found under the specified paths!")
+
+    if server:
+        if reference or features or cache:
+            print_error_and_exit("--reference, --features and --cache are not available with --server!")
+        with open_writers(output_format, str(output or "ela_report"), ELA_COLUMNS) as writer:
+            _analyze_on_server(server, paths, writer)
+        return
 
-    result.append(inspect_osx_metadata(path))
-    return result
+    if tiled:
+        if reference or features or cache:
+            print_error_and_exit("--reference, --features and --cache are not available with --tiled!")
+        _setup_backend(backend, threads)
+        with profiling.profile_session(
+            profile,
+            str(profile_json) if profile_json is not None else None,
+            profile_stage,
+        ):
+            _check_ela_tiled(
+                paths,
+                tile_size,
+                tile_threshold,
+                tile_fraction,
+                heatmaps,
+                batch_size,
+                workers,
+                backend,
+                output,
+                output_format,
+            )
+        return
 
+    from app.ela_nn.ela import check_ela, open_feature_store
 
-def scan_path(path: t.Union[PathAnnotation, str]) -> list[list[str]]:
-    result = []
-    if os.path.isdir(path):
-        paths = os.listdir(path)
-        child_paths = filter_images_or_directories_from_paths(path, paths)
-        for child_path in child_paths:
-            result.append(scan_path(f"{path}/{child_path}"))
-        return result
-    else:
-        result.append(scan_image(path))
-        return result
+    _setup_backend(backend, threads)
+    with (
+        profiling.profile_session(profile, str(profile_json) if profile_json is not None else None, profile_stage),
+        open_cache(str(cache) if cache is not None else None, cache_max_entries, cache_hash) as scan_cache,
+        open_writers(output_format, str(output or "ela_report"), ELA_COLUMNS) as writer,
+        open_feature_store(str(features), reference) if features else contextlib.nullcontext() as feature_store,
+    ):
+        check_ela(
+            paths,
+            batch_size=batch_size,
+            workers=workers,
+            reference=reference,
+            cache=scan_cache,
+            output=writer,
+            features=feature_store,
+            backend=backend,
+        )
+
+
+def _check_ela_tiled(
+    paths: list[str],
+    tile_size: int,
+    tile_threshold: float,
+    tile_fraction: float,
+    heatmaps: t.Optional[Path],
+    batch_size: int,
+    workers: int,
+    backend: InferenceBackend,
+    output: t.Optional[Path],
+    output_format: list[OutputFormat],
+) -> None:
+    from app.ela_nn.ela import ElaScorer
+    from app.ela_nn.tiles import TILE_ALIGNMENT, check_ela_tiled
+
+    if tile_size % TILE_ALIGNMENT:
+        print_error_and_exit(f"--tile-size has to be a multiple of {TILE_ALIGNMENT}!")
+    with open_writers(output_format, str(output or "ela_report"), TILED_ELA_COLUMNS) as writer:
+        check_ela_tiled(
+            paths,
+            ElaScorer(batch_size, backend),
+            tile_size=tile_size,
+            threshold=tile_threshold,
+            fraction=tile_fraction,
+            workers=workers,
+            heatmap_folder=str(heatmaps) if heatmaps is not None else None,
+            output=writer,
+        )
+
+
+def _analyze_on_server(server: str, paths: list[str], writer: MultiWriter) -> None:
+    from app.cli.client import ServerError, analyze
+
+    try:
+        for image_path, is_authentic in analyze(server, paths):
+            print_prediction(image_path, is_authentic)
+            writer.add(ElaRecord(image_path, is_authentic))
+    except ServerError as e:
+        print_error_and_exit(f"{e}!")
 
 
 @app.command(
-    help="Run the ELA (Error Level Analysis) scan",
+    help="Keep the ELA model loaded and analyse the images sent by `ela --server`, "
+    "the concurrent requests are batched together",
 )
-def ela(path: PathAnnotation) -> None:
-    create_temp_folders()
+def serve(
+    socket_path: t.Optional[Path] = typer.Option(
+        None,
+        "--socket",
+        dir_okay=False,
+        resolve_path=True,
+        help="Listen on this Unix socket instead of the TCP port",
+    ),
+    host: str = typer.Option("127.0.0.1", help="Address of the TCP listener, keep it local, there is no auth"),
+    port: int = typer.Option(DEFAULT_SERVER_PORT, min=0, max=65535),
+    batch_size: int = typer.Option(DEFAULT_BATCH_SIZE, min=1, help="Maximum number of images fed to the model at once"),
+    max_delay_ms: float = typer.Option(
+        10.0,
+        min=0,
+        help="How long a request waits for the others to fill up the batch",
+    ),
+    backend: BackendAnnotation = InferenceBackend.FP32,
+    threads: ThreadsAnnotation = None,
+) -> None:
+    from app.ela_nn.ela import ElaScorer
+    from app.ela_nn.server import SocketInUseError, create_server, serve_forever
 
-    if not os.path.exists(path):
-        print_error_and_exit("file does not exist under the specified path!")
+    _setup_backend(backend, threads)
+    try:
+        server = create_server(
+            ElaScorer(batch_size, backend),
+            socket_path=str(socket_path) if socket_path is not None else None,
+            host=host,
+            port=port,
+            max_delay=max_delay_ms / 1000,
+        )
+    except SocketInUseError as e:
+        print_error_and_exit(f"{e}!")
+    address = f"unix:{socket_path}" if socket_path else "{}:{}".format(*server.socket.getsockname())
+    print_header(f"Serving the ELA model on {address}, stop with Ctrl+C")
+    serve_forever(server)
 
-    check_ela(str(path))
 
-    clean_temp_folders_and_files()
+@app.command(
+    help="Run the ELA model on the inputs stored by `ela --features`, e.g. after the model update",
+)
+def rescore(
+    features: t.Annotated[
+        Path,
+        typer.Option(exists=True, file_okay=False, resolve_path=True, help="Folder written by `ela --features`"),
+    ],
+    reference: bool = typer.Option(False, help="Score the inputs stored by `ela --reference --features`"),
+    batch_size: int = typer.Option(DEFAULT_BATCH_SIZE, min=1, help="Number of images fed to the model at once"),
+    backend: BackendAnnotation = InferenceBackend.FP32,
+    threads: ThreadsAnnotation = None,
+    output: OutputAnnotation = None,
+    output_format: OutputFormatAnnotation = [],  # noqa: B006
+    profile: ProfileAnnotation = False,
+    profile_json: ProfileJsonAnnotation = None,
+    profile_stage: ProfileStageAnnotation = None,
+) -> None:
+    from app.ela_nn.ela import open_feature_store, rescore_features
+
+    if OutputFormat.PDF in output_format:
+        print_error_and_exit("the pdf report is only available for the scan command!")
+    _setup_backend(backend, threads)
+
+    with (
+        profiling.profile_session(profile, str(profile_json) if profile_json is not None else None, profile_stage),
+        open_writers(output_format, str(output or "ela_report"), ELA_COLUMNS) as writer,
+        open_feature_store(str(features), reference) as feature_store,
+    ):
+        rescore_features(feature_store, batch_size=batch_size, output=writer, backend=backend)
+
+
+def _setup_scan(
+    with_ela: bool,
+    dedup: bool,
+    backend: InferenceBackend,
+    threads: t.Optional[int],
+) -> tuple[t.Optional["ElaScorer"], dict[str, type]]:
+    """Lists the analysed features, returns the ELA scorer if asked for and the output columns"""
+    print_sub_header("The following features will be analysed:")
+    print_list_item("exif datetime fields")
+    print_list_item("exif editing software fields")
+    print_list_item("exif copyright field")
+    print_list_item("GPS fields\n")
+
+    if is_osxmetadata_package_present():
+        print_list_item("osxmetadata fields")
+
+    scorer = None
+    columns = SCAN_ELA_COLUMNS if with_ela else SCAN_COLUMNS
+    if with_ela:
+        from app.ela_nn.ela import ElaScorer
+
+        print_list_item("ELA model verdict")
+        _setup_backend(backend, threads)
+        scorer = ElaScorer(backend=backend)
+    if dedup:
+        print_list_item("near-duplicate images")
+        columns = {**columns, **DEDUP_COLUMNS}
+    return scorer, columns
 
 
 @app.command(
     help="Run the metadata fields analysis scan",
 )
 def scan(
-    path: t.Optional[PathAnnotation] = None,
+    path: t.Optional[FileOrDirPathAnnotation] = None,
     url: t.Optional[str] = None,
+    limit: int = typer.Option(DEFAULT_DOWNLOAD_LIMIT, min=1, help="Maximum number of images downloaded from the --url"),
+    download_workers: int = typer.Option(DEFAULT_DOWNLOAD_WORKERS, min=1, help="Number of concurrent image downloads"),
+    crawl_depth: int = typer.Option(0, min=0, help="Follow the links of the --url page up to this depth"),
+    same_domain: bool = typer.Option(True, help="Only crawl the pages of the --url domain"),
+    max_pages: int = typer.Option(1000, min=1, help="Maximum number of crawled pages"),
+    jobs: int = typer.Option(os.cpu_count() or 1, min=1, help="Number of processes scanning the images"),
+    with_ela: bool = typer.Option(False, help="Also run the ELA model on every image, its verdict counts as an edit"),
+    backend: BackendAnnotation = InferenceBackend.FP32,
+    threads: ThreadsAnnotation = None,
+    dedup: bool = typer.Option(
+        False,
+        help="Cluster the near-duplicate images by their perceptual hash, kept in the --cache file if given",
+    ),
+    dedup_distance: int = typer.Option(
+        DEFAULT_CLUSTER_DISTANCE,
+        min=0,
+        max=64,
+        help="Maximum Hamming distance of the 64-bit hashes of the images listed in one cluster",
+    ),
+    reuse_distance: int = typer.Option(
+        DEFAULT_REUSE_DISTANCE,
+        min=0,
+        max=64,
+        help="Maximum Hamming distance of the copies reusing the ELA verdict instead of being analysed",
+    ),
+    cache: CacheAnnotation = None,
+    cache_max_entries: CacheMaxEntriesAnnotation = DEFAULT_MAX_ENTRIES,
+    cache_hash: CacheHashAnnotation = False,
+    output: OutputAnnotation = None,
+    output_format: OutputFormatAnnotation = [OutputFormat.PDF],  # noqa: B006
+    profile: ProfileAnnotation = False,
+    profile_json: ProfileJsonAnnotation = None,
+    profile_stage: ProfileStageAnnotation = None,
 ) -> None:
     if not path and not url:
         print_error_and_exit("--path or --url param is required!")
@@ -115,30 +469,107 @@ def scan(
         print_error_and_exit("only one of the --path or --url params should be specified!")
 
     print_header("Started image scanner")
-    print_sub_header("The following features will be analysed:")
-    print_list_item("exif datetime fields")
-    print_list_item("exif editing software fields")
-    print_list_item("exif copyright field")
-    print_list_item("GPS fields\n")
+    scorer, columns = _setup_scan(with_ela, dedup, backend, threads)
 
-    if is_osxmetadata_package_present():
-        print_list_item("osxmetadata fields")
+    with (
+        profiling.profile_session(profile, str(profile_json) if profile_json is not None else None, profile_stage),
+        open_cache(str(cache) if cache is not None else None, cache_max_entries, cache_hash) as scan_cache,
+        open_perceptual_index(
+            dedup,
+            scan_cache,
+            scorer.version if scorer is not None else "",
+            dedup_distance,
+            reuse_distance,
+        ) as index,
+        open_writers(output_format, str(output or "report"), columns) as writer,
+        workspace() as workspace_path,
+    ):
+        if path:
+            if not os.path.exists(path):
+                print_error_and_exit("file or directory does not exist under the specified path!")
+            records: t.Iterable[ScanRecord] = scan_paths(
+                iter_image_paths(str(path)),
+                jobs=jobs,
+                cache=scan_cache,
+                scorer=scorer,
+                index=index,
+            )
+        else:
+            from app.cli.downloader import download_images
 
-    create_temp_folders()
+            downloads = download_images(
+                str(url),
+                spill_folder=workspace_path,
+                limit=limit,
+                workers=download_workers,
+                crawl_depth=crawl_depth,
+                same_domain=same_domain,
+                max_pages=max_pages,
+            )
+            records = scan_downloads(downloads, scorer=scorer, index=index)
+        for record in track(records, description="Scanning images ..."):
+            writer.add(record)
 
-    if path:
-        if not os.path.exists(path):
-            print_error_and_exit("file or directory does not exist under the specified path!")
-        result = scan_path(path)
-        generate_report(result)
-    if url:
-        download_images(url)
-        result = scan_path(DOWNLOAD_TMP_FOLDER)
-        generate_report(result)
+    print_header("Finished image scanner")
 
-    clean_temp_folders_and_files()
 
-    print_header("Finished image scanner")
+@app.command(
+    help="Watch the directory tree and scan the images as they arrive, the results are appended to the output",
+)
+def watch(
+    path: t.Annotated[
+        Path,
+        typer.Option(exists=True, file_okay=False, resolve_path=True, help="Directory tree to watch"),
+    ],
+    with_ela: bool = typer.Option(False, help="Also run the ELA model on every image, its verdict counts as an edit"),
+    backend: BackendAnnotation = InferenceBackend.FP32,
+    threads: ThreadsAnnotation = None,
+    jobs: int = typer.Option(1, min=1, help="Number of processes scanning every batch of the arrived images"),
+    debounce: float = typer.Option(
+        DEFAULT_DEBOUNCE,
+        min=0,
+        help="Seconds without further writes after which an image is scanned",
+    ),
+    polling: bool = typer.Option(False, help="Poll the tree instead of using inotify, e.g. on the network shares"),
+    poll_interval: float = typer.Option(DEFAULT_POLL_INTERVAL, min=0.1, help="Seconds between the polls"),
+    initial_scan: bool = typer.Option(False, help="Also scan the images already in the tree at the start"),
+    cache: CacheAnnotation = None,
+    cache_max_entries: CacheMaxEntriesAnnotation = DEFAULT_MAX_ENTRIES,
+    cache_hash: CacheHashAnnotation = False,
+    output: OutputAnnotation = None,
+    output_format: OutputFormatAnnotation = [OutputFormat.JSONL],  # noqa: B006
+) -> None:
+    if set(output_format) - {OutputFormat.JSONL, OutputFormat.CSV}:
+        print_error_and_exit("only the jsonl and csv results can be appended to!")
+
+    scorer = None
+    columns = SCAN_ELA_COLUMNS if with_ela else SCAN_COLUMNS
+    if with_ela:
+        from app.ela_nn.ela import ElaScorer
+
+        _setup_backend(backend, threads)
+        scorer = ElaScorer(backend=backend)
+
+    with (
+        open_cache(str(cache) if cache is not None else None, cache_max_entries, cache_hash) as scan_cache,
+        open_writers(output_format, str(output or "watch"), columns, append=True) as writer,
+    ):
+        # the watcher is started first, so the images arriving during the initial scan are not missed
+        watcher = create_watcher(str(path), polling=polling, interval=poll_interval)
+        batches = iter_settled(watcher, debounce)
+        if initial_scan:
+            batches = itertools.chain([list(iter_image_paths(str(path)))], batches)
+        print_header(f"Watching {path} with {type(watcher).__name__}, stop with Ctrl+C")
+        try:
+            for batch in batches:
+                for record in scan_paths(batch, jobs=jobs, cache=scan_cache, scorer=scorer):
+                    writer.add(record)
+                    print_list_item(f"{record.path}: {'[red]edited[/red]' if record.is_edited else 'original'}")
+                writer.flush()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,179 @@
+"""
+Result writers, the records are written one by one while the scan is running.
+Every writer exposes `add(record)`, `flush()` and `close()`
+"""
+import contextlib
+import csv
+import datetime
+import enum
+import json
+import os
+import typing as t
+
+from app.utils import print_error_and_exit
+
+PARQUET_ROW_GROUP_SIZE = 4096
+
+
+class OutputFormat(str, enum.Enum):
+    PDF = "pdf"
+    JSONL = "jsonl"
+    CSV = "csv"
+    PARQUET = "parquet"
+
+
+class Record(t.Protocol):
+    def as_output(self) -> dict[str, t.Any]:
+        ...
+
+
+class RecordWriter(t.Protocol):
+    def add(self, record: t.Any) -> None:
+        ...
+
+    def flush(self) -> None:
+        ...
+
+    def close(self) -> None:
+        ...
+
+
+def _encode(value: t.Any) -> t.Any:
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    raise TypeError(f"can't serialize {type(value).__name__}")
+
+
+def _project(record: Record, columns: dict[str, type]) -> dict[str, t.Any]:
+    output = record.as_output()
+    return {name: output[name] for name in columns}
+
+
+class JsonlWriter:
+    def __init__(self, path: str, columns: dict[str, type], append: bool = False) -> None:
+        self.columns = columns
+        self.file = open(path, "a" if append else "w", encoding="utf-8")  # noqa: SIM115
+
+    def add(self, record: Record) -> None:
+        self.file.write(json.dumps(_project(record, self.columns), default=_encode, ensure_ascii=False) + "\n")
+
+    def flush(self) -> None:
+        self.file.flush()
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class CsvWriter:
+    def __init__(self, path: str, columns: dict[str, type], append: bool = False) -> None:
+        self.columns = columns
+        self.file = open(path, "a" if append else "w", newline="", encoding="utf-8")  # noqa: SIM115
+        self.writer = csv.DictWriter(self.file, fieldnames=list(columns))
+        if self.file.tell() == 0:
+            self.writer.writeheader()
+
+    def add(self, record: Record) -> None:
+        row = _project(record, self.columns)
+        self.writer.writerow(
+            {key: value.isoformat() if isinstance(value, datetime.datetime) else value for key, value in row.items()},
+        )
+
+    def flush(self) -> None:
+        self.file.flush()
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class ParquetWriter:
+    """Buffers up to `row_group_size` records and writes them as one row group of the typed `columns` schema"""
+
+    def __init__(self, path: str, columns: dict[str, type], row_group_size: int = PARQUET_ROW_GROUP_SIZE) -> None:
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            print_error_and_exit(
+                "the parquet output requires the pyarrow package, install it with: pip install pyarrow",
+            )
+
+        types = {
+            str: pa.string(),
+            bool: pa.bool_(),
+            int: pa.int64(),
+            float: pa.float64(),
+            datetime.datetime: pa.timestamp("us", tz="UTC"),
+        }
+        self.pa = pa
+        self.columns = columns
+        self.schema = pa.schema([(name, types[type_]) for name, type_ in columns.items()])
+        self.writer = pq.ParquetWriter(path, self.schema)
+        self.row_group_size = row_group_size
+        self.rows: list[dict[str, t.Any]] = []
+
+    def add(self, record: Record) -> None:
+        self.rows.append(_project(record, self.columns))
+        if len(self.rows) >= self.row_group_size:
+            self.flush()
+
+    def flush(self) -> None:
+        if self.rows:
+            self.writer.write_table(self.pa.Table.from_pylist(self.rows, schema=self.schema))
+            self.rows = []
+
+    def close(self) -> None:
+        self.flush()
+        self.writer.close()
+
+
+class MultiWriter:
+    def __init__(self, writers: list[RecordWriter]) -> None:
+        self.writers = writers
+
+    def __enter__(self) -> "MultiWriter":
+        return self
+
+    def __exit__(self, *args: t.Any) -> None:
+        self.close()
+
+    def add(self, record: t.Any) -> None:
+        for writer in self.writers:
+            writer.add(record)
+
+    def flush(self) -> None:
+        for writer in self.writers:
+            writer.flush()
+
+    def close(self) -> None:
+        with contextlib.ExitStack() as stack:
+            for writer in self.writers:
+                stack.callback(writer.close)
+
+
+def open_writers(
+    formats: t.Iterable[OutputFormat],
+    stem: str,
+    columns: dict[str, type],
+    append: bool = False,
+) -> MultiWriter:
+    """
+    Creates a writer of every format, the results are written to `{stem}.{format}`.
+    With `append` the jsonl and csv results are appended to the existing files
+    """
+    writers: list[RecordWriter] = []
+    if directory := os.path.dirname(stem):
+        os.makedirs(directory, exist_ok=True)
+    for output_format in dict.fromkeys(formats):
+        path = f"{stem}.{output_format.value}"
+        if output_format == OutputFormat.PDF:
+            # reportlab and matplotlib are only imported when the PDF report is requested
+            from app.cli.report import ReportWriter
+
+            writers.append(ReportWriter(path, columns))
+        elif output_format == OutputFormat.JSONL:
+            writers.append(JsonlWriter(path, columns, append))
+        elif output_format == OutputFormat.CSV:
+            writers.append(CsvWriter(path, columns, append))
+        elif output_format == OutputFormat.PARQUET:
+            writers.append(ParquetWriter(path, columns))
+    return MultiWriter(writers)
@@ -0,0 +1,305 @@
+"""
+Perceptual hash index linking the copies of the same picture, e.g. resized or recompressed ones.
+
+Every image gets a 64-bit difference hash (dHash) computed from a small decode. The analysed images are kept
+in a BK-tree (a metric tree over the Hamming distance) persisted in SQLite, so the near-duplicates of the images
+of the previous runs are found as well. A perceptual hash can't tell a local edit from the original, e.g.
+samples/books.jpg is 9 bits away from samples/books-orig.jpg, so the verdicts are only reused for the nearly
+identical hashes, the more distant near-duplicates are analysed and just listed in the same cluster
+"""
+import contextlib
+import dataclasses
+import os
+import sqlite3
+import typing as t
+
+from PIL import Image
+
+from app.cli.cache import DEFAULT_MAX_ENTRIES, ScanCache
+
+HASH_SIZE = 8
+# copies within this distance are listed in one cluster, e.g. samples/queen.png and samples/queen2.jpg are 7 apart
+DEFAULT_CLUSTER_DISTANCE = 8
+# copies within this distance reuse the verdict instead of being analysed, e.g. resized or recompressed ones
+DEFAULT_REUSE_DISTANCE = 2
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS phash_nodes (
+    id INTEGER PRIMARY KEY,
+    hash INTEGER NOT NULL,
+    parent INTEGER,
+    distance INTEGER,
+    path TEXT NOT NULL,
+    cluster TEXT NOT NULL,
+    is_authentic INTEGER,
+    version TEXT NOT NULL,
+    inode INTEGER,
+    size INTEGER,
+    mtime_ns INTEGER,
+    retired INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+# the hashes are kept in the scan cache entries of this version
+DHASH_VERSION = "1"
+# inode, size and mtime of the hashed file, as in the scan cache entries
+Fingerprint = tuple[int, int, int]
+
+
+def dhash(source: t.Union[str, t.BinaryIO]) -> int:
+    """Compares the brightness of the horizontally adjacent pixels of the 9x8 grayscale thumbnail"""
+    with Image.open(source) as image:
+        # JPEGs are decoded right at a fraction of their size
+        image.draft("L", ((HASH_SIZE + 1) * 4, HASH_SIZE * 4))
+        pixels = image.convert("L").resize((HASH_SIZE + 1, HASH_SIZE), Image.Resampling.BILINEAR).tobytes()
+    value = 0
+    for row in range(HASH_SIZE):
+        for column in range(HASH_SIZE):
+            offset = row * (HASH_SIZE + 1) + column
+            value = value << 1 | (pixels[offset] > pixels[offset + 1])
+    return value
+
+
+def fingerprint(path: str) -> t.Optional[Fingerprint]:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+def hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+def _to_signed(value: int) -> int:
+    # SQLite integers are signed 64-bit
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+@dataclasses.dataclass(slots=True)
+class Node:
+    node_id: int
+    value: int
+    path: str
+    cluster: str
+    is_authentic: t.Optional[bool] = None
+    # `None` for the images without a file, e.g. the downloads held in memory
+    fingerprint: t.Optional[Fingerprint] = None
+    # the file changed since, the node only routes the searches to its children
+    retired: bool = False
+    children: dict[int, int] = dataclasses.field(default_factory=dict)
+
+
+@dataclasses.dataclass(slots=True)
+class Match:
+    """The analysed image the new one was matched to"""
+
+    node: Node
+    distance: int
+    reuse: bool
+
+
+class PerceptualIndex:
+    """
+    BK-tree of the analysed images. The nodes are only ever appended, so the tree is stored as rows
+    pointing to their parent and rebuilt in memory on open. Every `version` (model version) has its own tree,
+    the verdicts of the others can't be reused, and the runs without the model (empty version) keep no verdicts.
+    The nodes of the files which changed are retired instead of removed, the tree is rebuilt from the newest nodes
+    once the table holds more than `max_entries`
+    """
+
+    def __init__(
+        self,
+        connection: t.Optional[sqlite3.Connection] = None,
+        version: str = "",
+        cluster_distance: int = DEFAULT_CLUSTER_DISTANCE,
+        reuse_distance: int = DEFAULT_REUSE_DISTANCE,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+    ) -> None:
+        """The nodes are kept in memory unless the `connection` (of the scan cache) is given"""
+        self.version = version
+        self.with_verdicts = bool(version)
+        self.cluster_distance = cluster_distance
+        self.reuse_distance = min(reuse_distance, cluster_distance)
+        self.max_entries = max_entries
+        self.owns_connection = connection is None
+        self.connection = connection or sqlite3.connect(":memory:")
+        self.connection.executescript(_SCHEMA)
+        self._reset()
+        # rows of all the versions, kept up to date by this index only, so it's recounted when evicting
+        (self.rows,) = self.connection.execute("SELECT COUNT(*) FROM phash_nodes").fetchone()
+        rows = self.connection.execute(
+            "SELECT id, hash, parent, distance, path, cluster, is_authentic, inode, size, mtime_ns, retired "
+            "FROM phash_nodes WHERE version = ? ORDER BY id",
+            (version,),
+        )
+        for row in rows:
+            node_id, value, parent, distance, path, cluster, is_authentic, inode, size, mtime_ns, retired = row
+            node = Node(
+                node_id,
+                value & (1 << 64) - 1,
+                path,
+                cluster,
+                None if is_authentic is None else bool(is_authentic),
+                None if inode is None else (inode, size, mtime_ns),
+                bool(retired),
+            )
+            self._append(node)
+            if parent is not None:
+                self._node(parent).children[distance] = node_id
+
+    def __enter__(self) -> "PerceptualIndex":
+        return self
+
+    def __exit__(self, *args: t.Any) -> None:
+        self.close()
+
+    def _reset(self) -> None:
+        self.nodes: list[Node] = []
+        self.ids: dict[int, int] = {}
+        self.paths: dict[str, list[Node]] = {}
+        # nodes added since the last commit, their verdicts are set before it
+        self.pending: set[int] = set()
+
+    def _append(self, node: Node) -> None:
+        self.ids[node.node_id] = len(self.nodes)
+        self.nodes.append(node)
+        self.paths.setdefault(node.path, []).append(node)
+
+    def _node(self, node_id: int) -> Node:
+        return self.nodes[self.ids[node_id]]
+
+    def nearest(self, value: int) -> t.Optional[Match]:
+        """
+        The closest node within the cluster distance. Its verdict is only reused if it has one,
+        the images the ELA failed on or which were scanned without it are analysed again
+        """
+        if not self.nodes:
+            return None
+        best: t.Optional[tuple[int, Node]] = None
+        stack = [self.nodes[0]]
+        while stack:
+            node = stack.pop()
+            distance = hamming(value, node.value)
+            if not node.retired and distance <= self.cluster_distance and (best is None or distance < best[0]):
+                best = (distance, node)
+            # by the triangle inequality only the children within the distance range can hold a match
+            for child_distance, child in node.children.items():
+                if abs(child_distance - distance) <= self.cluster_distance:
+                    stack.append(self._node(child))
+        if best is None:
+            return None
+        distance, node = best
+        has_verdict = not self.with_verdicts or node.is_authentic is not None or node.node_id in self.pending
+        return Match(node, distance, distance <= self.reuse_distance and has_verdict)
+
+    def retire_stale(self, path: str, fingerprint: t.Optional[Fingerprint]) -> None:
+        """
+        Retires the nodes of the previous contents of the file, so an image edited in place is analysed again,
+        and those left without a verdict, which the new node of the image replaces
+        """
+        for node in self.paths.get(path, []):
+            missing_verdict = self.with_verdicts and node.is_authentic is None
+            if not node.retired and (node.fingerprint != fingerprint or missing_verdict):
+                node.retired = True
+                self.connection.execute("UPDATE phash_nodes SET retired = 1 WHERE id = ?", (node.node_id,))
+
+    def _insert(self, node: Node) -> None:
+        parent: t.Optional[Node] = None
+        distance: t.Optional[int] = None
+        if self.nodes:
+            parent = self.nodes[0]
+            while True:
+                distance = hamming(node.value, parent.value)
+                if distance not in parent.children:
+                    break
+                parent = self._node(parent.children[distance])
+        inode, size, mtime_ns = node.fingerprint or (None, None, None)
+        cursor = self.connection.execute(
+            "INSERT INTO phash_nodes (id, hash, parent, distance, path, cluster, is_authentic, version, inode, size, "
+            "mtime_ns) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                node.node_id or None,
+                _to_signed(node.value),
+                parent.node_id if parent is not None else None,
+                distance,
+                node.path,
+                node.cluster,
+                node.is_authentic,
+                self.version,
+                inode,
+                size,
+                mtime_ns,
+            ),
+        )
+        node.node_id = t.cast(int, cursor.lastrowid)
+        self.rows += 1
+        self._append(node)
+        if parent is not None and distance is not None:
+            parent.children[distance] = node.node_id
+
+    def add(
+        self,
+        value: int,
+        path: str,
+        cluster: t.Optional[str] = None,
+        fingerprint: t.Optional[Fingerprint] = None,
+    ) -> Node:
+        node = Node(0, value, path, cluster or path, fingerprint=fingerprint)
+        self._insert(node)
+        self.pending.add(node.node_id)
+        return node
+
+    def set_verdict(self, node: Node, is_authentic: t.Optional[bool]) -> None:
+        """The nodes the ELA failed on are no longer reused, even before the commit"""
+        node.is_authentic = is_authentic
+        if is_authentic is None:
+            self.pending.discard(node.node_id)
+        self.connection.execute("UPDATE phash_nodes SET is_authentic = ? WHERE id = ?", (is_authentic, node.node_id))
+
+    def evict(self) -> None:
+        """
+        A BK-tree node can't be removed without its subtree, so the tree is rebuilt from the newest nodes,
+        with a tenth of `max_entries` of headroom left not to rebuild it on every commit.
+        The nodes of the other versions older than the kept ones are dropped as well
+        """
+        if self.rows <= self.max_entries:
+            return
+        kept = [node for node in self.nodes if not node.retired][-(self.max_entries - self.max_entries // 10) :]
+        oldest = kept[0].node_id if kept else (1 << 63) - 1
+        self.connection.execute("DELETE FROM phash_nodes WHERE version = ? OR id < ?", (self.version, oldest))
+        self._reset()
+        for node in kept:
+            node.children = {}
+            self._insert(node)
+        (self.rows,) = self.connection.execute("SELECT COUNT(*) FROM phash_nodes").fetchone()
+
+    def commit(self) -> None:
+        self.evict()
+        self.pending.clear()
+        self.connection.commit()
+
+    def close(self) -> None:
+        self.commit()
+        if self.owns_connection:
+            self.connection.close()
+
+
+def open_perceptual_index(
+    enabled: bool,
+    cache: t.Optional[ScanCache],
+    version: str,
+    cluster_distance: int = DEFAULT_CLUSTER_DISTANCE,
+    reuse_distance: int = DEFAULT_REUSE_DISTANCE,
+) -> t.ContextManager[t.Optional[PerceptualIndex]]:
+    """
+    The index is kept in the `cache` file if given, in memory otherwise. It shares the cache connection,
+    a second one would wait for the write lock held by the other until the chunk is committed.
+    It's bounded by the `max_entries` of the cache as well
+    """
+    if not enabled:
+        return contextlib.nullcontext()
+    if cache is None:
+        return PerceptualIndex(None, version, cluster_distance, reuse_distance)
+    return PerceptualIndex(cache.connection, version, cluster_distance, reuse_distance, cache.max_entries)
@@ -0,0 +1,167 @@
+import dataclasses
+import datetime
+import os
+import typing as t
+
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+@dataclasses.dataclass(slots=True)
+class ScanRecord:
+    """Result of scanning a single image, produced by the scanner and consumed by the report writers"""
+
+    path: str
+    datetime_original: t.Optional[datetime.datetime] = None
+    datetime_modified: t.Optional[datetime.datetime] = None
+    is_edited_by_date: bool = False
+    software: str = ""
+    is_edited_by_software: bool = False
+    # category and confidence of the matched software signature, see app/cli/signatures.tsv
+    software_category: str = ""
+    software_confidence: t.Optional[float] = None
+    copyright: str = ""
+    gps: str = ""
+    # signed decimal degrees of the `gps` coordinates
+    latitude: t.Optional[float] = None
+    longitude: t.Optional[float] = None
+    has_source: bool = False
+    # verdict of the ELA model, only set by `scan --with-ela`
+    is_authentic: t.Optional[bool] = None
+    # first analysed image of the near-duplicates cluster, only set by `scan --dedup`
+    duplicate_of: str = ""
+
+    @property
+    def filename(self) -> str:
+        return os.path.basename(self.path)
+
+    @property
+    def is_edited(self) -> bool:
+        return self.is_edited_by_date or self.is_edited_by_software or self.is_authentic is False
+
+    @classmethod
+    def from_inspections(
+        cls,
+        path: str,
+        datetime_fields: list[t.Any],
+        editing_software: list[t.Any],
+        copyright_: list[t.Any],
+        gps: list[t.Any],
+        osx_metadata: list[t.Any],
+    ) -> "ScanRecord":
+        """Builds the record from the outputs of the `inspect_*` functions"""
+        return cls(
+            path=path,
+            datetime_original=datetime_fields[0] if len(datetime_fields) >= 1 else None,
+            datetime_modified=datetime_fields[1] if len(datetime_fields) >= 2 else None,
+            is_edited_by_date=bool(datetime_fields[2]) if len(datetime_fields) >= 3 else False,
+            software=editing_software[0] if len(editing_software) >= 1 else "",
+            is_edited_by_software=bool(editing_software[1]) if len(editing_software) >= 2 else False,
+            software_category=editing_software[2] if len(editing_software) >= 3 else "",
+            software_confidence=editing_software[3] if len(editing_software) >= 4 else None,
+            copyright=copyright_[0] if len(copyright_) >= 1 else "",
+            gps=gps[0] if len(gps) >= 1 else "",
+            latitude=gps[1] if len(gps) >= 2 else None,
+            longitude=gps[2] if len(gps) >= 3 else None,
+            has_source=bool(osx_metadata[0]) if len(osx_metadata) >= 1 else False,
+        )
+
+    def to_dict(self) -> dict[str, t.Any]:
+        return {field.name: getattr(self, field.name) for field in dataclasses.fields(self)}
+
+    def as_output(self) -> dict[str, t.Any]:
+        """Untruncated values of the `SCAN_ELA_COLUMNS`"""
+        return {**self.to_dict(), "is_edited": self.is_edited}
+
+    @classmethod
+    def from_dict(cls, data: dict[str, t.Any]) -> "ScanRecord":
+        return cls(**data)
+
+    def as_row(self) -> tuple[t.Any, ...]:
+        """Formatted values of the report table columns, see `REPORT_COLUMNS`"""
+        return (
+            self.filename,
+            self.datetime_original.strftime(DATETIME_FORMAT) if self.datetime_original else "",
+            self.datetime_modified.strftime(DATETIME_FORMAT) if self.datetime_modified else "",
+            self.software,
+            self.copyright,
+            self.gps,
+            self.has_source,
+            ELA_VERDICTS[self.is_authentic],
+            self.is_edited,
+        )
+
+
+REPORT_COLUMNS = (
+    "FileName",
+    "DateTime Origin",
+    "DateTime",
+    "Software",
+    "Copyright",
+    "Coordinates",
+    "Has Source",
+    "ELA Verdict",
+    "Is Edited",
+)
+ELA_VERDICTS = {True: "Authentic", False: "Tampered", None: ""}
+
+# column name -> value type of the machine-readable outputs
+SCAN_COLUMNS: dict[str, type] = {
+    "path": str,
+    "datetime_original": datetime.datetime,
+    "datetime_modified": datetime.datetime,
+    "is_edited_by_date": bool,
+    "software": str,
+    "is_edited_by_software": bool,
+    "software_category": str,
+    "software_confidence": float,
+    "copyright": str,
+    "gps": str,
+    "latitude": float,
+    "longitude": float,
+    "has_source": bool,
+    "is_edited": bool,
+}
+SCAN_ELA_COLUMNS: dict[str, type] = {**SCAN_COLUMNS, "is_authentic": bool}
+DEDUP_COLUMNS: dict[str, type] = {"duplicate_of": str}
+
+
+@dataclasses.dataclass(slots=True)
+class ElaRecord:
+    """Verdict of the ELA model, `is_authentic` is None when the image couldn't be analysed"""
+
+    path: str
+    is_authentic: t.Optional[bool] = None
+
+    def as_output(self) -> dict[str, t.Any]:
+        return {"path": self.path, "is_authentic": self.is_authentic}
+
+
+ELA_COLUMNS: dict[str, type] = {
+    "path": str,
+    "is_authentic": bool,
+}
+
+
+@dataclasses.dataclass(slots=True)
+class TiledElaRecord:
+    """Verdict of the tiled ELA, `heatmap` is the path of the saved heatmap image, if any"""
+
+    path: str
+    is_authentic: t.Optional[bool] = None
+    tiles: int = 0
+    tampered_tiles: int = 0
+    max_tamper_probability: float = 0.0
+    heatmap: str = ""
+
+    def as_output(self) -> dict[str, t.Any]:
+        return dataclasses.asdict(self)
+
+
+TILED_ELA_COLUMNS: dict[str, type] = {
+    "path": str,
+    "is_authentic": bool,
+    "tiles": int,
+    "tampered_tiles": int,
+    "max_tamper_probability": float,
+    "heatmap": str,
+}
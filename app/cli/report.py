@@ -1,72 +1,223 @@
-import contextlib
-import itertools
+import array
+import collections
+import datetime
+import io
+import math
 import os
-import time
 import typing as t
 
-import matplotlib.pyplot as plt
 import numpy as np
-import requests
-from PIL import Image
+import numpy.typing as npt
+from matplotlib.figure import Figure
 from reportlab.lib.pagesizes import A4
+from reportlab.lib.utils import ImageReader
 from reportlab.pdfgen import canvas
-from rich.progress import track
-
-from app.utils import TMP_FOLDER
-
-
-def generate_report(data: list[list[str]]) -> None:
-    w, h = A4
-    x_offset = 50
-    y_offset = 80
-    padding = 15
-    max_rows_per_page = 45
-    data = prep_data(data)
-    c = canvas.Canvas("report.pdf", pagesize=A4)
-    c.setFont("Helvetica-Bold", 14)
-    c.drawString(50, h - 50, "Report Table")
-    c.setFont("Helvetica", 6)
-
-    xlist = [x + x_offset for x in [0, 70, 135, 195, 270, 355, 420, 470, 510]]
-    ylist = [h - y_offset - i * padding for i in range(max_rows_per_page + 1)]
-
-    is_first_row = True
-    for rows in track(grouper(data, max_rows_per_page), description="Preparing report data ..."):
-        rows = tuple(filter(bool, rows))
-        c.grid(xlist, ylist[: len(rows) + 1])
-        for y, row in zip(ylist[:-1], rows):
-            for x, cell in zip(xlist, row):
-                if is_first_row:
-                    c.setFont("Helvetica-Bold", 8)
-                    c.drawString(x + 2, y - padding + 3, str(cell))
-                    c.setFont("Helvetica", 6)
-                    continue
-                if x == 520 and not is_first_row:
-                    if cell:
-                        c.setFillColorRGB(255, 0, 0)
-                        c.drawString(x + 2, y - padding + 3, "EDITED")
-                    else:
-                        c.setFillColorRGB(0, 100, 0)
-                        c.drawString(x + 2, y - padding + 3, "ORIGINAL")
-                    c.setFillColorRGB(0, 0, 0)
-                    continue
-                c.drawString(x + 2, y - padding + 3, truncate_string(str(cell)))
-            is_first_row = False
-        c.showPage()
-        c.setFont("Helvetica", 6)
 
-    edited = create_chart_of_eddited_data(data)
-    c.setFont("Helvetica-Bold", 14)
-    c.drawString(50, h - 50, "Edited Files Pie chart")
-    c.setFont("Helvetica", 10)
-    c.drawString(50, h - 65, "Edited: " + str(edited) + " Original: " + str(len(data) - edited))
-    c.drawImage(f"{TMP_FOLDER}/editedChart.png", -100, h - 550)
-    create_years_chart(data)
-    c.drawImage(f"{TMP_FOLDER}/yearBar.png", 0, 50)
-    c.showPage()
-    build_country_chart(data)
-    c.drawImage(f"{TMP_FOLDER}/countryBar.png", 0, h - 300)
-    c.save()
+from app import profiling
+from app.cli.records import REPORT_COLUMNS, SCAN_COLUMNS, ScanRecord
+from app.geo.geocoder import load_country_index
+
+X_OFFSET = 50
+Y_OFFSET = 80
+PADDING = 15
+MAX_ROWS_PER_PAGE = 45
+COLUMN_OFFSETS = [0, 70, 135, 195, 270, 355, 420, 470, 510]
+ELA_COLUMN_OFFSETS = [0, 70, 135, 195, 265, 335, 400, 440, 485, 525]
+# the bar charts are drawn at 600x300 px, one pixel per PDF point
+BAR_CHART_SIZE = (10, 5)
+BAR_CHART_DPI = 60
+IS_EDITED_COLUMN = REPORT_COLUMNS.index("Is Edited")
+ELA_VERDICT_COLUMN = REPORT_COLUMNS.index("ELA Verdict")
+
+
+class ReportWriter:
+    """
+    Writes the PDF report while the records arrive, each page is drawn as soon as its rows are filled and only
+    the aggregates needed by the charts are kept besides it. reportlab holds the finished pages (compressed,
+    about 0.5 KB per row) in memory until `close` saves the document, so a report can't be flushed midway
+    """
+
+    def __init__(self, path: str = "report.pdf", columns: dict[str, type] = SCAN_COLUMNS) -> None:
+        self.width, self.height = A4
+        # finished pages are kept compressed until the canvas is saved
+        self.canvas = canvas.Canvas(path, pagesize=A4, pageCompression=1)
+        # the ELA verdict column is only shown for the `scan --with-ela` results
+        with_ela = "is_authentic" in columns
+        self.columns = [i for i in range(len(REPORT_COLUMNS)) if with_ela or i != ELA_VERDICT_COLUMN]
+        self.xlist = [x + X_OFFSET for x in (ELA_COLUMN_OFFSETS if with_ela else COLUMN_OFFSETS)]
+        self.ylist: list[float] = [self.height - Y_OFFSET - i * PADDING for i in range(MAX_ROWS_PER_PAGE + 1)]
+        self.page_rows = 0
+        self.statistics = ReportStatistics()
+        # (software, category, confidence) of the matched software signatures -> number of images
+        self.software: collections.Counter[tuple[str, str, float]] = collections.Counter()
+        # first analysed image -> file names of its near-duplicates, only set by `scan --dedup`
+        self.clusters: collections.defaultdict[str, list[str]] = collections.defaultdict(list)
+
+        self.canvas.setFont("Helvetica-Bold", 14)
+        self.canvas.drawString(50, self.height - 50, "Report Table")
+        self._draw_header()
+
+    def __enter__(self) -> "ReportWriter":
+        return self
+
+    def __exit__(self, *args: t.Any) -> None:
+        self.close()
+
+    def _next_row_y(self) -> float:
+        if self.page_rows == MAX_ROWS_PER_PAGE:
+            self._finish_page()
+        y = self.ylist[self.page_rows]
+        self.page_rows += 1
+        return y
+
+    def _finish_page(self) -> None:
+        if self.page_rows:
+            self.canvas.grid(self.xlist, self.ylist[: self.page_rows + 1])
+        self.canvas.showPage()
+        self.page_rows = 0
+
+    def _draw_header(self) -> None:
+        y = self._next_row_y()
+        self.canvas.setFont("Helvetica-Bold", 8)
+        for x, column in zip(self.xlist, self.columns):
+            self.canvas.drawString(x + 2, y - PADDING + 3, REPORT_COLUMNS[column])
+
+    def add(self, record: ScanRecord) -> None:
+        with profiling.stage("pdf.rows"):
+            self._add(record)
+
+    def _add(self, record: ScanRecord) -> None:
+        y = self._next_row_y()
+        c = self.canvas
+        c.setFont("Helvetica", 6)
+        row = record.as_row()
+        for x, column in zip(self.xlist, self.columns):
+            cell = row[column]
+            if column == IS_EDITED_COLUMN:
+                if cell:
+                    c.setFillColorRGB(255, 0, 0)
+                    c.drawString(x + 2, y - PADDING + 3, "EDITED")
+                else:
+                    c.setFillColorRGB(0, 100, 0)
+                    c.drawString(x + 2, y - PADDING + 3, "ORIGINAL")
+                c.setFillColorRGB(0, 0, 0)
+                continue
+            c.drawString(x + 2, y - PADDING + 3, truncate_string(str(cell)))
+
+        self.statistics.add(record)
+        if record.software_category:
+            self.software[record.software, record.software_category, record.software_confidence or 0.0] += 1
+        if record.duplicate_of:
+            self.clusters[record.duplicate_of].append(record.filename)
+
+    def flush(self) -> None:
+        # reportlab can't write a partial document, the pages are only written out on close
+        pass
+
+    def close(self) -> None:
+        self._finish_page()
+        c = self.canvas
+        h = self.height
+        c.setFont("Helvetica-Bold", 14)
+        c.drawString(50, h - 50, "Edited Files Pie chart")
+        statistics = self.statistics
+        edited, total = statistics.edited_count(), len(statistics)
+        c.setFont("Helvetica", 10)
+        c.drawString(50, h - 65, "Edited: " + str(edited) + " Original: " + str(total - edited))
+        with profiling.stage("pdf.charts"):
+            # matplotlib can't draw a pie of zero wedges, e.g. for an empty directory
+            if total:
+                c.drawImage(create_chart_of_eddited_data(edited, total), -100, h - 550)
+            else:
+                c.drawString(50, h - 85, "No images were scanned")
+            c.drawImage(create_years_chart(*statistics.year_counts()), 0, 50)
+            c.showPage()
+            c.drawImage(build_country_chart(*statistics.country_counts()), 0, h - 300)
+        if self.software:
+            c.showPage()
+            self._draw_lines("Software signatures", self._software_lines())
+        if self.clusters:
+            c.showPage()
+            self._draw_lines("Near-duplicate clusters", self._cluster_lines())
+        with profiling.stage("pdf.save"):
+            c.save()
+
+    def _software_lines(self) -> t.Iterator[tuple[str, str]]:
+        # the most likely edits first
+        by_confidence = sorted(self.software.items(), key=lambda item: (-item[0][2], -item[1], item[0][0]))
+        for (software, category, confidence), count in by_confidence:
+            yield f"{software} - {category}, edit confidence {confidence:.2f}: {count} images", "Helvetica"
+
+    def _cluster_lines(self) -> t.Iterator[tuple[str, str]]:
+        for root, duplicates in self.clusters.items():
+            yield f"{os.path.basename(root)} ({len(duplicates) + 1} images)", "Helvetica-Bold"
+            for filename in duplicates:
+                yield f"    {filename}", "Helvetica"
+
+    def _draw_lines(self, title: str, lines: t.Iterable[tuple[str, str]]) -> None:
+        """Lines of text in the given font, continued on the next pages"""
+        c = self.canvas
+        c.setFont("Helvetica-Bold", 14)
+        c.drawString(50, self.height - 50, title)
+        y = self.height - Y_OFFSET
+        for line, font in lines:
+            if y < Y_OFFSET:
+                c.showPage()
+                y = self.height - Y_OFFSET
+            c.setFont(font, 8)
+            c.drawString(X_OFFSET, y, line)
+            y -= PADDING
+
+
+class ReportStatistics:
+    """
+    Per-image values the report charts are computed from, kept as columns (one row per image, 8 bytes
+    per value) which grow while the records arrive and are aggregated with NumPy group-bys at the end
+    """
+
+    def __init__(self) -> None:
+        # wall-clock time of the DateTimeOriginal as seconds since the epoch, NaN when missing
+        self.timestamps = array.array("d")
+        # signed decimal degrees, NaN when missing
+        self.latitudes = array.array("d")
+        self.longitudes = array.array("d")
+        self.edited = array.array("B")
+
+    def __len__(self) -> int:
+        return len(self.edited)
+
+    def add(self, record: ScanRecord) -> None:
+        original = record.datetime_original
+        # the year of the local time the photo was taken, not of the UTC one
+        self.timestamps.append(original.replace(tzinfo=datetime.timezone.utc).timestamp() if original else math.nan)
+        has_location = record.latitude is not None and record.longitude is not None
+        self.latitudes.append(t.cast(float, record.latitude) if has_location else math.nan)
+        self.longitudes.append(t.cast(float, record.longitude) if has_location else math.nan)
+        self.edited.append(record.is_edited)
+
+    # the NumPy views lock the size of the arrays, so they must not outlive the aggregation
+    def edited_count(self) -> int:
+        return int(np.count_nonzero(np.frombuffer(self.edited, dtype=np.uint8)))
+
+    def year_counts(self) -> tuple[npt.NDArray[np.int64], npt.NDArray[np.int64]]:
+        """Years and the number of images taken in them, in ascending order"""
+        timestamps = np.frombuffer(self.timestamps, dtype=np.float64)
+        seconds = np.floor(timestamps[~np.isnan(timestamps)]).astype(np.int64)
+        years = seconds.astype("datetime64[s]").astype("datetime64[Y]").astype(np.int64) + 1970
+        return np.unique(years, return_counts=True)
+
+    def country_counts(self) -> tuple[list[str], npt.NDArray[np.int64]]:
+        """Countries and the number of images taken in them, the most common first"""
+        with profiling.stage("geocode"):
+            index = load_country_index()
+            ids = index.lookup_ids(
+                np.frombuffer(self.latitudes, dtype=np.float64),
+                np.frombuffer(self.longitudes, dtype=np.float64),
+            )
+        counts = np.bincount(ids[ids >= 0], minlength=len(index.names))
+        order = np.argsort(-counts, kind="stable")
+        order = order[counts[order] > 0]
+        return [index.names[i] for i in order], counts[order]
 
 
 def truncate_string(input_string: str) -> str:
@@ -76,146 +227,49 @@ def truncate_string(input_string: str) -> str:
         return input_string
 
 
-def create_chart_of_eddited_data(data: list[list[t.Any]]) -> int:
-    count_edited = 0
+def render_figure(figure: Figure) -> ImageReader:
+    """Rasterizes the figure into an in-memory PNG, the figure is cleared afterwards"""
+    buffer = io.BytesIO()
+    figure.savefig(buffer, format="png")
+    figure.clear()
+    buffer.seek(0)
+    return ImageReader(buffer)
+
+
+def create_chart_of_eddited_data(count_edited: int, total: int) -> ImageReader:
     labels = ["Edited", "Original"]
     colors = ["Red", "green"]
-    for el in data[1::]:
-        if el[7]:
-            count_edited += 1
-    y = np.array([count_edited, len(data) - count_edited])
-    plt.pie(y, labels=labels, colors=colors)
-
-    plt.savefig(f"{TMP_FOLDER}/editedChart.png")
-    return count_edited
-
-
-def create_years_chart(data) -> None:
-    dictt = {}
-    for item in data[1:]:
-        date = item[1]
-        if date != "":
-            year = date[:4]
-            if year in dictt:
-                dictt[year] = dictt[year] + 1
-            else:
-                dictt[year] = 1
-    dictt = dict(sorted(dictt.items()))
-    years = list(dictt.keys())
-    values = list(dictt.values())
-    plt.figure(figsize=(10, 5))
-    plt.bar(years, values, color="maroon")
-    plt.xlabel("Years")
-    plt.ylabel("No. of images made this year")
-    plt.title("Images made by year")
-    plt.savefig(f"{TMP_FOLDER}/yearBar.png")
-    image = Image.open(f"{TMP_FOLDER}/yearBar.png")
-    image.thumbnail((600, 600))
-    image.save(f"{TMP_FOLDER}/yearBar.png")
-
-
-def build_country_chart(data):
-    countries = getCountryFromCoordinates(data)
-    dictt = {}
-    for contry in countries:
-        if contry in dictt:
-            dictt[contry] = dictt[contry] + 1
-        else:
-            dictt[contry] = 1
-    plt.figure(figsize=(10, 5))
-    contrs = list(dictt.keys())
-    values = list(dictt.values())
-    plt.bar(contrs, values, color="maroon")
-    plt.xlabel("Countries")
-    plt.ylabel("No. of images made made in this country")
-    plt.title("Images made in countries")
-    plt.savefig(f"{TMP_FOLDER}/countryBar.png")
-    image = Image.open(f"{TMP_FOLDER}/countryBar.png")
-    image.thumbnail((600, 600))
-    image.save(f"{TMP_FOLDER}/countryBar.png")
-
-
-def get_reverse_coordinates(lat: float, lng: float) -> t.Optional[dict[str, t.Any]]:
-    time.sleep(2)
-    url = f"https://nominatim.openstreetmap.org/reverse?lat={lat}&lon={lng}" \
-          f"&format=json&accept-language=en&addressdetails=1"
-
-    response = requests.get(url, headers={"User-Agent": "cli-application"})
-    if response.status_code != 200:
-        return None
-    return response.json()
-
-
-def getCountryFromCoordinates(data):
-    result = []
-    for item in track(data[1:], description="Processing GPS data ..."):
-        coordinates = item[5]
-        if coordinates != "":
-            latitude_str, longitude_str = coordinates.split(" ")[1:4:2]
-            NS, WE = coordinates.split(" ")[0:3:2]
-            latitude = float(latitude_str.split("°")[0])
-            longitude = float(longitude_str.split("°")[0])
-            latitude += float(latitude_str.split("°")[0].split("\'")[0]) / 60
-            longitude += float(longitude_str.split("°")[0].split("\'")[0]) / 60
-            latitude += float(latitude_str.split("°")[0].split("\'")[0].split('"')[0]) / 3600
-            latitude += float(longitude_str.split("°")[0].split("\'")[0].split('"')[0]) / 3600
-            if NS[0] == "S":
-                latitude = latitude * -1
-            if WE[0] == "W":
-                longitude = longitude * -1
-            location = get_reverse_coordinates(latitude, longitude)
-            if location:
-                country = location["address"]["country"]
-                result.append(country)
-    return result
-
-
-def grouper(iterable: t.Iterable[t.Any], n: int) -> t.Iterable[t.Any]:
-    args = [iter(iterable)] * n
-    return itertools.zip_longest(*args)
-
-
-def make_flat(data: list[t.Any], flat_data: list[t.Any]) -> None:
-    for item in data:
-        if not len(item):
-            continue
-
-        if isinstance(item[0], str):
-            flat_data.append(item)
-            continue
-
-        if isinstance(item[0], list):
-            make_flat(item, flat_data)
-            continue
-    return
-
-
-def get_row(x: list[t.Any]) -> t.Any:
-    filename = os.path.basename(x[0])
-
-    if len(x) != 6:
-        return filename, "", "", "", "", "", False, False
-
-    dto = x[1][0].strftime("%Y-%m-%d %H:%M:%S") if len(x[1]) >= 1 else ""
-    dt = x[1][1].strftime("%Y-%m-%d %H:%M:%S") if len(x[1]) >= 2 else ""
-    is_edited_by_date = x[1][2] if len(x[1]) >= 3 else 0
-    soft = x[2][0] if len(x[2]) >= 1 else ""
-    is_edited_by_soft = x[2][1] if len(x[2]) >= 2 else 0
-    coop = x[3][0] if len(x[3]) >= 1 else ""
-    gps = x[4][0] if len(x[4]) >= 1 else ""
-    source = x[5][0] if len(x[5]) >= 1 else 0
-    is_edited = is_edited_by_date or is_edited_by_soft
-    return filename, dto, dt, soft, coop, gps, bool(source), bool(is_edited)
-
-
-def prep_data(data: list[t.Any]) -> list[tuple[t.Any, ...]]:
-    flat_data = []
-    make_flat(data, flat_data)
-    result = [
-        ("FileName", "DateTime Origin", "DateTime", "Software", "Copyright", "Coordinates", "Has Source", "Is Edited"),
-    ]
-    for x in flat_data:
-        # todo: handle error
-        with contextlib.suppress(Exception):
-            result.append(get_row(x))
-    return result
+    y = np.array([count_edited, total - count_edited])
+    figure = Figure()
+    figure.add_subplot().pie(y, labels=labels, colors=colors)
+    return render_figure(figure)
+
+
+def _bar_chart(labels: list[str], values: list[int], xlabel: str, ylabel: str, title: str) -> ImageReader:
+    figure = Figure(figsize=BAR_CHART_SIZE, dpi=BAR_CHART_DPI)
+    ax = figure.add_subplot()
+    ax.bar(labels, values, color="maroon")
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(ylabel)
+    ax.set_title(title)
+    return render_figure(figure)
+
+
+def create_years_chart(years: npt.NDArray[np.int64], counts: npt.NDArray[np.int64]) -> ImageReader:
+    return _bar_chart(
+        [str(year) for year in years.tolist()],
+        counts.tolist(),
+        "Years",
+        "No. of images made this year",
+        "Images made by year",
+    )
+
+
+def build_country_chart(countries: list[str], counts: npt.NDArray[np.int64]) -> ImageReader:
+    return _bar_chart(
+        countries,
+        counts.tolist(),
+        "Countries",
+        "No. of images made made in this country",
+        "Images made in countries",
+    )
@@ -0,0 +1,350 @@
+import collections
+import io
+import itertools
+import struct
+import typing as t
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from PIL import Image
+
+from app import profiling
+from app.cli.cache import ELA, PHASH, SCAN, ScanCache
+from app.cli.exif import ExifError, parse_exif, read_exif
+from app.cli.inspectors import (
+    INSPECTORS_VERSION,
+    PathAnnotation,
+    inspect_copyright,
+    inspect_datetime_fields,
+    inspect_editing_software,
+    inspect_gps,
+    inspect_osx_metadata,
+)
+from app.cli.phash import DHASH_VERSION, Fingerprint, Node, PerceptualIndex, dhash, fingerprint
+from app.cli.records import ScanRecord
+from app.utils import iter_image_paths
+
+if t.TYPE_CHECKING:
+    from app.cli.downloader import Download
+    from app.ela_nn.ela import ElaScorer, ElaTensor
+
+SCAN_CHUNK_SIZE = 64
+# number of chunks submitted to the pool per worker, bounds the memory used by the pending results
+SCAN_CHUNKS_IN_FLIGHT = 4
+
+
+def _inspect_exif(path: str, exif: dict[str, t.Any], osx_metadata: list[t.Any]) -> ScanRecord:
+    if not exif:
+        return ScanRecord.from_inspections(path, [], [], [], [], osx_metadata)
+    with profiling.stage("inspectors"):
+        return ScanRecord.from_inspections(
+            path,
+            inspect_datetime_fields(exif),
+            inspect_editing_software(exif),
+            inspect_copyright(exif),
+            inspect_gps(exif),
+            osx_metadata,
+        )
+
+
+def scan_image(path: t.Union[PathAnnotation, str]) -> ScanRecord:
+    try:
+        exif = read_exif(str(path))
+    except OSError:
+        exif = {}
+    with profiling.stage("osx_metadata"):
+        osx_metadata = inspect_osx_metadata(path)
+    return _inspect_exif(str(path), exif, osx_metadata)
+
+
+def scan_image_data(name: str, data: bytes) -> ScanRecord:
+    """Scans the image held in memory, e.g. a downloaded one, there is no file to read the OS metadata from"""
+    try:
+        with profiling.stage("exif"):
+            exif = parse_exif(data)
+    except (ExifError, struct.error, IndexError):
+        exif = {}
+    return _inspect_exif(name, exif, [])
+
+
+def _scan_with_ela(path: str, data: bytes, osx_metadata: list[t.Any]) -> tuple[ScanRecord, t.Optional["ElaTensor"]]:
+    """The EXIF inspectors and the ELA share the file contents read once"""
+    from app.ela_nn.ela import prepare_ela_tensor
+
+    record = scan_image_data(path, data)
+    record.has_source = bool(osx_metadata)
+    return record, prepare_ela_tensor(io.BytesIO(data))
+
+
+def scan_image_with_ela(path: str) -> tuple[ScanRecord, t.Optional["ElaTensor"]]:
+    try:
+        with profiling.stage("open"), open(path, "rb") as f:
+            data = f.read()
+    except OSError:
+        return scan_image(path), None
+    with profiling.stage("osx_metadata"):
+        osx_metadata = inspect_osx_metadata(path)
+    return _scan_with_ela(path, data, osx_metadata)
+
+
+# the record, the ELA input and the perceptual hash of an image, the last two only when asked for
+Scanned = tuple[ScanRecord, t.Optional["ElaTensor"], t.Optional[int]]
+# node of the image in the perceptual index, and whether it's the node of a near-duplicate with a reusable verdict
+Link = tuple[Node, bool]
+_Result = tuple[list[Scanned], t.Optional[profiling.Samples]]
+_Pending = tuple[list[str], dict[str, Scanned], Future[_Result]]
+
+
+def _hash_image(source: t.Union[str, t.BinaryIO]) -> t.Optional[int]:
+    try:
+        with profiling.stage("dhash"):
+            return dhash(source)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+
+
+def _link(index: PerceptualIndex, path: str, value: int, fingerprint: t.Optional[Fingerprint]) -> Link:
+    """Matches the image to the already analysed ones, the images which aren't reused are added to the index"""
+    index.retire_stale(path, fingerprint)
+    match = index.nearest(value)
+    if match is not None and match.reuse:
+        return match.node, True
+    return index.add(value, path, cluster=match.node.cluster if match else None, fingerprint=fingerprint), False
+
+
+def _apply_link(
+    record: ScanRecord,
+    link: t.Optional[Link],
+    index: PerceptualIndex,
+    scorer: t.Optional["ElaScorer"],
+) -> None:
+    if link is None:
+        return
+    node, reused = link
+    if node.cluster != record.path:
+        record.duplicate_of = node.cluster
+    if scorer is None:
+        return
+    if reused:
+        # the matched image precedes this one, so its verdict is known by now
+        record.is_authentic = node.is_authentic
+    else:
+        index.set_verdict(node, record.is_authentic)
+
+
+def _is_reused(link: t.Optional[Link]) -> bool:
+    return link is not None and link[1]
+
+
+def _link_and_score(
+    scanned: list[Scanned],
+    fingerprints: list[t.Optional[Fingerprint]],
+    scorer: t.Optional["ElaScorer"],
+    index: t.Optional[PerceptualIndex],
+) -> list[t.Optional[Link]]:
+    """
+    Links the hashed images in order, the model only scores those not reusing the verdict of a near-duplicate.
+    The new nodes get their verdicts right away, so they are committed with them. The copies of an image
+    of the same batch the ELA failed on are linked and scored again, that image is no longer reused
+    """
+    links: list[t.Optional[Link]] = [None] * len(scanned)
+    todo = list(range(len(scanned)))
+    while todo:
+        if index is not None:
+            for i in todo:
+                record, _, value = scanned[i]
+                links[i] = _link(index, record.path, value, fingerprints[i]) if value is not None else None
+        if scorer is not None:
+            verdicts = scorer.score([None if _is_reused(links[i]) else scanned[i][1] for i in todo])
+            for i, verdict in zip(todo, verdicts):
+                scanned[i][0].is_authentic = verdict
+        if index is None or scorer is None:
+            break
+        for i in todo:
+            _apply_link(scanned[i][0], links[i], index, scorer)
+        todo = [i for i in todo if _is_reused(links[i]) and scanned[i][0].is_authentic is None]
+    if index is not None and scorer is None:
+        for (record, _, _), link in zip(scanned, links):
+            _apply_link(record, link, index, scorer)
+    return links
+
+
+def _link_cached(
+    cached: dict[str, Scanned],
+    scorer: t.Optional["ElaScorer"],
+    index: t.Optional[PerceptualIndex],
+) -> None:
+    """
+    Links the cached images by their cached hash, so their clusters are the same as without the cache.
+    Their verdict is cached as well, so it's kept and given to their new nodes
+    """
+    if index is None:
+        return
+    for path, (record, _, value) in cached.items():
+        if value is None:
+            continue
+        node, reused = _link(index, path, value, fingerprint(path))
+        record.duplicate_of = node.cluster if node.cluster != path else ""
+        if scorer is not None and not reused:
+            index.set_verdict(node, record.is_authentic)
+
+
+def _scan_download(download: "Download", with_ela: bool, with_hash: bool) -> Scanned:
+    if download.data is None:
+        record, tensor = scan_image_with_ela(str(download.path)) if with_ela else (scan_image(str(download.path)), None)
+        record.path = download.url
+        return record, tensor, _hash_image(str(download.path)) if with_hash else None
+    if with_ela:
+        record, tensor = _scan_with_ela(download.url, download.data, [])
+    else:
+        record, tensor = scan_image_data(download.url, download.data), None
+    return record, tensor, _hash_image(io.BytesIO(download.data)) if with_hash else None
+
+
+def scan_downloads(
+    downloads: t.Iterable["Download"],
+    scorer: t.Optional["ElaScorer"] = None,
+    index: t.Optional[PerceptualIndex] = None,
+) -> t.Iterator[ScanRecord]:
+    """
+    With the `scorer` the downloads are scored in batches, otherwise they are yielded one by one.
+    With the `index` the near-duplicates of the already scored images reuse their verdict
+    """
+    downloads_iter = iter(downloads)
+    batch_size = scorer.batch_size if scorer is not None else 1
+    while batch := list(itertools.islice(downloads_iter, batch_size)):
+        scanned = [_scan_download(download, scorer is not None, index is not None) for download in batch]
+        # the downloads have no file identity, their nodes are matched by the URL
+        _link_and_score(scanned, [None] * len(scanned), scorer, index)
+        if index is not None:
+            index.commit()
+        yield from (record for record, _, _ in scanned)
+
+
+def _scan_file(path: str, with_ela: bool, with_hash: bool) -> Scanned:
+    record, tensor = scan_image_with_ela(path) if with_ela else (scan_image(path), None)
+    return record, tensor, _hash_image(path) if with_hash else None
+
+
+def scan_images(paths: list[str], with_ela: bool = False, with_hash: bool = False) -> list[Scanned]:
+    """The ELA inputs and the perceptual hashes are only computed when asked for, e.g. on the pool workers"""
+    return [_scan_file(path, with_ela, with_hash) for path in paths]
+
+
+def _lookup_cached(
+    chunk: list[str],
+    cache: t.Optional[ScanCache],
+    scorer: t.Optional["ElaScorer"],
+    index: t.Optional[PerceptualIndex],
+) -> dict[str, Scanned]:
+    """
+    Records of the cached images, with the `scorer` the ELA verdict has to be cached as well,
+    with the `index` the perceptual hash, the near-duplicate links are made again from it
+    """
+    result: dict[str, Scanned] = {}
+    if cache is None:
+        return result
+    for path in chunk:
+        if (cached := cache.get(SCAN, path, INSPECTORS_VERSION)) is None:
+            continue
+        record = ScanRecord.from_dict(cached)
+        record.path = path
+        record.is_authentic = None
+        record.duplicate_of = ""
+        value = None
+        if index is not None and (value := cache.get(PHASH, path, DHASH_VERSION)) is None:
+            continue
+        if scorer is not None:
+            if (verdict := cache.get(ELA, path, scorer.version)) is None:
+                continue
+            record.is_authentic = verdict
+        result[path] = (record, None, value)
+    return result
+
+
+def _merge_chunk(
+    chunk: list[str],
+    cached: dict[str, Scanned],
+    scanned: list[Scanned],
+    cache: t.Optional[ScanCache],
+    scorer: t.Optional["ElaScorer"],
+    index: t.Optional[PerceptualIndex],
+) -> t.Iterator[ScanRecord]:
+    _link_cached(cached, scorer, index)
+    fingerprints = [fingerprint(record.path) if index is not None else None for record, _, _ in scanned]
+    links = _link_and_score(scanned, fingerprints, scorer, index)
+    scanned_iter = iter(zip(scanned, links))
+    for path in chunk:
+        if path in cached:
+            yield cached[path][0]
+            continue
+        (record, _, value), link = next(scanned_iter)
+        if cache is not None:
+            cache.put(SCAN, path, INSPECTORS_VERSION, record.to_dict())
+            if value is not None:
+                cache.put(PHASH, path, DHASH_VERSION, value)
+            # a reused verdict is only valid with the index, the runs without it analyse the image
+            if scorer is not None and record.is_authentic is not None and not _is_reused(link):
+                cache.put(ELA, path, scorer.version, record.is_authentic)
+        yield record
+    if cache is not None:
+        cache.commit()
+    if index is not None:
+        index.commit()
+
+
+def scan_paths(
+    paths: t.Iterable[str],
+    jobs: int = 1,
+    cache: t.Optional[ScanCache] = None,
+    scorer: t.Optional["ElaScorer"] = None,
+    index: t.Optional[PerceptualIndex] = None,
+) -> t.Iterator[ScanRecord]:
+    """
+    Scans the images yielding the results in the order of `paths`, with `jobs` > 1 the images are scanned
+    in chunks on a process pool. Images with a valid entry in the `cache` are not scanned again.
+    With the `scorer` the workers also prepare the ELA inputs, which are scored in the main process
+    while the next chunks are being scanned. With the `index` the workers also hash the images, which
+    are linked in the main process, the near-duplicates of the already scored images reuse their verdict
+    instead of being scored
+    """
+    paths_iter = iter(paths)
+    chunks = iter(lambda: list(itertools.islice(paths_iter, SCAN_CHUNK_SIZE)), [])
+    with_ela = scorer is not None
+    with_hash = index is not None
+
+    if jobs <= 1:
+        for chunk in chunks:
+            cached = _lookup_cached(chunk, cache, scorer, index)
+            scanned = scan_images([path for path in chunk if path not in cached], with_ela, with_hash)
+            yield from _merge_chunk(chunk, cached, scanned, cache, scorer, index)
+        return
+
+    pending: collections.deque[_Pending] = collections.deque()
+
+    def submit(chunk: list[str]) -> None:
+        cached = _lookup_cached(chunk, cache, scorer, index)
+        misses = [path for path in chunk if path not in cached]
+        pending.append((chunk, cached, executor.submit(profiling.collect, scan_images, misses, with_ela, with_hash)))
+
+    with ProcessPoolExecutor(
+        max_workers=jobs,
+        initializer=profiling.init_worker,
+        initargs=(profiling.is_enabled(),),
+    ) as executor:
+        for chunk in itertools.islice(chunks, jobs * SCAN_CHUNKS_IN_FLIGHT):
+            submit(chunk)
+        while pending:
+            chunk, cached, future = pending.popleft()
+            if next_chunk := next(chunks, None):
+                submit(next_chunk)
+            scanned, samples = future.result()
+            profiling.merge(samples)
+            yield from _merge_chunk(chunk, cached, scanned, cache, scorer, index)
+
+
+def scan_path(
+    path: t.Union[PathAnnotation, str],
+    jobs: int = 1,
+    cache: t.Optional[ScanCache] = None,
+) -> list[ScanRecord]:
+    return list(scan_paths(iter_image_paths(str(path)), jobs=jobs, cache=cache))
@@ -1,22 +1,19 @@
-import sys
+import os
+
+from app.ela_nn.model import LEGACY_MODEL_NAME, MODEL_FOLDER, MODEL_WEIGHTS_NAME, convert_model
+from app.utils import get_base_path
 
 
 def setup() -> None:
+    """Converts the pickled `model_c1.pth` into the weights-only format loaded by the `ela` subcommand"""
+    src = os.path.join(get_base_path(), MODEL_FOLDER, LEGACY_MODEL_NAME)
+    dst = os.path.join(get_base_path(), MODEL_FOLDER, MODEL_WEIGHTS_NAME)
     try:
-        path = sys.executable
-        bin_dir = path.rsplit("/", 1)[0]
-        main_executable_path = bin_dir + "/image_scan"
-        with open(main_executable_path) as f:
-            lines = f.readlines()
-
-        new_lines = lines[:2] + ["from app.ela_nn.model import IMDModel\n"] + lines[2:]
-
-        with open(main_executable_path, "w") as f:
-            f.writelines(new_lines)
+        convert_model(src, dst)
     except Exception:
-        print("Error when setting up the `image_scan` script, `ela` subcommand will not work")
+        print(f"Error when converting the model {src}, `ela` subcommand will load the legacy model")
     else:
-        print("Success")
+        print(f"Success, model weights are saved to {dst}")
 
 
 if __name__ == "__main__":
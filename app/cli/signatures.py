@@ -0,0 +1,98 @@
+"""
+Editing software signature database, see signatures.tsv. The patterns are compiled into an Aho-Corasick automaton,
+so a tag value is matched against all of them in a single pass over its characters whatever the number of patterns
+"""
+import collections
+import dataclasses
+import functools
+import os
+import typing as t
+
+SIGNATURES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "signatures.tsv")
+# the signatures at or above this confidence mark the image as edited
+EDITED_CONFIDENCE = 0.5
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class Signature:
+    pattern: str
+    name: str
+    category: str
+    # likelihood that a file carrying the signature was edited
+    confidence: float
+
+
+def _is_better(signature: Signature, other: t.Optional[Signature]) -> bool:
+    # the longer pattern is the more specific one, e.g. "Photoshop Lightroom" over "Photoshop"
+    return other is None or (len(signature.pattern), signature.confidence) > (len(other.pattern), other.confidence)
+
+
+class SignatureMatcher:
+    """
+    Aho-Corasick automaton over the lowercased patterns. Only the best signature ending in a state is kept,
+    including those reached by the failure links, as the match of a value is the single best hit
+    """
+
+    def __init__(self, signatures: t.Iterable[Signature]) -> None:
+        self.transitions: list[dict[str, int]] = [{}]
+        self.failures: list[int] = [0]
+        self.best: list[t.Optional[Signature]] = [None]
+        for signature in signatures:
+            self._insert(signature)
+        self._link()
+
+    def _insert(self, signature: Signature) -> None:
+        state = 0
+        for char in signature.pattern.lower():
+            if (next_state := self.transitions[state].get(char)) is None:
+                next_state = len(self.transitions)
+                self.transitions[state][char] = next_state
+                self.transitions.append({})
+                self.failures.append(0)
+                self.best.append(None)
+            state = next_state
+        if _is_better(signature, self.best[state]):
+            self.best[state] = signature
+
+    def _link(self) -> None:
+        # breadth-first, so the failure target of a state (a shorter suffix) is always complete before the state
+        queue = collections.deque(self.transitions[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.transitions[state].items():
+                queue.append(next_state)
+                failure = self.failures[state]
+                while failure and char not in self.transitions[failure]:
+                    failure = self.failures[failure]
+                self.failures[next_state] = self.transitions[failure].get(char, 0)
+                inherited = self.best[self.failures[next_state]]
+                if inherited is not None and _is_better(inherited, self.best[next_state]):
+                    self.best[next_state] = inherited
+
+    def match(self, value: str) -> t.Optional[Signature]:
+        """The longest (then the most confident) signature found in `value`"""
+        best: t.Optional[Signature] = None
+        state = 0
+        transitions, failures = self.transitions, self.failures
+        for char in value.lower():
+            while state and char not in transitions[state]:
+                state = failures[state]
+            state = transitions[state].get(char, 0)
+            if (signature := self.best[state]) is not None and _is_better(signature, best):
+                best = signature
+        return best
+
+
+def read_signatures(path: str = SIGNATURES_PATH) -> t.Iterator[Signature]:
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip() or line.startswith("#"):
+                continue
+            pattern, name, category, confidence = line.rstrip("\n").split("\t")
+            yield Signature(pattern, name, category, float(confidence))
+
+
+@functools.cache
+def load_matcher(path: str = SIGNATURES_PATH) -> SignatureMatcher:
+    """Compiled once per process, the scan workers build their own on the first inspected image"""
+    return SignatureMatcher(read_signatures(path))
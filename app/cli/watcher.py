@@ -0,0 +1,187 @@
+"""
+Directory tree watchers of the `watch` command. On Linux the kernel reports the changes through inotify
+(called via ctypes, there is no extra dependency), elsewhere the tree is polled.
+Both report the image files which were written or moved into the tree
+"""
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import time
+import typing as t
+
+from app.utils import IMAGE_EXTENSIONS, iter_image_paths
+
+DEFAULT_DEBOUNCE = 1.0
+DEFAULT_POLL_INTERVAL = 2.0
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+# a written file is only reported once it's closed, the files of the other filesystems arrive by a rename
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+EVENT_HEADER = struct.Struct("iIII")
+READ_SIZE = 2**16
+
+
+class Watcher(t.Protocol):
+    def poll(self, timeout: float) -> set[str]:
+        """Waits up to `timeout` seconds, returns the paths of the images changed in the meantime"""
+        ...
+
+    def close(self) -> None:
+        ...
+
+
+def _is_image(path: str) -> bool:
+    return path.lower().endswith(tuple(IMAGE_EXTENSIONS))
+
+
+def _iter_directories(root: str) -> t.Iterator[str]:
+    for directory, _, _ in os.walk(root):
+        yield directory
+
+
+class InotifyWatcher:
+    def __init__(self, root: str) -> None:
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.root = root
+        self.directories: dict[int, str] = {}
+        try:
+            self._add_tree(root)
+        except OSError:
+            os.close(self.fd)
+            raise
+
+    def _add_watch(self, directory: str) -> None:
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error == errno.ENOSPC:
+                raise OSError(error, "inotify watch limit reached, raise fs.inotify.max_user_watches")
+            return  # the directory was removed in the meantime
+        self.directories[wd] = directory
+
+    def _add_tree(self, root: str) -> None:
+        for directory in _iter_directories(root):
+            self._add_watch(directory)
+
+    def _read_events(self) -> t.Iterator[tuple[int, int, str]]:
+        try:
+            data = os.read(self.fd, READ_SIZE)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset : offset + length].rstrip(b"\0")
+            offset += length
+            yield wd, mask, os.fsdecode(name)
+
+    def poll(self, timeout: float) -> set[str]:
+        changed: set[str] = set()
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        while readable:
+            for wd, mask, name in self._read_events():
+                if mask & IN_Q_OVERFLOW:
+                    # events were dropped, everything is reported, the cache skips the unchanged images
+                    changed.update(iter_image_paths(self.root))
+                    continue
+                if mask & IN_IGNORED:
+                    self.directories.pop(wd, None)
+                    continue
+                directory = self.directories.get(wd)
+                if directory is None or not name:
+                    continue
+                path = os.path.join(directory, name)
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        # the images written before the new directory was watched are picked up by the walk
+                        self._add_tree(path)
+                        changed.update(iter_image_paths(path))
+                elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO) and _is_image(path):
+                    changed.add(path)
+            readable, _, _ = select.select([self.fd], [], [], 0)
+        return changed
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """Compares the size and mtime of every image with the previous walk, the cost grows with the tree size"""
+
+    def __init__(self, root: str, interval: float = DEFAULT_POLL_INTERVAL) -> None:
+        self.root = root
+        self.interval = interval
+        self.state = self._snapshot()
+        self.next_poll = time.monotonic() + interval
+
+    def _snapshot(self) -> dict[str, tuple[int, int]]:
+        state = {}
+        for path in iter_image_paths(self.root):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            state[path] = (stat.st_size, stat.st_mtime_ns)
+        return state
+
+    def poll(self, timeout: float) -> set[str]:
+        time.sleep(max(0.0, min(timeout, self.next_poll - time.monotonic())))
+        if time.monotonic() < self.next_poll:
+            return set()
+        self.next_poll = time.monotonic() + self.interval
+        state = self._snapshot()
+        changed = {path for path, signature in state.items() if self.state.get(path) != signature}
+        self.state = state
+        return changed
+
+    def close(self) -> None:
+        pass
+
+
+def create_watcher(root: str, polling: bool = False, interval: float = DEFAULT_POLL_INTERVAL) -> Watcher:
+    if not polling and sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(root)
+        except (OSError, AttributeError):
+            # e.g. the inotify syscalls are blocked in the container, or the watch limit is too low
+            pass
+    return PollingWatcher(root, interval)
+
+
+def iter_settled(watcher: Watcher, debounce: float = DEFAULT_DEBOUNCE) -> t.Iterator[list[str]]:
+    """
+    Yields the batches of changed images once no further change of them was reported for `debounce` seconds,
+    so a file written in several bursts is only scanned once
+    """
+    pending: dict[str, float] = {}
+    while True:
+        timeout = debounce if not pending else max(0.0, min(pending.values()) + debounce - time.monotonic())
+        changed = watcher.poll(timeout)
+        now = time.monotonic()
+        for path in changed:
+            pending[path] = now
+        settled = sorted(path for path, changed_at in pending.items() if now - changed_at >= debounce)
+        for path in settled:
+            del pending[path]
+        settled = [path for path in settled if os.path.isfile(path)]
+        if settled:
+            yield settled
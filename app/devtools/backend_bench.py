@@ -0,0 +1,97 @@
+"""
+Compares the ELA model inference backends on the bundled samples/ and exif_samples/ images: the verdicts and
+the output probabilities against the float32 baseline, and the throughput of every backend and thread count.
+
+Usage: python -m app.devtools.backend_bench [--threads 1 --threads 4] [--batch-size 32] [--seconds 3]
+
+Exits with code 1 when a backend disagrees with the float32 verdict on more than `--max-mismatches` images
+"""
+import argparse
+import itertools
+import sys
+import time
+import warnings
+
+import numpy as np
+import numpy.typing as npt
+import torch
+
+from app.devtools.bench import sample_files
+from app.ela_nn.backends import BackendError, check_backend, load_backend_model, select_device
+from app.ela_nn.ela import ElaTensor, prepare_ela_tensor
+from app.utils import DEFAULT_BATCH_SIZE, InferenceBackend, get_base_path
+
+warnings.filterwarnings("ignore")
+
+
+def probabilities(
+    model: torch.nn.Module,
+    device: torch.device,
+    tensors: ElaTensor,
+    batch_size: int,
+) -> npt.NDArray[np.float32]:
+    """Probability of the authentic class of every image"""
+    outputs: list[npt.NDArray[np.float32]] = []
+    with torch.inference_mode():
+        for start in range(0, len(tensors), batch_size):
+            out = model(torch.from_numpy(tensors[start : start + batch_size]).to(device=device))
+            outputs.append(out[:, 1].float().cpu().numpy())
+    return np.concatenate(outputs)
+
+
+def throughput(model: torch.nn.Module, device: torch.device, batch: ElaTensor, seconds: float) -> float:
+    """Images per second of the repeated inference of `batch`"""
+    inputs = torch.from_numpy(batch).to(device=device)
+    with torch.inference_mode():
+        model(inputs)  # warm-up, e.g. the oneDNN kernels are created on the first call
+        images = 0
+        start = time.perf_counter()
+        while (elapsed := time.perf_counter() - start) < seconds:
+            model(inputs)
+            images += len(batch)
+    return images / elapsed
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, action="append", help="Intra-op thread counts, can be repeated")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--seconds", type=float, default=3.0, help="Duration of every throughput measurement")
+    parser.add_argument("--max-mismatches", type=int, default=0)
+    args = parser.parse_args()
+
+    paths = sample_files("samples") + sample_files("exif_samples")
+    tensors = np.stack([tensor for path in paths if (tensor := prepare_ela_tensor(path)) is not None])
+    batch = np.stack(list(itertools.islice(itertools.cycle(tensors), args.batch_size)))
+    thread_counts = args.threads or [torch.get_num_threads()]
+    print(f"{len(tensors)} sample images, batch size {args.batch_size}\n")
+
+    baseline = None
+    failed = False
+    columns = " ".join(f"{f'{threads} threads':>13}" for threads in thread_counts)
+    print(f"{'backend':<8} {'mismatches':>10} {'max |dp|':>10} {columns}")
+    for backend in InferenceBackend:
+        device = select_device(backend)
+        try:
+            check_backend(device, backend)
+        except BackendError as e:
+            print(f"{backend.value:<8} skipped, {e}")
+            continue
+        model = load_backend_model(get_base_path(), device, backend)
+        authentic = probabilities(model, device, tensors, args.batch_size)
+        if baseline is None:
+            baseline = authentic
+        mismatches = int(np.count_nonzero((authentic > 0.5) != (baseline > 0.5)))
+        failed |= mismatches > args.max_mismatches
+        rates = []
+        for threads in thread_counts:
+            torch.set_num_threads(threads)
+            rates.append(f"{throughput(model, device, batch, args.seconds):>8.1f} img/s")
+        print(
+            f"{backend.value:<8} {mismatches:>10} {np.max(np.abs(authentic - baseline)):>10.4f} " + " ".join(rates),
+        )
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,299 @@
+"""
+Benchmarks every stage of the scan and ELA pipelines on datasets synthesized from exif_samples/ and samples/.
+The sample files are hard-linked (copied when linking isn't possible) into a nested tree of `--files` images,
+a few large resolution images are made by upscaling samples/acceptance.jpeg.
+
+Usage:
+    python -m app.devtools.bench [--files 10000] [--save bench_baseline.json]
+    python -m app.devtools.bench --compare bench_baseline.json [--threshold 0.2]
+
+The comparison fails (exit code 1) when the per-item time of a stage grows by more than `--threshold`
+"""
+import argparse
+import glob
+import itertools
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import typing as t
+
+from PIL import Image
+
+from app.cli import inspectors
+from app.cli.exif import read_exif
+from app.cli.scanner import scan_image, scan_paths
+from app.devtools.import_budget import REPO_ROOT
+from app.utils import IMAGE_EXTENSIONS, get_base_path, iter_image_paths
+
+DEFAULT_FILES = 10_000
+DEFAULT_REPEAT = 3
+DEFAULT_THRESHOLD = 0.2
+FILES_PER_DIRECTORY = 500
+LARGE_IMAGE_SIZE = (6000, 4000)
+LARGE_IMAGES = 2
+INFERENCE_BATCH_SIZE = 32
+
+# the parsed exif_samples shared by the inspector stages, filled by setup_exifs outside of the timings
+EXIFS: list[dict[str, t.Any]] = []
+INSPECTORS = ["inspect_datetime_fields", "inspect_editing_software", "inspect_copyright", "inspect_gps"]
+
+
+class Dataset(t.NamedTuple):
+    root: str
+    tree: str
+    files: int
+    exif_samples: list[str]
+    ela_samples: list[str]
+    large_images: list[str]
+
+
+def sample_files(folder: str) -> list[str]:
+    """The bundled images under the `folder` of the repository, e.g. samples/"""
+    return sorted(
+        path
+        for path in glob.glob(os.path.join(REPO_ROOT, folder, "**", "*"), recursive=True)
+        if path.lower().endswith(tuple(IMAGE_EXTENSIONS))
+    )
+
+
+def _link_or_copy(src: str, dst: str) -> None:
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def build_dataset(root: str, files: int) -> Dataset:
+    exif_samples = sample_files("exif_samples")
+    ela_samples = sample_files("samples")
+
+    tree = os.path.join(root, "tree")
+    sources = itertools.cycle(exif_samples + ela_samples)
+    for i in range(files):
+        directory = os.path.join(tree, f"d{i // FILES_PER_DIRECTORY // 10}", f"d{i // FILES_PER_DIRECTORY}")
+        if i % FILES_PER_DIRECTORY == 0:
+            os.makedirs(directory, exist_ok=True)
+        src = next(sources)
+        _link_or_copy(src, os.path.join(directory, f"{i}_{os.path.basename(src)}"))
+
+    large_images = []
+    with Image.open(os.path.join(REPO_ROOT, "samples", "acceptance.jpeg")) as image:
+        large = image.convert("RGB").resize(LARGE_IMAGE_SIZE)
+    for i in range(LARGE_IMAGES):
+        path = os.path.join(root, f"large{i}.jpg")
+        large.save(path, quality=95)
+        large_images.append(path)
+    return Dataset(root, tree, files, exif_samples, ela_samples, large_images)
+
+
+def bench_exif(dataset: Dataset) -> int:
+    for path in dataset.exif_samples:
+        read_exif(path)
+    return len(dataset.exif_samples)
+
+
+def bench_scan_image(dataset: Dataset) -> int:
+    for path in dataset.exif_samples:
+        scan_image(path)
+    return len(dataset.exif_samples)
+
+
+def setup_exifs(dataset: Dataset) -> None:
+    if not EXIFS:
+        EXIFS.extend(exif for path in dataset.exif_samples if (exif := read_exif(path)))
+
+
+def make_inspector_bench(name: str) -> t.Callable[[Dataset], int]:
+    inspector = getattr(inspectors, name)
+
+    def bench(dataset: Dataset) -> int:
+        for exif in EXIFS:
+            inspector(exif)
+        return len(EXIFS)
+
+    return bench
+
+
+def bench_walk(dataset: Dataset) -> int:
+    return sum(1 for _ in iter_image_paths(dataset.tree))
+
+
+def bench_scan_path(dataset: Dataset) -> int:
+    return sum(1 for _ in scan_paths(iter_image_paths(dataset.tree), jobs=1))
+
+
+def bench_scan_path_parallel(dataset: Dataset) -> int:
+    return sum(1 for _ in scan_paths(iter_image_paths(dataset.tree), jobs=os.cpu_count() or 1))
+
+
+def bench_ela(dataset: Dataset) -> int:
+    from app.ela_nn.ela import ela
+
+    for path in dataset.ela_samples:
+        ela(path)
+    return len(dataset.ela_samples)
+
+
+def bench_ela_large(dataset: Dataset) -> int:
+    from app.ela_nn.ela import ela
+
+    for path in dataset.large_images:
+        ela(path)
+    return len(dataset.large_images)
+
+
+def bench_model_load(dataset: Dataset) -> int:
+    import torch
+
+    from app.ela_nn.model import load_model
+
+    load_model.cache_clear()
+    load_model(get_base_path(), torch.device("cpu"))
+    return 1
+
+
+def bench_inference(dataset: Dataset) -> int:
+    import numpy as np
+    import torch
+
+    from app.ela_nn.ela import predict_batch, prepare_ela_tensor
+    from app.ela_nn.model import load_model
+
+    model = load_model(get_base_path(), torch.device("cpu"))
+    tensors = [tensor for path in dataset.ela_samples if (tensor := prepare_ela_tensor(path)) is not None]
+    batch = np.stack(list(itertools.islice(itertools.cycle(tensors), INFERENCE_BATCH_SIZE)))
+    predict_batch(batch, model, torch.device("cpu"))
+    return INFERENCE_BATCH_SIZE
+
+
+def bench_report(dataset: Dataset) -> int:
+    from app.cli.report import ReportWriter
+
+    records = [scan_image(path) for path in dataset.exif_samples]
+    with ReportWriter(os.path.join(dataset.root, "report.pdf")) as writer:
+        for record in itertools.islice(itertools.cycle(records), dataset.files):
+            writer.add(record)
+    return dataset.files
+
+
+def _model_available() -> bool:
+    from app.ela_nn.model import _model_path
+
+    return os.path.exists(_model_path(get_base_path()))
+
+
+STAGES: dict[str, t.Callable[[Dataset], int]] = {
+    "exif": bench_exif,
+    "scan_image": bench_scan_image,
+    **{name: make_inspector_bench(name) for name in INSPECTORS},
+    "walk": bench_walk,
+    "scan_path": bench_scan_path,
+    "scan_path_parallel": bench_scan_path_parallel,
+    "ela": bench_ela,
+    "ela_large": bench_ela_large,
+    "model_load": bench_model_load,
+    "inference": bench_inference,
+    "report": bench_report,
+}
+MODEL_STAGES = {"model_load", "inference"}
+# untimed, run once before the repeats of the stage
+SETUPS: dict[str, t.Callable[[Dataset], None]] = {name: setup_exifs for name in INSPECTORS}
+
+
+def run_stage(
+    stage: t.Callable[[Dataset], int],
+    dataset: Dataset,
+    repeat: int,
+    setup: t.Optional[t.Callable[[Dataset], None]] = None,
+) -> dict[str, float]:
+    if setup is not None:
+        setup(dataset)
+    timings = []
+    items = 0
+    for _ in range(repeat):
+        started = time.perf_counter()
+        items = stage(dataset)
+        timings.append(time.perf_counter() - started)
+    seconds = statistics.median(timings)
+    return {
+        "items": items,
+        "seconds": seconds,
+        "min_seconds": min(timings),
+        "per_item_us": seconds / max(items, 1) * 1e6,
+    }
+
+
+def compare(results: dict[str, t.Any], baseline: dict[str, t.Any], threshold: float) -> list[str]:
+    """Returns the descriptions of the stages whose per-item time regressed by more than `threshold`"""
+    regressions = []
+    for name, result in results["stages"].items():
+        if name not in baseline["stages"]:
+            continue
+        before, after = baseline["stages"][name]["per_item_us"], result["per_item_us"]
+        change = after / before - 1 if before else 0.0
+        marker = ""
+        if change > threshold:
+            marker = "  REGRESSION"
+            regressions.append(f"{name}: {before:.1f}us -> {after:.1f}us ({change:+.0%})")
+        print(f"{name:<26} {before:>12.1f}us {after:>12.1f}us {change:>+8.0%}{marker}")
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=DEFAULT_FILES, help="Size of the synthesized directory tree")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT, help="Runs per stage, the median is kept")
+    parser.add_argument("--stage", action="append", choices=list(STAGES), help="Only run these stages")
+    parser.add_argument("--save", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="Baseline JSON file to compare the results with")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="Allowed relative slowdown")
+    args = parser.parse_args()
+
+    stages = args.stage or list(STAGES)
+    if MODEL_STAGES & set(stages) and not _model_available():
+        print("model weights not found under ./model, skipping the model stages")
+        stages = [stage for stage in stages if stage not in MODEL_STAGES]
+
+    with tempfile.TemporaryDirectory() as root:
+        print(f"synthesizing {args.files} files ...")
+        dataset = build_dataset(root, args.files)
+        results: dict[str, t.Any] = {
+            "meta": {
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpu_count": os.cpu_count(),
+                "files": args.files,
+                "repeat": args.repeat,
+            },
+            "stages": {},
+        }
+        for name in stages:
+            result = run_stage(STAGES[name], dataset, args.repeat, SETUPS.get(name))
+            results["stages"][name] = result
+            print(
+                f"{name:<26} {result['items']:>8} items {result['seconds']:>9.3f}s "
+                f"{result['per_item_us']:>12.1f}us/item",
+            )
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print(f"\n{'stage':<26} {'baseline':>14} {'current':>14} {'change':>8}")
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} stage(s) regressed by more than {args.threshold:.0%}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,100 @@
+"""
+Builds the bundled `app/geo/countries.npz` from the Natural Earth admin 0 countries shapefile
+(e.g. ne_110m_admin_0_countries.shp, the .dbf file is expected next to it).
+
+Usage: python -m app.devtools.build_countries <path to .shp> [output path]
+"""
+import os
+import struct
+import sys
+
+import numpy as np
+import numpy.typing as npt
+
+from app.geo.geocoder import COUNTRIES_PATH
+
+SHAPE_POLYGON = 5
+NAME_FIELDS = ("NAME", "NAME_EN", "ADMIN")
+ISO_FIELDS = ("ISO_A3", "ADM0_A3")
+
+
+def read_shp_polygons(path: str) -> list[list[npt.NDArray[np.float64]]]:
+    """Returns the rings (arrays of lon, lat) of every polygon record"""
+    with open(path, "rb") as f:
+        data = f.read()
+    records: list[list[npt.NDArray[np.float64]]] = []
+    pos = 100
+    while pos + 8 <= len(data):
+        _, content_length = struct.unpack_from(">ii", data, pos)
+        content = pos + 8
+        pos = content + content_length * 2
+        (shape_type,) = struct.unpack_from("<i", data, content)
+        if shape_type != SHAPE_POLYGON:
+            records.append([])
+            continue
+        num_parts, num_points = struct.unpack_from("<ii", data, content + 36)
+        parts = list(struct.unpack_from(f"<{num_parts}i", data, content + 44)) + [num_points]
+        points = np.frombuffer(data, dtype="<f8", count=num_points * 2, offset=content + 44 + num_parts * 4)
+        points = points.reshape(-1, 2)
+        records.append([points[start:end] for start, end in zip(parts[:-1], parts[1:])])
+    return records
+
+
+def read_dbf(path: str) -> list[dict[str, str]]:
+    with open(path, "rb") as f:
+        data = f.read()
+    num_records, header_length, record_length = struct.unpack_from("<IHH", data, 4)
+    fields = []
+    pos = 32
+    while data[pos] != 0x0D:
+        name = data[pos : pos + 11].split(b"\x00", 1)[0].decode("ascii")
+        fields.append((name.upper(), data[pos + 16]))
+        pos += 32
+
+    records = []
+    for i in range(num_records):
+        pos = header_length + i * record_length + 1  # skipping the deletion flag
+        record = {}
+        for name, length in fields:
+            record[name] = data[pos : pos + length].decode("latin-1").strip()
+            pos += length
+        records.append(record)
+    return records
+
+
+def _first_field(record: dict[str, str], names: tuple[str, ...]) -> str:
+    return next((record[name] for name in names if record.get(name)), "")
+
+
+def build(shp_path: str, output_path: str) -> None:
+    polygons = read_shp_polygons(shp_path)
+    attributes = read_dbf(os.path.splitext(shp_path)[0] + ".dbf")
+
+    names: list[str] = []
+    iso_codes: list[str] = []
+    rings: list[npt.NDArray[np.float64]] = []
+    ring_country: list[int] = []
+    for rings_of_country, record in zip(polygons, attributes):
+        if not rings_of_country:
+            continue
+        ring_country.extend([len(names)] * len(rings_of_country))
+        rings.extend(rings_of_country)
+        names.append(_first_field(record, NAME_FIELDS))
+        iso_codes.append(_first_field(record, ISO_FIELDS))
+
+    np.savez_compressed(
+        output_path,
+        names=np.array(names),
+        iso_codes=np.array(iso_codes),
+        ring_offsets=np.cumsum([0] + [len(ring) for ring in rings]).astype(np.int32),
+        ring_country=np.array(ring_country, dtype=np.int32),
+        vertices=np.concatenate(rings).astype(np.float32),
+    )
+    print(f"{len(names)} countries, {len(rings)} rings are saved to {output_path}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    build(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else COUNTRIES_PATH)
@@ -0,0 +1,79 @@
+"""
+Measures the crawl + download throughput of `scan --url` against a local fixture site built from samples/.
+Every page links to the next `--fan-out` pages and embeds a few images, the same images appear on many pages
+(also under different names), so the URL and content deduplication is exercised as well.
+
+Usage: python -m app.devtools.crawl_bench [--pages 200] [--depth 5]
+"""
+import argparse
+import functools
+import glob
+import http.server
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from app.cli.downloader import Crawler, Downloader, create_session
+from app.devtools.import_budget import REPO_ROOT
+
+IMAGES_PER_PAGE = 3
+
+
+def build_site(root: str, pages: int, fan_out: int) -> int:
+    """Writes the fixture site to `root`, returns the number of distinct image files"""
+    samples = sorted(glob.glob(os.path.join(REPO_ROOT, "samples", "*.jp*g")))
+    for i, sample in enumerate(samples):
+        shutil.copy(sample, os.path.join(root, f"img{i}.jpg"))
+        # the same content under another name, only the content hash can tell it's a duplicate
+        shutil.copy(sample, os.path.join(root, f"copy{i}.jpg"))
+
+    for page in range(pages):
+        links = "".join(f'<a href="page{(page + j) % pages}.html#top">next</a>' for j in range(1, fan_out + 1))
+        images = "".join(
+            f'<img src="img{(page + j) % len(samples)}.jpg" srcset="copy{(page + j) % len(samples)}.jpg 2x">'
+            for j in range(IMAGES_PER_PAGE)
+        )
+        with open(os.path.join(root, f"page{page}.html"), "w") as f:
+            f.write(f"<html><body>{links}{images}<a href='https://example.com/'>external</a></body></html>")
+    return len(samples) * 2
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, default=200)
+    parser.add_argument("--fan-out", type=int, default=3)
+    parser.add_argument("--depth", type=int, default=100)
+    parser.add_argument("--workers", type=int, default=8)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        image_files = build_site(root, args.pages, args.fan_out)
+        handler = functools.partial(QuietHandler, directory=root)
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        start_url = f"http://127.0.0.1:{server.server_address[1]}/page0.html"
+
+        session = create_session(args.workers)
+        crawler = Crawler(session, max_depth=args.depth, max_pages=args.pages, workers=args.workers)
+        downloader = Downloader(root, session=session, workers=args.workers)
+        started = time.perf_counter()
+        downloads = list(downloader.fetch_all(crawler.crawl(start_url)))
+        elapsed = time.perf_counter() - started
+        server.shutdown()
+
+    print(f"pages crawled:      {crawler.pages_fetched} ({crawler.pages_fetched / elapsed:.0f} pages/s)")
+    print(f"image files:        {image_files}")
+    print(f"unique images:      {len(downloads)}")
+    print(f"content duplicates: {downloader.duplicates}")
+    print(f"elapsed:            {elapsed:.2f}s")
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, *args: object) -> None:
+        pass
+
+
+if __name__ == "__main__":
+    main()
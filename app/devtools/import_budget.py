@@ -0,0 +1,79 @@
+"""
+Checks that the startup path of the lightweight subcommands doesn't import the heavy dependencies.
+
+Usage: python -m app.devtools.import_budget [--budget-ms 500]
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+HEAVY_MODULES = ["torch", "matplotlib", "reportlab", "requests", "bs4", "numpy"]
+DEFAULT_BUDGET_MS = 500
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+SAMPLE_IMAGE = os.path.join(REPO_ROOT, "exif_samples", "Canon_40D.jpg")
+COMMANDS = {
+    "clean": ["clean"],
+    "scan": ["scan", "--help"],
+    # a real scan also covers the lazy imports of the command path, the PDF report is heavy by design
+    "scan (one file)": ["scan", "--path", SAMPLE_IMAGE, "--jobs", "1", "--output-format", "jsonl"],
+}
+
+
+def parse_importtime(stderr: str) -> dict[str, int]:
+    """Maps each imported module to its self import time in microseconds"""
+    result = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, _, module = line[len("import time:") :].split("|")
+        result[module.strip()] = int(self_us)
+    return result
+
+
+def measure_command(args: list[str]) -> dict[str, int]:
+    env = {**os.environ, "PYTHONPATH": REPO_ROOT}
+    # the commands are run in an empty directory, so `clean` has nothing to delete
+    with tempfile.TemporaryDirectory() as cwd:
+        process = subprocess.run(
+            [sys.executable, "-X", "importtime", "-m", "app.cli.main", *args],  # noqa: S603
+            cwd=cwd,
+            env=env,
+            capture_output=True,
+            text=True,
+            check=False,
+        )
+    if process.returncode != 0:
+        raise RuntimeError(f"`image_scan {' '.join(args)}` failed:\n{process.stderr}")
+    return parse_importtime(process.stderr)
+
+
+def find_heavy_modules(modules: dict[str, int]) -> list[str]:
+    return sorted(
+        {heavy for module in modules for heavy in HEAVY_MODULES if module == heavy or module.startswith(f"{heavy}.")},
+    )
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--budget-ms", type=int, default=DEFAULT_BUDGET_MS, help="Total import time allowed")
+    args = parser.parse_args()
+
+    failed = False
+    for name, command in COMMANDS.items():
+        modules = measure_command(command)
+        total_ms = sum(modules.values()) / 1000
+        heavy = find_heavy_modules(modules)
+        print(f"{name}: {len(modules)} modules imported in {total_ms:.0f}ms")
+        if heavy:
+            print(f"    heavy modules leaked into the startup path: {', '.join(heavy)}")
+            failed = True
+        if total_ms > args.budget_ms:
+            print(f"    import time exceeds the budget of {args.budget_ms}ms")
+            failed = True
+    return int(failed)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,112 @@
+"""
+Inference backends of `IMDModel`, the optimized variants are derived from the float32 model once per process:
+
+- fp32: the model as trained
+- fused: BatchNorm folded into the preceding conv/linear layers, channels-last convolutions
+- int8: fused, with the linear layers (most of the weights) dynamically quantized, CPU only
+- bf16: fused, with the weights and activations in bfloat16
+"""
+import copy
+import functools
+import typing as t
+
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval, fuse_linear_bn_eval
+
+from app.ela_nn.model import IMDModel, load_model, model_version
+from app.utils import InferenceBackend
+
+
+class BackendError(Exception):
+    pass
+
+
+def _fuse_sequential(sequential: nn.Sequential) -> nn.Sequential:
+    """Folds every BatchNorm into the conv/linear layer right before it"""
+    layers: list[nn.Module] = []
+    for layer in sequential:
+        previous = layers[-1] if layers else None
+        if isinstance(layer, nn.BatchNorm2d) and isinstance(previous, nn.Conv2d):
+            layers[-1] = fuse_conv_bn_eval(previous, layer)
+        elif isinstance(layer, nn.BatchNorm1d) and isinstance(previous, nn.Linear):
+            layers[-1] = fuse_linear_bn_eval(previous, layer)
+        else:
+            layers.append(layer)
+    return nn.Sequential(*layers)
+
+
+def fuse_model(model: IMDModel) -> IMDModel:
+    fused = copy.deepcopy(model).eval()
+    fused.down_conv1 = _fuse_sequential(fused.down_conv1)
+    fused.down_conv2 = _fuse_sequential(fused.down_conv2)
+    fused.linear = _fuse_sequential(fused.linear)
+    return fused
+
+
+class OptimizedModel(nn.Module):
+    """Converts the inputs to the memory format and dtype of the wrapped model, the outputs are float32"""
+
+    def __init__(self, model: nn.Module, dtype: torch.dtype = torch.float32, channels_last: bool = False) -> None:
+        super().__init__()
+        self.model = model
+        self.dtype = dtype
+        self.memory_format = torch.channels_last if channels_last else torch.contiguous_format
+
+    def forward(self, img: torch.Tensor) -> torch.Tensor:
+        out: torch.Tensor = self.model(img.to(dtype=self.dtype, memory_format=self.memory_format))
+        return out.float()
+
+
+def is_bf16_supported(device: torch.device) -> bool:
+    if device.type == "cuda":
+        return bool(torch.cuda.is_bf16_supported())
+    # `mkldnn.is_available` isn't annotated in torch
+    mkldnn = torch.backends.mkldnn.is_available()  # type: ignore[no-untyped-call]
+    return bool(mkldnn and torch.ops.mkldnn._is_mkldnn_bf16_supported())
+
+
+def select_device(backend: InferenceBackend) -> torch.device:
+    # the dynamically quantized kernels only exist for the CPU
+    if backend != InferenceBackend.INT8 and torch.cuda.is_available():
+        return torch.device("cuda")
+    return torch.device("cpu")
+
+
+def backend_version(base_path: str, backend: InferenceBackend) -> str:
+    """`model_version` of the backend, the reduced precision backends may give different verdicts"""
+    version = model_version(base_path)
+    return version if backend == InferenceBackend.FP32 else f"{version}:{backend.value}"
+
+
+def set_threads(threads: t.Optional[int]) -> None:
+    """Sets the number of intra-op threads, `None` keeps the torch default (the number of cores)"""
+    if threads is not None:
+        torch.set_num_threads(threads)
+
+
+def check_backend(device: torch.device, backend: InferenceBackend) -> None:
+    if backend == InferenceBackend.INT8 and device.type != "cpu":
+        raise BackendError("the int8 backend is only available on the CPU")
+    if backend == InferenceBackend.BF16 and not is_bf16_supported(device):
+        raise BackendError(f"bfloat16 is not supported on this {device.type.upper()}")
+
+
+@functools.cache
+def load_backend_model(base_path: str, device: torch.device, backend: InferenceBackend) -> nn.Module:
+    check_backend(device, backend)
+    model = load_model(base_path, device)
+    if backend == InferenceBackend.FP32:
+        return model
+
+    fused = fuse_model(model).to(memory_format=torch.channels_last)
+    if backend == InferenceBackend.FUSED:
+        return OptimizedModel(fused, channels_last=True).eval()
+    if backend == InferenceBackend.INT8:
+        quantized = torch.ao.quantization.quantize_dynamic(  # type: ignore[no-untyped-call]
+            fused,
+            {nn.Linear},
+            dtype=torch.qint8,
+        )
+        return OptimizedModel(quantized, channels_last=True).eval()
+    return OptimizedModel(fused.to(dtype=torch.bfloat16), dtype=torch.bfloat16, channels_last=True).eval()
@@ -1,48 +1,294 @@
+import collections
+import contextlib
+import io
+import itertools
 import os
+import tempfile
+import typing as t
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
 
 import numpy as np
+import numpy.typing as npt
 import PIL.Image
-import rich
 import torch
 from PIL import Image, ImageChops
 
-from app.ela_nn.model import IMDModel
-from app.utils import get_base_path, TMP_FOLDER
+from app import profiling
+from app.cli.cache import ELA, ScanCache
+from app.cli.records import ElaRecord
+from app.ela_nn.backends import backend_version, load_backend_model, select_device
+from app.ela_nn.features import FeatureStore
+from app.utils import DEFAULT_BATCH_SIZE, WORKSPACE_PREFIX, InferenceBackend, get_base_path, print_prediction
 
+if t.TYPE_CHECKING:
+    from app.cli.outputs import RecordWriter
 
-def infer(img_path: str, model: IMDModel, device: torch.device) -> None:
-    ela(img_path=img_path)
+ELA_QUALITY = 90
+ELA_SCALE = 10
+ELA_INPUT_SIZE = (128, 128)
+# paths per task submitted to the pool
+PREPARE_CHUNK_SIZE = 4
+# batches of inputs prepared ahead of the model, bounds the memory held by those it hasn't consumed yet
+PREPARE_BATCHES_AHEAD = 2
 
-    img = Image.open(f"{TMP_FOLDER}/ela_img.jpg")
-    img = img.resize((128, 128))
-    img = np.array(img, dtype=np.float32).transpose(2, 0, 1) / 255.0
-    img = np.expand_dims(img, axis=0)
+# model inputs in [0, 1], a 3x128x128 image or an Nx3x128x128 batch of them
+ElaTensor = npt.NDArray[np.float32]
 
-    out = model(torch.from_numpy(img).to(device=device))
-    y_pred = torch.max(out, dim=1)[1]
 
-    print("Prediction:", end=" ")
-    rich.print("[green]Authentic[/green]" if y_pred else "[red]Tampered[/red]")
+def prepare_ela_input(ela_img: npt.NDArray[np.uint8]) -> ElaTensor:
+    """Turns an HxWx3 uint8 ELA image into the 3x128x128 float32 array the model expects"""
+    with profiling.stage("ela.resize"):
+        img = Image.fromarray(ela_img).resize(ELA_INPUT_SIZE)
+        return np.ascontiguousarray(np.asarray(img, dtype=np.float32).transpose(2, 0, 1)) / 255.0
 
 
-def ela(img_path: str) -> None:
-    temp = "temp.jpg"
-    scale = 10
-    original = PIL.Image.open(img_path)
-    original.save(temp, quality=90)
-    temporary = PIL.Image.open(temp)
-    diff = ImageChops.difference(original, temporary)
-    d = diff.load()
-    width, height = diff.size
-    for x in range(width):
-        for y in range(height):
-            d[x, y] = tuple(k * scale for k in d[x, y])
+def ela(img_path: t.Union[str, t.BinaryIO]) -> npt.NDArray[np.uint8]:
+    """
+    Error Level Analysis done fully in memory: the image is recompressed into a buffer
+    and the scaled difference is computed with array ops. Takes a path or an already read file object
+    """
+    with profiling.stage("ela.decode"):
+        original = Image.open(img_path).convert("RGB")
+    if profiling.is_enabled() and isinstance(img_path, str):
+        profiling.add_bytes("ela.decode", os.path.getsize(img_path))
+    with profiling.stage("ela.recompress"):
+        buffer = io.BytesIO()
+        original.save(buffer, format="JPEG", quality=ELA_QUALITY)
+        buffer.seek(0)
+        recompressed = Image.open(buffer).convert("RGB")
 
-    diff.save(TMP_FOLDER + "/ela_img.jpg")
+    with profiling.stage("ela.diff"):
+        diff = np.abs(np.asarray(original, dtype=np.int16) - np.asarray(recompressed, dtype=np.int16))
+        scaled: npt.NDArray[np.uint8] = np.minimum(diff * ELA_SCALE, 255).astype(np.uint8)
+        return scaled
 
 
-def check_ela(path: str) -> None:
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    model_path = f"{get_base_path()}/model/model_c1.pth"
-    model = torch.load(model_path, map_location=torch.device("cpu"))
-    infer(model=model, img_path=path, device=device)
+def ela_reference(img_path: t.Union[str, t.BinaryIO]) -> npt.NDArray[np.uint8]:
+    """
+    Original per-pixel ELA going through `temp.jpg` and `ela_img.jpg` on disk,
+    kept to check that `ela` produces matching results. Every call works in its own temporary folder
+    """
+    with tempfile.TemporaryDirectory(prefix=f"{WORKSPACE_PREFIX}{os.getpid()}_") as folder:
+        temp = os.path.join(folder, "temp.jpg")
+        original = PIL.Image.open(img_path)
+        original.save(temp, quality=ELA_QUALITY)
+        temporary = PIL.Image.open(temp)
+        diff = ImageChops.difference(original, temporary)
+        d = diff.load()
+        width, height = diff.size
+        for x in range(width):
+            for y in range(height):
+                d[x, y] = tuple(k * ELA_SCALE for k in d[x, y])
+
+        diff.save(os.path.join(folder, "ela_img.jpg"))
+        return np.asarray(Image.open(os.path.join(folder, "ela_img.jpg")).convert("RGB"))
+
+
+def prepare_ela_tensor(img_path: t.Union[str, t.BinaryIO], reference: bool = False) -> t.Optional[ElaTensor]:
+    try:
+        ela_img = ela_reference(img_path=img_path) if reference else ela(img_path=img_path)
+        return prepare_ela_input(ela_img)
+    except Exception:
+        return None
+
+
+def predict_batch(batch: ElaTensor, model: torch.nn.Module, device: torch.device) -> list[bool]:
+    """Runs an Nx3x128x128 batch through the model, True means the image is authentic"""
+    profiling.add_bytes("inference", batch.nbytes)
+    with profiling.stage("inference"), torch.inference_mode():
+        out = model(torch.from_numpy(batch).to(device=device))
+        return (torch.max(out, dim=1)[1] == 1).tolist()
+
+
+def feature_version(reference: bool = False) -> str:
+    """Identifies the ELA parameters the model inputs are computed with"""
+    width, height = ELA_INPUT_SIZE
+    return f"q{ELA_QUALITY}:s{ELA_SCALE}:{width}x{height}" + (":reference" if reference else "")
+
+
+def open_feature_store(folder: str, reference: bool = False) -> FeatureStore:
+    width, height = ELA_INPUT_SIZE
+    return FeatureStore(folder, feature_version(reference), (3, height, width))
+
+
+def prepare_ela_tensors(paths: list[str], reference: bool = False) -> list[t.Optional[ElaTensor]]:
+    return [prepare_ela_tensor(path, reference) for path in paths]
+
+
+def _prepare_on_pool(
+    paths: list[str],
+    executor: Executor,
+    reference: bool,
+    in_flight: int,
+) -> t.Iterator[t.Optional[ElaTensor]]:
+    """Only `in_flight` chunks are submitted at a time, so the inputs don't pile up when the model is slower"""
+    chunks = (paths[start : start + PREPARE_CHUNK_SIZE] for start in range(0, len(paths), PREPARE_CHUNK_SIZE))
+    pending: collections.deque[Future[tuple[list[t.Optional[ElaTensor]], t.Optional[profiling.Samples]]]]
+    pending = collections.deque()
+
+    def submit(chunk: list[str]) -> None:
+        pending.append(executor.submit(profiling.collect, prepare_ela_tensors, chunk, reference))
+
+    def results() -> t.Iterator[tuple[list[t.Optional[ElaTensor]], t.Optional[profiling.Samples]]]:
+        while pending:
+            future = pending.popleft()
+            if next_chunk := next(chunks, None):
+                submit(next_chunk)
+            yield future.result()
+
+    for chunk in itertools.islice(chunks, in_flight):
+        submit(chunk)
+    for tensors in profiling.merged(results()):
+        yield from tensors
+
+
+def _prepare_tensors(
+    paths: list[str],
+    executor: t.Optional[Executor],
+    reference: bool,
+    batch_size: int,
+) -> t.Iterator[t.Optional[ElaTensor]]:
+    if executor is None:
+        return (prepare_ela_tensor(path, reference) for path in paths)
+    in_flight = max(1, batch_size * PREPARE_BATCHES_AHEAD // PREPARE_CHUNK_SIZE)
+    return _prepare_on_pool(paths, executor, reference, in_flight)
+
+
+def iter_predictions(
+    paths: list[str],
+    model: torch.nn.Module,
+    device: torch.device,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    executor: t.Optional[Executor] = None,
+    reference: bool = False,
+    features: t.Optional[FeatureStore] = None,
+) -> t.Iterator[tuple[str, t.Optional[bool]]]:
+    """
+    Yields (path, is_authentic) in the order of `paths`, `None` is yielded for the files that can't be analysed.
+    ELA inputs are prepared on the `executor` (in the current process if it's not given) while the model
+    consumes them in batches of `batch_size`, at most PREPARE_BATCHES_AHEAD batches ahead. The inputs found
+    in the `features` store are not prepared again, the prepared ones are added to it
+    """
+    tensors: t.Iterable[t.Optional[ElaTensor]]
+    if features is None:
+        tensors = _prepare_tensors(paths, executor, reference, batch_size)
+    else:
+        stored = features.lookup(paths)
+        prepared = _prepare_tensors([path for path in paths if path not in stored], executor, reference, batch_size)
+        tensors = (
+            features.get(stored[path]) if path in stored else features.add(path, next(prepared)) for path in paths
+        )
+
+    items = zip(paths, tensors)
+    while chunk := list(itertools.islice(items, batch_size)):
+        valid = [(path, tensor) for path, tensor in chunk if tensor is not None]
+        verdicts = {}
+        if valid:
+            batch = np.stack([tensor for _, tensor in valid])
+            verdicts = dict(zip([path for path, _ in valid], predict_batch(batch, model, device)))
+        for path, _ in chunk:
+            yield path, verdicts.get(path)
+
+
+class ElaScorer:
+    """Scores the prepared ELA inputs in batches, the model is loaded on the first use"""
+
+    def __init__(
+        self,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        backend: InferenceBackend = InferenceBackend.FP32,
+    ) -> None:
+        self.batch_size = batch_size
+        self.backend = backend
+        self.device = select_device(backend)
+        self.version = backend_version(get_base_path(), backend)
+        self._model: t.Optional[torch.nn.Module] = None
+
+    @property
+    def model(self) -> torch.nn.Module:
+        if self._model is None:
+            with profiling.stage("model.load"):
+                self._model = load_backend_model(get_base_path(), self.device, self.backend)
+        return self._model
+
+    def score(self, tensors: t.Sequence[t.Optional[ElaTensor]]) -> list[t.Optional[bool]]:
+        """Returns is_authentic of every tensor, `None` for the missing ones"""
+        verdicts: list[t.Optional[bool]] = [None] * len(tensors)
+        valid = [(i, tensor) for i, tensor in enumerate(tensors) if tensor is not None]
+        for start in range(0, len(valid), self.batch_size):
+            indices, batch = zip(*valid[start : start + self.batch_size])
+            for i, verdict in zip(indices, predict_batch(np.stack(batch), self.model, self.device)):
+                verdicts[i] = verdict
+        return verdicts
+
+
+def check_ela(
+    paths: list[str],
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    workers: int = 0,
+    reference: bool = False,
+    cache: t.Optional[ScanCache] = None,
+    output: t.Optional["RecordWriter"] = None,
+    features: t.Optional[FeatureStore] = None,
+    backend: InferenceBackend = InferenceBackend.FP32,
+) -> None:
+    version = backend_version(get_base_path(), backend) + (":reference" if reference else "")
+    cached: dict[str, bool] = {}
+    if cache is not None:
+        cached = {path: verdict for path in paths if (verdict := cache.get(ELA, path, version)) is not None}
+    misses = [path for path in paths if path not in cached]
+    # the model is only loaded when there is something to analyse
+    device = select_device(backend)
+    model = None
+    if misses:
+        with profiling.stage("model.load"):
+            model = load_backend_model(get_base_path(), device, backend)
+
+    with contextlib.ExitStack() as stack:
+        executor = None
+        if workers > 1 and len(misses) > 1:
+            executor = stack.enter_context(
+                ProcessPoolExecutor(
+                    max_workers=workers,
+                    initializer=profiling.init_worker,
+                    initargs=(profiling.is_enabled(),),
+                ),
+            )
+        predictions: t.Iterator[tuple[str, t.Optional[bool]]] = iter(())
+        if model is not None:
+            predictions = iter_predictions(
+                misses,
+                model,
+                device,
+                batch_size,
+                executor=executor,
+                reference=reference,
+                features=features,
+            )
+
+        is_authentic: t.Optional[bool]
+        for path in paths:
+            if path in cached:
+                is_authentic = cached[path]
+            else:
+                _, is_authentic = next(predictions)
+                if cache is not None and is_authentic is not None:
+                    cache.put(ELA, path, version, is_authentic)
+            print_prediction(path, is_authentic)
+            if output is not None:
+                output.add(ElaRecord(path, is_authentic))
+
+
+def rescore_features(
+    features: FeatureStore,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    output: t.Optional["RecordWriter"] = None,
+    backend: InferenceBackend = InferenceBackend.FP32,
+) -> None:
+    """Scores all the images of the `features` store, the stored batches are fed to the model without copying"""
+    scorer = ElaScorer(batch_size, backend)
+    for paths, batch in features.iter_batches(batch_size):
+        for path, is_authentic in zip(paths, predict_batch(batch, scorer.model, scorer.device)):
+            print_prediction(path, is_authentic)
+            if output is not None:
+                output.add(ElaRecord(path, is_authentic))
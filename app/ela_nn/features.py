@@ -0,0 +1,160 @@
+"""
+ELA feature store, keeps the prepared 3x128x128 float32 model inputs of a dataset in a memory-mapped array
+so the images can be scored again (e.g. by a newer model) without recompressing them.
+
+The store is a folder holding `features.f32`, the raw row-major array, and the SQLite `index.db` mapping every
+image path and its fingerprint (device, inode, size, mtime) to its row
+"""
+import os
+import sqlite3
+import typing as t
+
+import numpy as np
+import numpy.typing as npt
+
+from app.cli.cache import LOCK_TIMEOUT
+
+FEATURES_FILE = "features.f32"
+INDEX_FILE = "index.db"
+INITIAL_CAPACITY = 1024
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS features (
+    path TEXT PRIMARY KEY,
+    device INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    version TEXT NOT NULL,
+    slot INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS features_slot ON features (slot);
+"""
+
+
+class FeatureStore:
+    """
+    Rows of the new images are appended to the array file, a changed image overwrites its own row.
+    `version` identifies the ELA parameters the features were computed with, rows of other versions are ignored.
+    Several runs can add to one store, the rows are claimed under the index write lock
+    """
+
+    def __init__(self, folder: str, version: str, row_shape: tuple[int, ...]) -> None:
+        os.makedirs(folder, exist_ok=True)
+        self.version = version
+        self.row_shape = row_shape
+        self.row_size = int(np.prod(row_shape))
+        self.path = os.path.join(folder, FEATURES_FILE)
+        self.connection = sqlite3.connect(os.path.join(folder, INDEX_FILE), timeout=LOCK_TIMEOUT)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(_SCHEMA)
+        self.capacity = 0
+        self.rows: t.Optional[np.memmap[t.Any, np.dtype[np.float32]]] = None
+        self._map(max(self._slot_count(), INITIAL_CAPACITY))
+
+    def __enter__(self) -> "FeatureStore":
+        return self
+
+    def __exit__(self, *args: t.Any) -> None:
+        self.close()
+
+    def _map(self, capacity: int) -> None:
+        """(Re)maps the array file, growing it to hold `capacity` rows"""
+        if self.rows is not None:
+            self.rows.flush()
+        size = capacity * self.row_size * np.dtype(np.float32).itemsize
+        with open(self.path, "ab") as f:
+            if f.tell() < size:
+                f.truncate(size)
+        self.capacity = capacity
+        # a writable map, torch.from_numpy warns about the read-only arrays
+        self.rows = np.memmap(self.path, dtype=np.float32, mode="r+", shape=(capacity, *self.row_shape))
+
+    def _slot_count(self) -> int:
+        """Number of the rows claimed so far, also by the other runs"""
+        (max_slot,) = self.connection.execute("SELECT MAX(slot) FROM features").fetchone()
+        return 0 if max_slot is None else int(max_slot) + 1
+
+    def _ensure_capacity(self, rows: int) -> None:
+        # the other runs may have grown the file since it was mapped
+        if rows > self.capacity:
+            self._map(max(rows, self.capacity * 2))
+
+    def _fingerprint(self, path: str) -> t.Optional[tuple[int, int, int, int]]:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def lookup(self, paths: t.Iterable[str]) -> dict[str, int]:
+        """Rows of the `paths` whose stored features are still valid"""
+        result = {}
+        for path in paths:
+            row = self.connection.execute(
+                "SELECT device, inode, size, mtime_ns, version, slot FROM features WHERE path = ?",
+                (path,),
+            ).fetchone()
+            if row and row[:5] == (*(self._fingerprint(path) or ()), self.version):
+                result[path] = row[5]
+        return result
+
+    def get(self, slot: int) -> npt.NDArray[np.float32]:
+        self._ensure_capacity(slot + 1)
+        assert self.rows is not None
+        row: npt.NDArray[np.float32] = self.rows[slot]
+        return row
+
+    def add(
+        self,
+        path: str,
+        features: t.Optional[npt.NDArray[np.float32]],
+    ) -> t.Optional[npt.NDArray[np.float32]]:
+        """Stores the features of the image, returns them for convenience"""
+        if features is None or (fingerprint := self._fingerprint(path)) is None:
+            return features
+        # the slot is picked and recorded in one write transaction, so the concurrent runs never share a row
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            row = self.connection.execute("SELECT slot FROM features WHERE path = ?", (path,)).fetchone()
+            slot = row[0] if row else self._slot_count()
+            self._ensure_capacity(slot + 1)
+            assert self.rows is not None
+            self.rows[slot] = features
+            self.connection.execute(
+                "INSERT OR REPLACE INTO features VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (path, *fingerprint, self.version, slot),
+            )
+        return features
+
+    def iter_batches(self, batch_size: int) -> t.Iterator[tuple[list[str], npt.NDArray[np.float32]]]:
+        """
+        Yields (paths, features) of all the valid rows in the storage order. The features are views of
+        contiguous row ranges of the memory map, so they can be passed to `torch.from_numpy` without copying
+        """
+        count = self._slot_count()
+        self._ensure_capacity(count)
+        assert self.rows is not None
+        for start in range(0, count, batch_size):
+            end = min(start + batch_size, count)
+            entries = self.connection.execute(
+                "SELECT path, slot FROM features WHERE version = ? AND slot >= ? AND slot < ? ORDER BY slot",
+                (self.version, start, end),
+            ).fetchall()
+            if not entries:
+                continue
+            first, last = entries[0][1], entries[-1][1] + 1
+            batch = self.rows[first:last]
+            if len(entries) != last - first:
+                # rows of the other versions are skipped
+                batch = batch[[slot - first for _, slot in entries]]
+            yield [path for path, _ in entries], batch
+
+    def commit(self) -> None:
+        assert self.rows is not None
+        self.rows.flush()
+        self.connection.commit()
+
+    def close(self) -> None:
+        self.commit()
+        self.connection.close()
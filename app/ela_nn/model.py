@@ -1,7 +1,17 @@
 # importing libs
+import functools
+import os
+import pickle
+import types
+import typing as t
 
+import torch
 import torch.nn as nn
 
+MODEL_FOLDER = "model"
+MODEL_WEIGHTS_NAME = "model_c1_weights.pt"
+LEGACY_MODEL_NAME = "model_c1.pth"
+
 
 # auth -> 1 and tp -> 0
 class IMDModel(nn.Module):
@@ -37,7 +47,68 @@ class IMDModel(nn.Module):
         d1 = self.down_conv1(img)
         d2 = self.down_conv2(d1)
 
-        d2 = d2.view(-1, d2.shape[1] * d2.shape[2] * d2.shape[3])
+        # unlike `view` works for the channels-last activations as well
+        d2 = torch.flatten(d2, start_dim=1)
         out = self.linear(d2)
 
         return out
+
+
+class _LegacyUnpickler(pickle.Unpickler):
+    # the legacy checkpoint was pickled with the class living in `__main__`, which is why the console script
+    # used to be patched with the `IMDModel` import
+    def find_class(self, module: str, name: str) -> t.Any:
+        if name == IMDModel.__name__:
+            return IMDModel
+        return super().find_class(module, name)
+
+
+_legacy_pickle_module = types.SimpleNamespace(
+    __name__="pickle",
+    Unpickler=_LegacyUnpickler,
+    load=lambda f, **kwargs: _LegacyUnpickler(f, **kwargs).load(),
+)
+
+
+def load_legacy_model(path: str) -> IMDModel:
+    """Loads the fully pickled `IMDModel` module, e.g. `model/model_c1.pth`"""
+    model: IMDModel = torch.load(path, map_location="cpu", pickle_module=_legacy_pickle_module, weights_only=False)
+    return model
+
+
+def convert_model(src: str, dst: str) -> None:
+    """Converts the legacy pickled module into the weights-only state dict format"""
+    model = load_legacy_model(src)
+    torch.save(model.state_dict(), dst)
+
+
+def _model_path(base_path: str) -> str:
+    weights_path = os.path.join(base_path, MODEL_FOLDER, MODEL_WEIGHTS_NAME)
+    if os.path.exists(weights_path):
+        return weights_path
+    return os.path.join(base_path, MODEL_FOLDER, LEGACY_MODEL_NAME)
+
+
+def model_version(base_path: str) -> str:
+    """Identifies the model file `load_model` picks, used to invalidate the cached verdicts"""
+    path = _model_path(base_path)
+    stat = os.stat(path)
+    return f"{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+@functools.cache
+def load_model(base_path: str, device: torch.device) -> IMDModel:
+    """
+    Loads the model once per process, preferring the weights-only state dict which is memory-mapped instead of
+    being read and unpickled. Falls back to the legacy pickled module when the weights file is missing
+    """
+    path = _model_path(base_path)
+    if path.endswith(MODEL_WEIGHTS_NAME):
+        state_dict = torch.load(path, map_location="cpu", weights_only=True, mmap=True)
+        # parameters are created without storage and then take over the memory-mapped tensors
+        with torch.device("meta"):
+            model = IMDModel()
+        model.load_state_dict(state_dict, assign=True)
+    else:
+        model = load_legacy_model(path)
+    return model.to(device=device).eval()
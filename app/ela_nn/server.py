@@ -0,0 +1,210 @@
+"""
+ELA daemon keeping the model warm between the analyses. The HTTP API is served either on a Unix socket
+or on a localhost TCP port:
+
+    POST /analyze {"paths": ["/abs/image.jpg", ...]}
+        -> {"version": "...", "results": [{"path": "/abs/image.jpg", "is_authentic": true}, ...]}
+    GET /health -> {"version": "...", "backend": "..."}
+
+The request handlers prepare the ELA inputs in parallel, the inputs of the concurrent requests are coalesced
+into micro-batches which are run through the model once `batch_size` inputs are queued or `max_delay` passes
+"""
+import http.server
+import json
+import os
+import queue
+import socket
+import socketserver
+import stat
+import threading
+import time
+import typing as t
+from concurrent.futures import Future
+
+import numpy as np
+
+from app.ela_nn.ela import ElaScorer, ElaTensor, predict_batch, prepare_ela_tensor
+
+DEFAULT_MAX_DELAY = 0.01
+MAX_REQUEST_SIZE = 2**24
+
+_Item = tuple[ElaTensor, "Future[bool]"]
+
+
+class MicroBatcher:
+    def __init__(self, scorer: ElaScorer, max_delay: float = DEFAULT_MAX_DELAY) -> None:
+        self.scorer = scorer
+        self.max_delay = max_delay
+        self.queue: queue.Queue[t.Optional[_Item]] = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+        self.thread.start()
+
+    def submit(self, tensor: ElaTensor) -> "Future[bool]":
+        future: Future[bool] = Future()
+        self.queue.put((tensor, future))
+        return future
+
+    def _collect(self, first: _Item) -> tuple[list[_Item], bool]:
+        """Waits for the batch to fill up until the deadline, also returns whether the batcher was closed"""
+        items = [first]
+        deadline = time.monotonic() + self.max_delay
+        while len(items) < self.scorer.batch_size:
+            try:
+                item = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                break
+            if item is None:
+                return items, True
+            items.append(item)
+        return items, False
+
+    def _run(self) -> None:
+        closed = False
+        while not closed and (first := self.queue.get()) is not None:
+            items, closed = self._collect(first)
+            try:
+                batch = np.stack([tensor for tensor, _ in items])
+                verdicts = predict_batch(batch, self.scorer.model, self.scorer.device)
+            except Exception as e:
+                for _, future in items:
+                    future.set_exception(e)
+                continue
+            for (_, future), verdict in zip(items, verdicts):
+                future.set_result(verdict)
+
+    def close(self) -> None:
+        self.queue.put(None)
+        self.thread.join()
+
+
+class ElaRequestHandler(http.server.BaseHTTPRequestHandler):
+    server: "ElaServer"
+
+    def log_message(self, format: str, *args: t.Any) -> None:  # noqa: A002
+        pass
+
+    def _send_json(self, status: int, body: dict[str, t.Any]) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self) -> None:  # noqa: N802
+        if self.path != "/health":
+            self._send_json(404, {"error": "not found"})
+            return
+        scorer = self.server.batcher.scorer
+        self._send_json(200, {"version": scorer.version, "backend": scorer.backend.value})
+
+    def do_POST(self) -> None:  # noqa: N802
+        if self.path != "/analyze":
+            self._send_json(404, {"error": "not found"})
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        if length > MAX_REQUEST_SIZE:
+            self._send_json(413, {"error": "request too large"})
+            return
+        try:
+            paths = json.loads(self.rfile.read(length))["paths"]
+            if not isinstance(paths, list) or not all(isinstance(path, str) for path in paths):
+                raise ValueError
+        except (ValueError, KeyError, TypeError):
+            self._send_json(400, {"error": 'expected {"paths": ["/path/to/image.jpg", ...]}'})
+            return
+
+        futures = []
+        for path in paths:
+            tensor = prepare_ela_tensor(path) if os.path.isfile(path) else None
+            futures.append(None if tensor is None else self.server.batcher.submit(tensor))
+        try:
+            results = [
+                {"path": path, "is_authentic": None if future is None else future.result()}
+                for path, future in zip(paths, futures)
+            ]
+        except Exception as e:
+            self._send_json(500, {"error": str(e)})
+            return
+        self._send_json(200, {"version": self.server.batcher.scorer.version, "results": results})
+
+
+class ElaServerMixin(socketserver.ThreadingMixIn):
+    daemon_threads = True
+    # the per-file clients connect all at once, the default backlog of 5 refuses them
+    request_queue_size = 1024
+    batcher: MicroBatcher
+
+
+class ElaHttpServer(ElaServerMixin, http.server.HTTPServer):
+    pass
+
+
+class ElaUnixServer(ElaServerMixin, socketserver.UnixStreamServer):
+    def __init__(self, socket_path: str, handler: type[socketserver.BaseRequestHandler]) -> None:
+        super().__init__(socket_path, handler)
+        self.socket_path = socket_path
+
+    def get_request(self) -> tuple[t.Any, t.Any]:
+        # BaseHTTPRequestHandler expects a (host, port) client address
+        request, _ = super().get_request()
+        return request, ("local", 0)
+
+
+ElaServer = t.Union[ElaHttpServer, ElaUnixServer]
+
+
+class SocketInUseError(Exception):
+    pass
+
+
+def _remove_stale_socket(path: str) -> None:
+    """Removes the socket left by a killed daemon, the one a daemon still listens on is kept"""
+    try:
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            return
+    except FileNotFoundError:
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+        try:
+            probe.connect(path)
+        except ConnectionRefusedError:
+            os.remove(path)
+            return
+        except FileNotFoundError:
+            return
+    raise SocketInUseError(f"another server is listening on {path}")
+
+
+def create_server(
+    scorer: ElaScorer,
+    socket_path: t.Optional[str] = None,
+    host: str = "127.0.0.1",
+    port: int = 0,
+    max_delay: float = DEFAULT_MAX_DELAY,
+) -> ElaServer:
+    """
+    Loads the model and binds the Unix socket if `socket_path` is given, the TCP `host`:`port` otherwise.
+    Raises SocketInUseError if another server listens on the socket
+    """
+    _ = scorer.model
+    server: ElaServer
+    if socket_path is not None:
+        _remove_stale_socket(socket_path)
+        server = ElaUnixServer(socket_path, ElaRequestHandler)
+    else:
+        server = ElaHttpServer((host, port), ElaRequestHandler)
+    server.batcher = MicroBatcher(scorer, max_delay)
+    return server
+
+
+def serve_forever(server: ElaServer) -> None:
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.batcher.close()
+        if isinstance(server, ElaUnixServer):
+            os.remove(server.socket_path)
@@ -0,0 +1,194 @@
+"""
+Tiled ELA for the large images. Instead of recompressing the whole image and shrinking the difference
+to the 128x128 model input, every tile is recompressed and scored on its own, which keeps the local detail
+and gives a tamper probability per region. Besides the decoded image only the tiles being prepared are held
+in memory.
+
+The tiles are aligned to the 16px JPEG MCU grid, so the ELA of a tile matches the same region
+of the whole image ELA
+"""
+import contextlib
+import hashlib
+import io
+import itertools
+import math
+import os
+import typing as t
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import numpy.typing as npt
+import torch
+from PIL import Image
+
+from app import profiling
+from app.cli.records import TiledElaRecord
+from app.ela_nn.ela import ELA_QUALITY, ELA_SCALE, ElaTensor, prepare_ela_input
+from app.utils import DEFAULT_TILE_FRACTION, DEFAULT_TILE_SIZE, DEFAULT_TILE_THRESHOLD, print_prediction
+
+if t.TYPE_CHECKING:
+    from app.cli.outputs import RecordWriter
+    from app.ela_nn.ela import ElaScorer
+
+TILE_ALIGNMENT = 16
+HEATMAP_SIZE = (1024, 1024)
+# the edge tiles narrower than this are merged into their neighbour
+MIN_TILE_SIZE = 64
+
+Box = tuple[int, int, int, int]
+
+
+def _tile_edges(length: int, tile_size: int) -> list[int]:
+    edges = list(range(0, length, tile_size)) + [length]
+    if len(edges) > 2 and edges[-1] - edges[-2] < MIN_TILE_SIZE:
+        del edges[-2]
+    return edges
+
+
+def tile_grid(size: tuple[int, int], tile_size: int = DEFAULT_TILE_SIZE) -> list[list[Box]]:
+    """Rows of the (left, upper, right, lower) tile boxes covering the image of `size`"""
+    if tile_size % TILE_ALIGNMENT:
+        raise ValueError(f"the tile size has to be a multiple of {TILE_ALIGNMENT}")
+    width, height = size
+    xs, ys = _tile_edges(width, tile_size), _tile_edges(height, tile_size)
+    return [
+        [(left, upper, right, lower) for left, right in itertools.pairwise(xs)]
+        for upper, lower in itertools.pairwise(ys)
+    ]
+
+
+def ela_tile(image: Image.Image, box: Box) -> npt.NDArray[np.uint8]:
+    """
+    ELA of the `box` region of the RGB image, see `app.ela_nn.ela.ela`. The decoder interpolates the chroma
+    across the block edges, so the region is recompressed with a one MCU margin which is cropped afterwards
+    """
+    left, upper, right, lower = box
+    width, height = image.size
+    halo = (
+        max(left - TILE_ALIGNMENT, 0),
+        max(upper - TILE_ALIGNMENT, 0),
+        min(right + TILE_ALIGNMENT, width),
+        min(lower + TILE_ALIGNMENT, height),
+    )
+    original = image.crop(halo)
+    with profiling.stage("ela.recompress"):
+        buffer = io.BytesIO()
+        original.save(buffer, format="JPEG", quality=ELA_QUALITY)
+        buffer.seek(0)
+        recompressed = Image.open(buffer).convert("RGB")
+    with profiling.stage("ela.diff"):
+        diff = np.abs(np.asarray(original, dtype=np.int16) - np.asarray(recompressed, dtype=np.int16))
+        diff = diff[upper - halo[1] : lower - halo[1], left - halo[0] : right - halo[0]]
+        scaled: npt.NDArray[np.uint8] = np.minimum(diff * ELA_SCALE, 255).astype(np.uint8)
+        return scaled
+
+
+def predict_tamper_probabilities(
+    batch: ElaTensor,
+    model: torch.nn.Module,
+    device: torch.device,
+) -> npt.NDArray[np.float32]:
+    """Probability of the tampered class (0) for every input of the Nx3x128x128 batch"""
+    profiling.add_bytes("inference", batch.nbytes)
+    with profiling.stage("inference"), torch.inference_mode():
+        out = model(torch.from_numpy(batch).to(device=device))
+        probabilities: npt.NDArray[np.float32] = out[:, 0].float().cpu().numpy()
+        return probabilities
+
+
+def open_rgb(path: str) -> Image.Image:
+    with profiling.stage("ela.decode"):
+        image = Image.open(path)
+        image.load()
+    # `convert` copies the image even when it's RGB already
+    return image if image.mode == "RGB" else image.convert("RGB")
+
+
+def tiled_heatmap(
+    image: Image.Image,
+    scorer: "ElaScorer",
+    tile_size: int = DEFAULT_TILE_SIZE,
+    executor: t.Optional[ThreadPoolExecutor] = None,
+) -> npt.NDArray[np.float32]:
+    """
+    Tamper probability of every tile as a rows x columns array. The tiles are prepared batch by batch
+    (on the `executor` threads if given) so that at most `scorer.batch_size` tiles are held at once
+    """
+    grid = tile_grid(image.size, tile_size)
+    boxes = [box for row in grid for box in row]
+    probabilities: list[npt.NDArray[np.float32]] = []
+
+    def prepare(box: Box) -> ElaTensor:
+        return prepare_ela_input(ela_tile(image, box))
+
+    for start in range(0, len(boxes), scorer.batch_size):
+        chunk = boxes[start : start + scorer.batch_size]
+        tensors = list(executor.map(prepare, chunk) if executor is not None else map(prepare, chunk))
+        probabilities.append(predict_tamper_probabilities(np.stack(tensors), scorer.model, scorer.device))
+    heatmap: npt.NDArray[np.float32] = np.concatenate(probabilities).reshape(len(grid), len(grid[0]))
+    return heatmap
+
+
+def save_heatmap(image: Image.Image, heatmap: npt.NDArray[np.float32], path: str) -> None:
+    """Overlays the tile probabilities in red over a thumbnail of the image"""
+    # `reduce` makes the downscaled copy right away, unlike `copy` followed by `thumbnail`
+    factor = max(1, min(image.width // HEATMAP_SIZE[0], image.height // HEATMAP_SIZE[1]))
+    thumbnail = image.reduce(factor)
+    thumbnail.thumbnail(HEATMAP_SIZE)
+    overlay = Image.fromarray((heatmap * 255).astype(np.uint8), mode="L")
+    overlay = overlay.resize(thumbnail.size, Image.Resampling.NEAREST)
+    red = Image.new("RGB", thumbnail.size, (255, 0, 0))
+    # at most 60% red, so that the image stays visible under the tampered tiles
+    Image.composite(red, thumbnail, overlay.point(lambda value: value * 6 // 10)).save(path)
+
+
+def heatmap_name(path: str) -> str:
+    # the images of different directories may share the name
+    digest = hashlib.sha1(os.path.dirname(path).encode(), usedforsecurity=False).hexdigest()[:8]
+    return f"{os.path.basename(path)}.{digest}.heatmap.png"
+
+
+def min_tampered_tiles(tiles: int, fraction: float = DEFAULT_TILE_FRACTION) -> int:
+    """
+    Number of the tiles reaching the threshold which make the image tampered: `fraction` of them, at least one.
+    Every tile is a chance of a false positive, so a single tile would flag nearly all the large images
+    """
+    return max(1, math.ceil(tiles * fraction))
+
+
+def check_ela_tiled(
+    paths: list[str],
+    scorer: "ElaScorer",
+    tile_size: int = DEFAULT_TILE_SIZE,
+    threshold: float = DEFAULT_TILE_THRESHOLD,
+    workers: int = 0,
+    heatmap_folder: t.Optional[str] = None,
+    output: t.Optional["RecordWriter"] = None,
+    fraction: float = DEFAULT_TILE_FRACTION,
+) -> None:
+    """
+    The image counts as tampered when at least `fraction` of its tiles (and at least one)
+    reach the tamper probability `threshold`, see `min_tampered_tiles`
+    """
+    if heatmap_folder is not None:
+        os.makedirs(heatmap_folder, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=workers) if workers > 1 else contextlib.nullcontext() as executor:
+        for path in paths:
+            record = TiledElaRecord(path)
+            try:
+                image = open_rgb(path)
+                heatmap = tiled_heatmap(image, scorer, tile_size, executor)
+            except (OSError, ValueError, Image.DecompressionBombError):
+                heatmap = None
+            if heatmap is not None:
+                record.tiles = heatmap.size
+                record.tampered_tiles = int(np.count_nonzero(heatmap >= threshold))
+                record.max_tamper_probability = round(float(heatmap.max()), 4)
+                record.is_authentic = record.tampered_tiles < min_tampered_tiles(record.tiles, fraction)
+                if heatmap_folder is not None:
+                    record.heatmap = os.path.join(heatmap_folder, heatmap_name(path))
+                    save_heatmap(image, heatmap, record.heatmap)
+                del image
+            print_prediction(path, record.is_authentic)
+            if output is not None:
+                output.add(record)
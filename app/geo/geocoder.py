@@ -0,0 +1,174 @@
+"""
+Offline reverse geocoder, answers point-in-country queries against the bundled Natural Earth boundaries
+"""
+import functools
+import os
+import typing as t
+
+import numpy as np
+import numpy.typing as npt
+
+COUNTRIES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "countries.npz")
+GRID_CELL_DEGREES = 1.0
+GRID_WIDTH = int(360 / GRID_CELL_DEGREES)
+GRID_HEIGHT = int(180 / GRID_CELL_DEGREES)
+# the bundled boundaries are simplified, so coastal points may fall slightly outside of their country,
+# must not exceed the grid cell size as only the neighbouring cells are searched
+MAX_COAST_DISTANCE_DEGREES = 0.5
+# bounds the size of the point x edge matrices of the ray casting
+MAX_TEST_ELEMENTS = 2**22
+
+
+def _cell_xy(lons: t.Any, lats: t.Any) -> tuple[t.Any, t.Any]:
+    cell_x = np.clip(np.floor((lons + 180) / GRID_CELL_DEGREES), 0, GRID_WIDTH - 1).astype(np.int64)
+    cell_y = np.clip(np.floor((lats + 90) / GRID_CELL_DEGREES), 0, GRID_HEIGHT - 1).astype(np.int64)
+    return cell_x, cell_y
+
+
+def _group_by_cell(
+    cells: npt.NDArray[np.int64],
+    values: npt.NDArray[np.int64],
+) -> tuple[npt.NDArray[np.int64], npt.NDArray[np.int64]]:
+    """Builds a CSR-like (offsets, values) grid, values of the cell `i` are `values[offsets[i]:offsets[i + 1]]`"""
+    order = np.argsort(cells, kind="stable")
+    offsets = np.searchsorted(cells[order], np.arange(GRID_WIDTH * GRID_HEIGHT + 1))
+    return offsets, values[order]
+
+
+class CountryIndex:
+    """
+    Country polygons bucketed into a regular lat/lon grid, a point is only tested (even-odd ray casting)
+    against the countries whose ring bounding boxes overlap the grid cell it falls into
+    """
+
+    def __init__(
+        self,
+        names: npt.NDArray[np.str_],
+        ring_offsets: npt.NDArray[np.int32],
+        ring_country: npt.NDArray[np.int32],
+        vertices: npt.NDArray[np.float32],
+    ) -> None:
+        self.names = [str(name) for name in names]
+        self.vertices = vertices.astype(np.float64)
+        self.vertex_country = np.repeat(ring_country, np.diff(ring_offsets))
+
+        # consecutive vertices of a ring form an edge, rings are closed (the first vertex is repeated at the end)
+        is_edge_start = np.ones(len(vertices), dtype=bool)
+        is_edge_start[ring_offsets[1:] - 1] = False
+        starts = np.flatnonzero(is_edge_start)
+        edge_country = self.vertex_country[starts]
+        order = np.argsort(edge_country, kind="stable")
+        self.edges = np.column_stack([self.vertices[starts], self.vertices[starts + 1]])[order]
+        self.country_edge_offsets = np.searchsorted(edge_country[order], np.arange(len(self.names) + 1))
+
+        # every cell overlapped by the bounding box of a ring points to the ring's country
+        ring_cells, ring_countries = [], []
+        for ring, country in enumerate(ring_country):
+            ring_vertices = self.vertices[ring_offsets[ring] : ring_offsets[ring + 1]]
+            (min_lon, min_lat), (max_lon, max_lat) = ring_vertices.min(axis=0), ring_vertices.max(axis=0)
+            min_x, min_y = _cell_xy(min_lon, min_lat)
+            max_x, max_y = _cell_xy(max_lon, max_lat)
+            xs, ys = np.meshgrid(np.arange(min_x, max_x + 1), np.arange(min_y, max_y + 1))
+            ring_cells.append((ys * GRID_WIDTH + xs).reshape(-1))
+            ring_countries.append(np.full(xs.size, country))
+        pairs = np.unique(np.column_stack([np.concatenate(ring_cells), np.concatenate(ring_countries)]), axis=0)
+        self.grid_offsets, self.grid_countries = _group_by_cell(pairs[:, 0], pairs[:, 1])
+
+        vertex_x, vertex_y = _cell_xy(self.vertices[:, 0], self.vertices[:, 1])
+        self.vertex_grid_offsets, self.vertex_grid = _group_by_cell(
+            vertex_y * GRID_WIDTH + vertex_x,
+            np.arange(len(self.vertices)),
+        )
+        # cells having boundary vertices in their 3x3 neighbourhood, the rest is open sea for the coastal fallback
+        has_vertices = (np.diff(self.vertex_grid_offsets) > 0).reshape(GRID_HEIGHT, GRID_WIDTH)
+        padded = np.pad(has_vertices, ((1, 1), (0, 0)))
+        self.near_boundary = np.zeros_like(has_vertices)
+        for dy in (0, 1, 2):
+            for dx in (-1, 0, 1):
+                self.near_boundary |= np.roll(padded[dy : dy + GRID_HEIGHT], dx, axis=1)
+
+    @classmethod
+    def load(cls, path: str = COUNTRIES_PATH) -> "CountryIndex":
+        with np.load(path) as data:
+            return cls(data["names"], data["ring_offsets"], data["ring_country"], data["vertices"])
+
+    def _contains(
+        self,
+        country: int,
+        lons: npt.NDArray[np.float64],
+        lats: npt.NDArray[np.float64],
+    ) -> npt.NDArray[np.bool_]:
+        edges = self.edges[self.country_edge_offsets[country] : self.country_edge_offsets[country + 1]]
+        result = np.zeros(len(lons), dtype=bool)
+        chunk_size = max(1, MAX_TEST_ELEMENTS // max(1, len(edges)))
+        x1, y1, x2, y2 = (edges[:, i][np.newaxis, :] for i in range(4))
+        for start in range(0, len(lons), chunk_size):
+            x = lons[start : start + chunk_size, np.newaxis]
+            y = lats[start : start + chunk_size, np.newaxis]
+            crosses = (y1 > y) != (y2 > y)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                x_intersection = x1 + (y - y1) * (x2 - x1) / (y2 - y1)
+            result[start : start + chunk_size] = np.count_nonzero(crosses & (x < x_intersection), axis=1) % 2 == 1
+        return result
+
+    def _nearest(self, lons: npt.NDArray[np.float64], lats: npt.NDArray[np.float64]) -> npt.NDArray[np.int64]:
+        """Country of the closest boundary vertex within `MAX_COAST_DISTANCE_DEGREES`, -1 otherwise"""
+        result = np.full(len(lons), -1)
+        cell_x, cell_y = _cell_xy(lons, lats)
+        for i in np.flatnonzero(self.near_boundary[cell_y, cell_x]):
+            ys = np.clip(np.arange(cell_y[i] - 1, cell_y[i] + 2), 0, GRID_HEIGHT - 1)
+            xs = np.arange(cell_x[i] - 1, cell_x[i] + 2) % GRID_WIDTH
+            cells = np.unique((ys[:, np.newaxis] * GRID_WIDTH + xs[np.newaxis, :]).reshape(-1))
+            vertices = np.concatenate(
+                [self.vertex_grid[self.vertex_grid_offsets[c] : self.vertex_grid_offsets[c + 1]] for c in cells],
+            )
+            if not len(vertices):
+                continue
+            distances = (self.vertices[vertices, 0] - lons[i]) ** 2 + (self.vertices[vertices, 1] - lats[i]) ** 2
+            if distances.min() <= MAX_COAST_DISTANCE_DEGREES**2:
+                result[i] = self.vertex_country[vertices[distances.argmin()]]
+        return result
+
+    def lookup_ids(self, lats: npt.NDArray[np.float64], lons: npt.NDArray[np.float64]) -> npt.NDArray[np.int64]:
+        """Returns the country index of every point, -1 for the points outside of any country"""
+        lats, lons = np.asarray(lats, dtype=np.float64), np.asarray(lons, dtype=np.float64)
+        result = np.full(len(lats), -1)
+        valid = np.isfinite(lats) & np.isfinite(lons) & (np.abs(lats) <= 90) & (np.abs(lons) <= 180)
+        if not valid.any():
+            return result
+
+        # identical coordinates (e.g. a burst of photos) are resolved once
+        points, inverse = np.unique(np.column_stack([lats[valid], lons[valid]]), axis=0, return_inverse=True)
+        lats, lons = points[:, 0], points[:, 1]
+        countries = np.full(len(points), -1)
+
+        # (point, candidate country) pairs grouped by country
+        cell_x, cell_y = _cell_xy(lons, lats)
+        cells = cell_y * GRID_WIDTH + cell_x
+        starts, counts = self.grid_offsets[cells], self.grid_offsets[cells + 1] - self.grid_offsets[cells]
+        pair_points = np.repeat(np.arange(len(points)), counts)
+        pair_slots = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(starts, counts)
+        pair_countries = self.grid_countries[pair_slots]
+        order = np.argsort(pair_countries, kind="stable")
+        pair_points, pair_countries = pair_points[order], pair_countries[order]
+        bounds = np.flatnonzero(np.diff(pair_countries)) + 1
+        groups = zip(pair_countries[np.r_[0, bounds]], np.split(pair_points, bounds)) if len(pair_points) else ()
+        for country, point_ids in groups:
+            point_ids = point_ids[countries[point_ids] == -1]
+            if len(point_ids):
+                inside = self._contains(country, lons[point_ids], lats[point_ids])
+                countries[point_ids[inside]] = country
+
+        if (outside := np.flatnonzero(countries == -1)).size:
+            countries[outside] = self._nearest(lons[outside], lats[outside])
+
+        result[valid] = countries[inverse.reshape(-1)]
+        return result
+
+    def lookup(self, lats: t.Sequence[float], lons: t.Sequence[float]) -> list[t.Optional[str]]:
+        return [self.names[i] if i >= 0 else None for i in self.lookup_ids(np.asarray(lats), np.asarray(lons))]
+
+
+@functools.cache
+def load_country_index(path: str = COUNTRIES_PATH) -> CountryIndex:
+    return CountryIndex.load(path)
@@ -0,0 +1,193 @@
+"""
+Per-stage timing instrumentation enabled by the `--profile` options.
+
+The pipeline wraps its stages with `stage(name)`, while profiling is disabled it returns a shared no-op
+context manager, so the instrumented code pays a single global lookup.
+Samples recorded in the pool workers are sent back with the results (see `collect`) and merged into the
+profiler of the main process.
+"""
+import array
+import collections
+import contextlib
+import cProfile
+import io
+import json
+import pstats
+import threading
+import time
+import typing as t
+
+import rich
+from rich.table import Table
+
+CPROFILE_TOP_FUNCTIONS = 25
+
+Samples = dict[str, tuple[list[float], int]]
+
+_DISABLED = contextlib.nullcontext()
+
+
+def _percentile(values: list[float], q: float) -> float:
+    """Nearest-rank percentile of the sorted `values`"""
+    return values[min(len(values) - 1, max(0, round(q * len(values)) - 1))]
+
+
+class Profiler:
+    def __init__(self, cprofile_stage: t.Optional[str] = None) -> None:
+        self.cprofile_stage = cprofile_stage
+        self.cprofile = cProfile.Profile() if cprofile_stage else None
+        self.seconds: dict[str, array.array[float]] = collections.defaultdict(lambda: array.array("d"))
+        self.bytes: collections.Counter[str] = collections.Counter()
+        # the downloads are timed on several threads
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> t.Iterator[None]:
+        profile = self.cprofile if name == self.cprofile_stage else None
+        if profile is not None:
+            profile.enable()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self.seconds[name].append(elapsed)
+            if profile is not None:
+                profile.disable()
+
+    def add_bytes(self, name: str, count: int) -> None:
+        with self._lock:
+            self.bytes[name] += count
+
+    def drain(self) -> Samples:
+        samples = {name: (list(seconds), self.bytes.pop(name, 0)) for name, seconds in self.seconds.items()}
+        samples.update({name: ([], count) for name, count in self.bytes.items()})
+        self.seconds.clear()
+        self.bytes.clear()
+        return samples
+
+    def merge(self, samples: Samples) -> None:
+        for name, (seconds, count) in samples.items():
+            self.seconds[name].extend(seconds)
+            self.bytes[name] += count
+
+    def summary(self) -> dict[str, dict[str, float]]:
+        result = {}
+        for name in sorted(self.seconds.keys() | self.bytes.keys()):
+            values = sorted(self.seconds.get(name, ()))
+            result[name] = {
+                "count": len(values),
+                "total": sum(values),
+                "p50": _percentile(values, 0.5) if values else 0.0,
+                "p95": _percentile(values, 0.95) if values else 0.0,
+                "max": values[-1] if values else 0.0,
+                "bytes": self.bytes.get(name, 0),
+            }
+        return result
+
+    def print_summary(self) -> None:
+        table = Table(title="Stage timings")
+        for column in ("stage", "count", "total", "p50", "p95", "max", "bytes"):
+            table.add_column(column, justify="left" if column == "stage" else "right")
+        for name, stats in self.summary().items():
+            table.add_row(
+                name,
+                str(stats["count"]),
+                f"{stats['total']:.3f}s",
+                f"{stats['p50'] * 1000:.2f}ms",
+                f"{stats['p95'] * 1000:.2f}ms",
+                f"{stats['max'] * 1000:.2f}ms",
+                str(stats["bytes"]) if stats["bytes"] else "",
+            )
+        rich.print(table)
+
+    def print_cprofile(self) -> None:
+        if self.cprofile is not None:
+            output = io.StringIO()
+            stats = pstats.Stats(self.cprofile, stream=output)
+            stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(CPROFILE_TOP_FUNCTIONS)
+            print(f"cProfile of the {self.cprofile_stage} stage (main process only):")
+            print(output.getvalue())
+
+    def dump_json(self, path: str) -> None:
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+
+
+_profiler: t.Optional[Profiler] = None
+
+
+def enable(cprofile_stage: t.Optional[str] = None) -> Profiler:
+    global _profiler
+    _profiler = Profiler(cprofile_stage)
+    return _profiler
+
+
+def disable() -> None:
+    global _profiler
+    _profiler = None
+
+
+def is_enabled() -> bool:
+    return _profiler is not None
+
+
+def stage(name: str) -> t.ContextManager[None]:
+    if _profiler is None:
+        return _DISABLED
+    return _profiler.stage(name)
+
+
+def add_bytes(name: str, count: int) -> None:
+    if _profiler is not None:
+        _profiler.add_bytes(name, count)
+
+
+def init_worker(enabled: bool) -> None:
+    """Pool initializer, turns the profiling on in the worker process if it's on in the main one"""
+    if enabled:
+        enable()
+
+
+R = t.TypeVar("R")
+
+
+def collect(function: t.Callable[..., R], *args: t.Any) -> tuple[R, t.Optional[Samples]]:
+    """Runs `function` in a pool worker and returns its result with the samples recorded meanwhile"""
+    result = function(*args)
+    return result, _profiler.drain() if _profiler is not None else None
+
+
+def merge(samples: t.Optional[Samples]) -> None:
+    if _profiler is not None and samples:
+        _profiler.merge(samples)
+
+
+def merged(results: t.Iterable[tuple[R, t.Optional[Samples]]]) -> t.Iterator[R]:
+    """Unwraps the results of `collect` merging their samples on the way"""
+    for result, samples in results:
+        merge(samples)
+        yield result
+
+
+@contextlib.contextmanager
+def profile_session(
+    enabled: bool,
+    json_path: t.Optional[str] = None,
+    cprofile_stage: t.Optional[str] = None,
+) -> t.Iterator[None]:
+    """Profiles the enclosed command, the summary is printed (or dumped to `json_path`) at the end"""
+    if not (enabled or json_path or cprofile_stage):
+        yield
+        return
+    profiler = enable(cprofile_stage)
+    try:
+        yield
+    finally:
+        disable()
+        if json_path:
+            profiler.dump_json(json_path)
+        else:
+            profiler.print_summary()
+        profiler.print_cprofile()
@@ -1,23 +1,42 @@
+import contextlib
+import enum
+import glob
 import os
 import platform
 import shutil
 import sys
-from urllib.parse import urljoin
+import tempfile
+import typing as t
 
-import requests
 import rich
 import typer
-from bs4 import BeautifulSoup
-from rich.progress import track
 
 IMAGE_EXTENSIONS = [".png", ".jpg", ".jpeg"]
+# shared folders used by the older versions, only removed by the `clean` command now
 TMP_FOLDER = "./tmp"
 DOWNLOAD_TMP_FOLDER = "./download_tmp"
+WORKSPACE_PREFIX = "image_scan_"
 DOWNLOAD_CHUNK_SIZE = 2**14
+DEFAULT_BATCH_SIZE = 32
+DEFAULT_DOWNLOAD_LIMIT = 10
+DEFAULT_DOWNLOAD_WORKERS = 8
+DEFAULT_SERVER_PORT = 8765
+DEFAULT_TILE_SIZE = 512
+DEFAULT_TILE_THRESHOLD = 0.5
+DEFAULT_TILE_FRACTION = 0.05
 USER_AGENT = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 " \
              "(KHTML, like Gecko) Chrome/119.0.0.0 Safari/537.36"
 
 
+class InferenceBackend(str, enum.Enum):
+    """ELA model inference modes, see `app.ela_nn.backends`"""
+
+    FP32 = "fp32"
+    FUSED = "fused"
+    INT8 = "int8"
+    BF16 = "bf16"
+
+
 def is_osxmetadata_package_present() -> bool:
     if platform.system() == "Darwin":
         try:
@@ -64,64 +83,87 @@ def print_success(msg: str) -> None:
     rich.print(f"[green]{_center_in_the_terminal(msg)}[/green]")
 
 
-def filter_images_from_paths(paths: list[str]) -> list[str]:
-    return [path for path in paths if any(path.endswith(ext) for ext in IMAGE_EXTENSIONS)]
-
-
-def filter_images_or_directories_from_paths(parent_path: str, paths: list[str]) -> list[str]:
-    return [
-        path
-        for path in paths
-        if any(path.lower().endswith(ext) for ext in IMAGE_EXTENSIONS) or os.path.isdir(f"{parent_path}/{path}")
-    ]
-
-
-def get_images_from_url(url: str) -> list[str]:  # type: ignore[return]
-    response = requests.get(url, headers={"User-Agent": USER_AGENT})
-    if response.status_code == 200:
-        soup = BeautifulSoup(response.content, "html.parser")
-        img_tags = soup.find_all("img")
-        potential_img_urls = [urljoin(url, img_tag["src"]) for img_tag in img_tags]
-        return filter_images_from_paths(potential_img_urls)
+def print_prediction(path: str, is_authentic: t.Optional[bool]) -> None:
+    print(f"{path}:", end=" ")
+    if is_authentic is None:
+        rich.print("[yellow]Failed to analyse[/yellow]")
     else:
-        print_error_and_exit(f"Failed to retrieve the webpage. Status code: {response.status_code}")
-
-
-def download_image(url: str) -> str:
-    img_name = url.split("/")[-1]
-    save_path = DOWNLOAD_TMP_FOLDER + "/" + img_name
+        rich.print("[green]Authentic[/green]" if is_authentic else "[red]Tampered[/red]")
 
-    response = requests.get(url, stream=True, headers={"User-Agent": USER_AGENT})
-    if response.status_code != 200:
-        print_warning(f"Failed to download image. Status code: {response.status_code}")
 
-    with open(save_path, "wb") as file:
-        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
-            file.write(chunk)
+def _sorted_dir_entries(path: str) -> list[os.DirEntry[str]]:
+    try:
+        with os.scandir(path) as entries:
+            return sorted(entries, key=lambda entry: entry.name)
+    except OSError:
+        return []
 
-    return save_path
 
-
-def download_images(url: str, limit: int = 10) -> list[str]:
-    img_urls = get_images_from_url(url)
-    if not img_urls:
-        print_warning_and_exit(f"Can't find suitable images from url {url}")
-
-    img_paths = []
-
-    if not os.path.exists(DOWNLOAD_TMP_FOLDER):
-        os.makedirs(DOWNLOAD_TMP_FOLDER)
-    for img_url in track(img_urls[:limit], description="Downloading images ..."):
-        img_path = download_image(img_url)
-        img_paths.append(img_path)
-
-    return img_paths
+def _is_dir(entry: os.DirEntry[str]) -> bool:
+    try:
+        return entry.is_dir()
+    except OSError:
+        return False
 
 
-def create_temp_folders() -> None:
-    for path in [TMP_FOLDER, DOWNLOAD_TMP_FOLDER]:
-        if not os.path.exists(path):
-            os.makedirs(path)
+def iter_image_paths(path: str) -> t.Iterator[str]:
+    """
+    Walks the directory tree without recursion yielding the image paths in a deterministic (sorted) order,
+    the file type is taken from the directory entries, so only the symlinks are stat-ed
+    """
+    if not os.path.isdir(path):
+        yield path
+        return
+
+    image_extensions = tuple(IMAGE_EXTENSIONS)
+    root_stat = os.stat(path)
+    visited_links = {(root_stat.st_dev, root_stat.st_ino)}
+    stack = [iter(_sorted_dir_entries(path))]
+    while stack:
+        entry = next(stack[-1], None)
+        if entry is None:
+            stack.pop()
+            continue
+        if _is_dir(entry):
+            if entry.is_symlink():
+                # guards against the symlink loops
+                stat = os.stat(entry.path)
+                if (stat.st_dev, stat.st_ino) in visited_links:
+                    continue
+                visited_links.add((stat.st_dev, stat.st_ino))
+            stack.append(iter(_sorted_dir_entries(entry.path)))
+        elif entry.name.lower().endswith(image_extensions):
+            yield entry.path
+
+
+def collect_image_paths(paths: list[str]) -> list[str]:
+    return [image_path for path in paths for image_path in iter_image_paths(path)]
+
+
+@contextlib.contextmanager
+def workspace() -> t.Iterator[str]:
+    """
+    Private temporary folder of the current run, removed once the run is over.
+    The folder name holds the process id, so `clean` can tell the abandoned workspaces apart
+    """
+    path = tempfile.mkdtemp(prefix=f"{WORKSPACE_PREFIX}{os.getpid()}_")
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def _is_process_alive(pid: int) -> bool:
+    if platform.system() == "Windows":
+        # os.kill would terminate the process there
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
 
 
 def clean_temp_folders_and_files() -> None:
@@ -133,6 +175,12 @@ def clean_temp_folders_and_files() -> None:
         if os.path.exists(file):
             os.remove(file)
 
+    # workspaces left behind by the killed runs, the ones of the running scans are kept
+    for path in glob.glob(os.path.join(tempfile.gettempdir(), f"{WORKSPACE_PREFIX}*_*")):
+        pid = os.path.basename(path)[len(WORKSPACE_PREFIX) :].split("_", 1)[0]
+        if pid.isdigit() and not _is_process_alive(int(pid)):
+            shutil.rmtree(path, ignore_errors=True)
+
 
 def get_base_path() -> str:
     if getattr(sys, 'frozen', False):  # Check if the application is a bundle
@@ -140,6 +188,3 @@ def get_base_path() -> str:
     else:
         return os.path.abspath(".")
 
-
-if __name__ == "__main__":
-    download_images("https://www.vu.lt/")
@@ -0,0 +1,81 @@
+import os
+import sqlite3
+from pathlib import Path
+
+from app.cli.cache import ELA, SCAN, SCHEMA_VERSION, ScanCache
+
+
+def _image(tmp_path: Path, name: str) -> str:
+    path = tmp_path / name
+    path.write_bytes(name.encode())
+    return str(path)
+
+
+def test_versions_share_the_cache(tmp_path: Path) -> None:
+    path = _image(tmp_path, "a.jpg")
+    db = str(tmp_path / "cache.db")
+    with ScanCache(db) as fp32:
+        fp32.put(ELA, path, "fp32", True)
+    # a run of another model version doesn't drop the entries of the first one
+    with ScanCache(db) as int8:
+        assert int8.get(ELA, path, "int8") is None
+        int8.put(ELA, path, "int8", False)
+    with ScanCache(db) as cache:
+        assert cache.get(ELA, path, "fp32") is True
+        assert cache.get(ELA, path, "int8") is False
+        assert cache.get(ELA, path, "fp32:reference") is None
+
+
+def test_changed_file_misses(tmp_path: Path) -> None:
+    path = _image(tmp_path, "a.jpg")
+    with ScanCache(str(tmp_path / "cache.db")) as cache:
+        cache.put(SCAN, path, "1", {"path": path})
+        assert cache.get(SCAN, path, "1") == {"path": path}
+        with open(path, "ab") as f:
+            f.write(b"edited")
+        assert cache.get(SCAN, path, "1") is None
+        assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_content_hash_survives_a_copy(tmp_path: Path) -> None:
+    path = _image(tmp_path, "a.jpg")
+    with ScanCache(str(tmp_path / "cache.db"), hash_contents=True) as cache:
+        assert cache.get(SCAN, path, "1") is None
+        cache.put(SCAN, path, "1", {"verdict": 1})
+        copy = str(tmp_path / "copy.jpg")
+        with open(path, "rb") as src, open(copy, "wb") as dst:
+            dst.write(src.read())
+        assert cache.get(SCAN, copy, "1") == {"verdict": 1}
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path: Path) -> None:
+    paths = [_image(tmp_path, f"{i}.jpg") for i in range(30)]
+    with ScanCache(str(tmp_path / "cache.db"), max_entries=20) as cache:
+        for path in paths[:20]:
+            cache.put(SCAN, path, "1", 1)
+        cache.commit()
+        assert cache.get(SCAN, paths[0], "1") == 1
+        for path in paths[20:]:
+            cache.put(SCAN, path, "1", 1)
+        cache.commit()
+        (count,) = cache.connection.execute("SELECT COUNT(*) FROM entries").fetchone()
+        assert count == 18
+        assert cache.get(SCAN, paths[0], "1") == 1
+        assert cache.get(SCAN, paths[1], "1") is None
+        assert cache.get(SCAN, paths[-1], "1") == 1
+
+
+def test_cache_of_an_older_schema_is_dropped(tmp_path: Path) -> None:
+    db = str(tmp_path / "cache.db")
+    connection = sqlite3.connect(db)
+    connection.execute(
+        "CREATE TABLE entries (kind TEXT, device INTEGER, inode INTEGER, PRIMARY KEY (kind, device, inode))"
+    )
+    connection.commit()
+    connection.close()
+    path = _image(tmp_path, "a.jpg")
+    with ScanCache(db) as cache:
+        cache.put(SCAN, path, "1", 1)
+        assert cache.get(SCAN, path, "1") == 1
+    assert sqlite3.connect(db).execute("PRAGMA user_version").fetchone() == (SCHEMA_VERSION,)
+    assert os.path.exists(db)
@@ -0,0 +1,107 @@
+import json
+import shutil
+import typing as t
+from pathlib import Path
+
+import pytest
+from PIL import Image
+from typer.testing import CliRunner
+
+from app.cli.cache import ScanCache
+from app.cli.main import app
+from app.cli.phash import PerceptualIndex, dhash
+from app.cli.scanner import scan_paths
+
+SAMPLES = Path(__file__).parent.parent / "samples"
+
+
+@pytest.fixture()
+def images(tmp_path: Path) -> Path:
+    folder = tmp_path / "images"
+    folder.mkdir()
+    for name in ["queen.png", "queen2.jpg", "books.jpg"]:
+        shutil.copyfile(SAMPLES / name, folder / name)
+    return folder
+
+
+def _scan(tmp_path: Path, *args: str) -> dict[str, dict[str, t.Any]]:
+    output = tmp_path / "out"
+    result = CliRunner().invoke(
+        app,
+        ["scan", "--jobs", "1", "--output-format", "jsonl", "--output", str(output), *args],
+    )
+    assert result.exit_code == 0, result.output
+    with open(tmp_path / "out.jsonl") as f:
+        return {Path(record["path"]).name: record for record in map(json.loads, f)}
+
+
+def test_dedup_clusters_the_copies(tmp_path: Path, images: Path) -> None:
+    records = _scan(tmp_path, "--path", str(images), "--dedup")
+    assert records["queen2.jpg"]["duplicate_of"] == str(images / "queen.png")
+    assert records["queen.png"]["duplicate_of"] == ""
+    assert records["books.jpg"]["duplicate_of"] == ""
+
+
+def test_dedup_after_cached_scan(tmp_path: Path, images: Path) -> None:
+    cache = str(tmp_path / "cache.db")
+    records = _scan(tmp_path, "--path", str(images), "--cache", cache)
+    assert "duplicate_of" not in records["queen2.jpg"]
+    for _ in range(2):
+        # the first run hashes the images cached without a hash, the second one links them by their cached hash
+        records = _scan(tmp_path, "--path", str(images), "--cache", cache, "--dedup")
+        assert records["queen2.jpg"]["duplicate_of"] == str(images / "queen.png")
+        assert records["books.jpg"]["duplicate_of"] == ""
+
+
+class FailingScorer:
+    """Fails on the first image, the others are authentic"""
+
+    batch_size = 8
+    version = "test"
+
+    def __init__(self) -> None:
+        self.scored = 0
+
+    def score(self, tensors: t.Sequence[t.Any]) -> list[t.Optional[bool]]:
+        verdicts: list[t.Optional[bool]] = []
+        for tensor in tensors:
+            verdicts.append(None if tensor is None or self.scored == 0 else True)
+            self.scored += tensor is not None
+        return verdicts
+
+
+def test_copies_of_a_failed_image_are_scored(tmp_path: Path) -> None:
+    folder = tmp_path / "images"
+    folder.mkdir()
+    shutil.copyfile(SAMPLES / "chimp.jpeg", folder / "a.jpeg")
+    Image.open(folder / "a.jpeg").save(folder / "b.jpeg", quality=90)
+    scorer = FailingScorer()
+    index = PerceptualIndex(version=scorer.version)
+    paths = [str(folder / "a.jpeg"), str(folder / "b.jpeg")]
+    records = {Path(record.path).name: record for record in scan_paths(paths, scorer=scorer, index=index)}
+    assert records["a.jpeg"].is_authentic is None
+    assert records["b.jpeg"].is_authentic is True
+    assert records["b.jpeg"].duplicate_of == str(folder / "a.jpeg")
+    assert scorer.scored == 2
+
+
+def test_edited_image_is_not_reused(tmp_path: Path) -> None:
+    path = tmp_path / "queen.png"
+    shutil.copyfile(SAMPLES / "queen.png", path)
+    with ScanCache(str(tmp_path / "cache.db")) as cache:
+        index = PerceptualIndex(cache.connection, version="test")
+        node = index.add(dhash(str(path)), str(path), fingerprint=(1, 2, 3))
+        index.set_verdict(node, True)
+        index.commit()
+        index.retire_stale(str(path), (1, 2, 4))
+        assert index.nearest(dhash(str(path))) is None
+
+
+def test_index_is_bounded(tmp_path: Path) -> None:
+    index = PerceptualIndex(max_entries=20)
+    for i in range(50):
+        index.add(i * 0x0101010101010101, f"image{i}")
+        index.commit()
+    assert len(index.nodes) <= 20
+    match = index.nearest(49 * 0x0101010101010101)
+    assert match is not None and match.node.path == "image49"
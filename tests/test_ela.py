@@ -0,0 +1,79 @@
+import threading
+import typing as t
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+import pytest
+import torch
+
+from app.ela_nn import ela
+from app.ela_nn.ela import PREPARE_BATCHES_AHEAD, PREPARE_CHUNK_SIZE, iter_predictions
+
+
+class CountingExecutor(ThreadPoolExecutor):
+    """Records the highest number of submitted tasks not consumed yet"""
+
+    def __init__(self) -> None:
+        super().__init__(max_workers=2)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def submit(self, *args: t.Any, **kwargs: t.Any) -> Future[t.Any]:  # type: ignore[override]
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        future = super().submit(*args, **kwargs)
+        original = future.result
+
+        def result(timeout: t.Optional[float] = None) -> t.Any:
+            with self.lock:
+                self.in_flight -= 1
+            return original(timeout)
+
+        future.result = result  # type: ignore[method-assign]
+        return future
+
+
+class ParityModel(torch.nn.Module):
+    """Authentic when the value the input is filled with is even, records the batch sizes"""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.batches: list[int] = []
+
+    def forward(self, batch: torch.Tensor) -> torch.Tensor:
+        self.batches.append(len(batch))
+        even = (batch[:, 0, 0, 0].round().long() % 2 == 0).float()
+        return torch.stack([1 - even, even], dim=1)
+
+
+def _fake_tensor(path: str, reference: bool = False) -> t.Optional[np.ndarray]:
+    number = int(path)
+    return None if number % 7 == 3 else np.full((3, 128, 128), number, dtype=np.float32)
+
+
+@pytest.mark.parametrize("with_executor", [False, True])
+def test_predictions_keep_the_order_across_windows(monkeypatch: pytest.MonkeyPatch, with_executor: bool) -> None:
+    monkeypatch.setattr(ela, "prepare_ela_tensor", _fake_tensor)
+    batch_size = 8
+    # several windows of in-flight chunks, and a last batch which isn't full
+    paths = [str(number) for number in range(batch_size * PREPARE_BATCHES_AHEAD * 3 + 5)]
+    model = ParityModel()
+    executor = CountingExecutor() if with_executor else None
+    try:
+        predictions = list(iter_predictions(paths, model, torch.device("cpu"), batch_size, executor=executor))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    assert [path for path, _ in predictions] == paths
+    for path, is_authentic in predictions:
+        number = int(path)
+        assert is_authentic == (None if number % 7 == 3 else number % 2 == 0)
+    # every batch holds the valid inputs of `batch_size` consecutive paths
+    expected = [sum(int(path) % 7 != 3 for path in paths[i : i + batch_size]) for i in range(0, len(paths), batch_size)]
+    assert model.batches == expected
+    if executor is not None:
+        # the next chunk is submitted right before the result of the oldest one is taken
+        assert executor.max_in_flight == batch_size * PREPARE_BATCHES_AHEAD // PREPARE_CHUNK_SIZE + 1
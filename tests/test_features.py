@@ -0,0 +1,78 @@
+import os
+from pathlib import Path
+
+import numpy as np
+
+from app.ela_nn.features import FEATURES_FILE, INITIAL_CAPACITY, FeatureStore
+
+ROW_SHAPE = (2, 3)
+
+
+def _image(tmp_path: Path, name: str) -> str:
+    path = tmp_path / name
+    path.write_bytes(name.encode())
+    return str(path)
+
+
+def _features(value: float) -> np.ndarray:
+    return np.full(ROW_SHAPE, value, dtype=np.float32)
+
+
+def test_concurrent_stores_claim_distinct_rows(tmp_path: Path) -> None:
+    folder = str(tmp_path / "features")
+    paths = [_image(tmp_path, f"{i}.jpg") for i in range(6)]
+    # both stores are opened before either adds anything, like two runs started together
+    with FeatureStore(folder, "v1", ROW_SHAPE) as first, FeatureStore(folder, "v1", ROW_SHAPE) as second:
+        for i, path in enumerate(paths):
+            (first if i % 2 else second).add(path, _features(i))
+
+    with FeatureStore(folder, "v1", ROW_SHAPE) as store:
+        slots = store.lookup(paths)
+        assert sorted(slots.values()) == list(range(len(paths)))
+        for i, path in enumerate(paths):
+            np.testing.assert_array_equal(store.get(slots[path]), _features(i))
+
+
+def test_changed_image_reuses_its_row(tmp_path: Path) -> None:
+    folder = str(tmp_path / "features")
+    path, other = _image(tmp_path, "a.jpg"), _image(tmp_path, "b.jpg")
+    with FeatureStore(folder, "v1", ROW_SHAPE) as store:
+        store.add(path, _features(1))
+        store.add(other, _features(2))
+        with open(path, "ab") as f:
+            f.write(b"edited")
+        assert store.lookup([path]) == {}
+        store.add(path, _features(3))
+        assert store.lookup([path, other]) == {path: 0, other: 1}
+
+        batches = list(store.iter_batches(batch_size=8))
+        assert [paths for paths, _ in batches] == [[path, other]]
+        np.testing.assert_array_equal(batches[0][1], np.stack([_features(3), _features(2)]))
+
+
+def test_rows_of_other_versions_are_skipped(tmp_path: Path) -> None:
+    folder = str(tmp_path / "features")
+    paths = [_image(tmp_path, f"{i}.jpg") for i in range(3)]
+    with FeatureStore(folder, "v1", ROW_SHAPE) as store:
+        for i, path in enumerate(paths):
+            store.add(path, _features(i))
+    with FeatureStore(folder, "v2", ROW_SHAPE) as store:
+        assert store.lookup(paths) == {}
+        store.add(paths[1], _features(10))
+        batches = list(store.iter_batches(batch_size=8))
+    assert [paths for paths, _ in batches] == [[paths[1]]]
+    np.testing.assert_array_equal(batches[0][1], _features(10)[np.newaxis])
+
+
+def test_store_grows_past_the_initial_capacity(tmp_path: Path) -> None:
+    folder = str(tmp_path / "features")
+    rows = INITIAL_CAPACITY + 3
+    paths = [_image(tmp_path, f"{i}.jpg") for i in range(rows)]
+    with FeatureStore(folder, "v1", ROW_SHAPE) as reader, FeatureStore(folder, "v1", ROW_SHAPE) as writer:
+        for i, path in enumerate(paths):
+            writer.add(path, _features(i))
+        # the reader maps the rows the writer appended after the reader was opened
+        np.testing.assert_array_equal(reader.get(reader.lookup([paths[-1]])[paths[-1]]), _features(rows - 1))
+        assert sum(len(batch) for _, batch in reader.iter_batches(batch_size=100)) == rows
+    row_bytes = int(np.prod(ROW_SHAPE)) * 4
+    assert os.path.getsize(os.path.join(folder, FEATURES_FILE)) == 2 * INITIAL_CAPACITY * row_bytes
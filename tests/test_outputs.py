@@ -0,0 +1,107 @@
+import csv
+import datetime
+import json
+from pathlib import Path
+
+import pytest
+
+from app.cli.outputs import CsvWriter, JsonlWriter, MultiWriter, OutputFormat, ParquetWriter, open_writers
+from app.cli.records import ELA_COLUMNS, SCAN_COLUMNS, ElaRecord, ScanRecord
+
+TAKEN = datetime.datetime(2021, 6, 1, 12, 30, tzinfo=datetime.timezone.utc)
+
+
+def _records(count: int) -> list[ScanRecord]:
+    return [
+        ScanRecord(
+            path=f"/images/{i}.jpg",
+            datetime_original=TAKEN if i % 2 else None,
+            software="Adobe Photoshop" if i % 3 == 0 else "",
+            is_edited_by_software=i % 3 == 0,
+            latitude=48.85 if i % 2 else None,
+        )
+        for i in range(count)
+    ]
+
+
+def test_jsonl_holds_the_columns_and_appends(tmp_path: Path) -> None:
+    path = str(tmp_path / "report.jsonl")
+    writer = JsonlWriter(path, SCAN_COLUMNS)
+    for record in _records(2):
+        writer.add(record)
+    writer.close()
+    writer = JsonlWriter(path, SCAN_COLUMNS, append=True)
+    writer.add(ScanRecord(path="/images/é.jpg"))
+    writer.close()
+
+    rows = [json.loads(line) for line in Path(path).read_text(encoding="utf-8").splitlines()]
+    assert [row["path"] for row in rows] == ["/images/0.jpg", "/images/1.jpg", "/images/é.jpg"]
+    assert all(list(row) == list(SCAN_COLUMNS) for row in rows)
+    assert rows[0]["is_edited"] is True
+    assert rows[0]["datetime_original"] is None
+    assert rows[1]["datetime_original"] == TAKEN.isoformat()
+
+
+def test_csv_header_is_written_once(tmp_path: Path) -> None:
+    path = str(tmp_path / "ela_report.csv")
+    for verdict in (True, None):
+        writer = CsvWriter(path, ELA_COLUMNS, append=True)
+        writer.add(ElaRecord(f"/images/{verdict}.jpg", verdict))
+        writer.close()
+
+    with open(path, newline="", encoding="utf-8") as f:
+        rows = list(csv.reader(f))
+    assert rows == [list(ELA_COLUMNS), ["/images/True.jpg", "True"], ["/images/None.jpg", ""]]
+
+
+def test_parquet_is_written_in_row_groups(tmp_path: Path) -> None:
+    pq = pytest.importorskip("pyarrow.parquet")
+    path = str(tmp_path / "report.parquet")
+    writer = ParquetWriter(path, SCAN_COLUMNS, row_group_size=4)
+    for record in _records(10):
+        writer.add(record)
+    # the full row groups are written right away, the rest is buffered until the flush
+    assert len(writer.rows) == 2
+    writer.close()
+
+    file = pq.ParquetFile(path)
+    assert [file.metadata.row_group(i).num_rows for i in range(file.num_row_groups)] == [4, 4, 2]
+    table = file.read()
+    assert table.schema.names == list(SCAN_COLUMNS)
+    assert str(table.schema.field("datetime_original").type) == "timestamp[us, tz=UTC]"
+    assert table.column("path").to_pylist() == [f"/images/{i}.jpg" for i in range(10)]
+    assert table.column("datetime_original").to_pylist()[:2] == [None, TAKEN]
+
+
+def test_open_writers_writes_every_format_once(tmp_path: Path) -> None:
+    stem = str(tmp_path / "results" / "run1")
+    formats = [OutputFormat.JSONL, OutputFormat.CSV, OutputFormat.JSONL]
+    with open_writers(formats, stem, SCAN_COLUMNS) as writers:
+        assert len(writers.writers) == 2
+        for record in _records(3):
+            writers.add(record)
+
+    assert sorted(path.name for path in (tmp_path / "results").iterdir()) == ["run1.csv", "run1.jsonl"]
+    assert len((tmp_path / "results" / "run1.jsonl").read_text().splitlines()) == 3
+    assert len((tmp_path / "results" / "run1.csv").read_text().splitlines()) == 4
+
+
+class _FailingWriter:
+    def add(self, record: object) -> None:
+        pass
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        raise OSError("disk full")
+
+
+def test_multi_writer_closes_every_writer(tmp_path: Path) -> None:
+    jsonl = JsonlWriter(str(tmp_path / "report.jsonl"), SCAN_COLUMNS)
+    writers = MultiWriter([_FailingWriter(), jsonl])
+    writers.add(_records(1)[0])
+    with pytest.raises(OSError, match="disk full"):
+        writers.close()
+    assert jsonl.file.closed
+    assert (tmp_path / "report.jsonl").read_text().count("\n") == 1
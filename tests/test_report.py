@@ -0,0 +1,53 @@
+import re
+from pathlib import Path
+
+from typer.testing import CliRunner
+
+from app.cli.main import app
+from app.cli.records import ScanRecord
+from app.cli.report import MAX_ROWS_PER_PAGE, ReportWriter
+
+
+def test_empty_report_is_saved(tmp_path: Path) -> None:
+    path = tmp_path / "report.pdf"
+    ReportWriter(str(path)).close()
+    assert path.read_bytes().startswith(b"%PDF")
+
+
+def test_scan_of_empty_directory_writes_report(tmp_path: Path) -> None:
+    folder = tmp_path / "empty"
+    folder.mkdir()
+    output = tmp_path / "report"
+    result = CliRunner().invoke(app, ["scan", "--path", str(folder), "--jobs", "1", "--output", str(output)])
+    assert result.exit_code == 0, result.output
+    assert (tmp_path / "report.pdf").read_bytes().startswith(b"%PDF")
+
+
+def _page_count(path: Path) -> int:
+    return len(re.findall(rb"/Type /Page\b(?!s)", path.read_bytes()))
+
+
+def test_report_pages(tmp_path: Path) -> None:
+    path = tmp_path / "report.pdf"
+    with ReportWriter(str(path)) as writer:
+        # the header and 89 rows fill two table pages
+        for i in range(MAX_ROWS_PER_PAGE * 2 - 1):
+            writer.add(ScanRecord(path=f"/images/{i}.jpg", latitude=48.85, longitude=2.35))
+    # plus the pie and years chart page and the countries chart page
+    assert _page_count(path) == 4
+
+    with ReportWriter(str(path)) as writer:
+        for i in range(MAX_ROWS_PER_PAGE * 2):
+            writer.add(
+                ScanRecord(
+                    path=f"/images/{i}.jpg",
+                    software="Adobe Photoshop",
+                    software_category="editor",
+                    software_confidence=0.9,
+                    duplicate_of="/images/0.jpg" if i else "",
+                ),
+            )
+    assert writer.software == {("Adobe Photoshop", "editor", 0.9): MAX_ROWS_PER_PAGE * 2}
+    assert len(writer.clusters["/images/0.jpg"]) == MAX_ROWS_PER_PAGE * 2 - 1
+    # the last row moves to a third table page, the software gets a page and the 90 cluster lines two
+    assert _page_count(path) == 8
@@ -0,0 +1,32 @@
+import socket
+from pathlib import Path
+
+import pytest
+
+from app.ela_nn.server import SocketInUseError, _remove_stale_socket
+
+
+def test_stale_socket_is_removed(tmp_path: Path) -> None:
+    path = str(tmp_path / "ela.sock")
+    # bound but not listening anymore, as left by a killed daemon
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as stale:
+        stale.bind(path)
+    _remove_stale_socket(path)
+    assert not Path(path).exists()
+
+
+def test_socket_of_a_running_server_is_kept(tmp_path: Path) -> None:
+    path = str(tmp_path / "ela.sock")
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as running:
+        running.bind(path)
+        running.listen()
+        with pytest.raises(SocketInUseError, match="another server"):
+            _remove_stale_socket(path)
+    assert Path(path).exists()
+
+
+def test_other_files_are_left_alone(tmp_path: Path) -> None:
+    path = tmp_path / "ela.sock"
+    path.write_text("not a socket")
+    _remove_stale_socket(str(path))
+    assert path.exists()
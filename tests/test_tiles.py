@@ -0,0 +1,92 @@
+import typing as t
+from pathlib import Path
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+from app.cli.records import TiledElaRecord
+from app.ela_nn.ela import ela
+from app.ela_nn.tiles import check_ela_tiled, ela_tile, min_tampered_tiles, tile_grid
+
+SAMPLES = Path(__file__).parent.parent / "samples"
+
+
+def test_tile_grid_covers_the_image() -> None:
+    grid = tile_grid((1100, 530), 512)
+    # the 76px wide last column is kept, the 18px high last row is merged into the one above
+    assert [box[0] for box in grid[0]] == [0, 512, 1024]
+    assert grid[0][-1] == (1024, 0, 1100, 530)
+    assert len(grid) == 1
+    with pytest.raises(ValueError, match="multiple of 16"):
+        tile_grid((100, 100), 100)
+
+
+def test_tile_ela_matches_the_whole_image_ela() -> None:
+    path = str(SAMPLES / "books.jpg")
+    image = Image.open(path).convert("RGB")
+    whole = ela(path)
+    box = (256, 128, 512, 384)
+    difference = np.abs(ela_tile(image, box).astype(np.int16) - whole[128:384, 256:512].astype(np.int16))
+    assert difference.mean() < 1
+
+
+@pytest.mark.parametrize(("tiles", "expected"), [(1, 1), (4, 1), (20, 1), (21, 2), (408, 21)])
+def test_min_tampered_tiles(tiles: int, expected: int) -> None:
+    assert min_tampered_tiles(tiles, 0.05) == expected
+
+
+class ConstantModel(torch.nn.Module):
+    """Gives the probabilities in order, one per tile"""
+
+    def __init__(self, probabilities: list[float]) -> None:
+        super().__init__()
+        self.probabilities = iter(probabilities)
+
+    def forward(self, batch: torch.Tensor) -> torch.Tensor:
+        tampered = torch.tensor([next(self.probabilities) for _ in range(len(batch))])
+        return torch.stack([tampered, 1 - tampered], dim=1)
+
+
+class FakeScorer:
+    batch_size = 3
+    device = torch.device("cpu")
+
+    def __init__(self, probabilities: list[float]) -> None:
+        self.model = ConstantModel(probabilities)
+
+
+class ListWriter:
+    def __init__(self) -> None:
+        self.records: list[t.Any] = []
+
+    def add(self, record: t.Any) -> None:
+        self.records.append(record)
+
+
+@pytest.mark.parametrize(
+    ("probabilities", "is_authentic"),
+    [([0.1] * 24, True), ([0.9] + [0.1] * 23, True), ([0.9, 0.9] + [0.1] * 22, False)],
+)
+def test_one_tampered_tile_of_many_does_not_flag_the_image(
+    tmp_path: Path,
+    probabilities: list[float],
+    is_authentic: bool,
+) -> None:
+    path = str(tmp_path / "large.jpg")
+    Image.new("RGB", (6 * 64, 4 * 64), (120, 80, 40)).save(path)
+    writer = ListWriter()
+    heatmaps = tmp_path / "heatmaps"
+    check_ela_tiled(
+        [path],
+        FakeScorer(probabilities),  # type: ignore[arg-type]
+        tile_size=64,
+        heatmap_folder=str(heatmaps),
+        output=writer,  # type: ignore[arg-type]
+    )
+    (record,) = writer.records
+    assert isinstance(record, TiledElaRecord)
+    assert (record.tiles, record.tampered_tiles) == (24, probabilities.count(0.9))
+    assert record.is_authentic is is_authentic
+    assert Path(record.heatmap).parent == heatmaps and Path(record.heatmap).exists()